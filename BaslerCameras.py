@@ -8,6 +8,74 @@ import numpy as np
 from CameraControlsNew import CameraInterface
 from pypylon import pylon  # For basler camera, maybe move that out of here
 from time import sleep
+from threading import Thread, Event
+
+from FrameBuffers import FrameRing, FramePairer
+
+GRAB_STRATEGIES = {
+    'OneByOne': pylon.GrabStrategy_OneByOne,
+    'LatestImageOnly': pylon.GrabStrategy_LatestImageOnly,
+    }
+
+class GrabThread(Thread):
+    """
+    Drains the grab results of a free-running camera into a FrameRing.
+
+    The frames are copied straight from the pylon buffer into the slot of the ring, with the camera timestamp and block ID.
+    Gaps in the block IDs are counted as dropped (lost by the camera or the transport), images that pylon overwrote
+    before they were retrieved (LatestImageOnly) as skipped.
+    """
+
+    def __init__(self, cam, frame_ring, dtype = np.uint8, timeout = 1000):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.cam = cam
+        self.frame_ring = frame_ring
+        self.dtype = dtype
+        self.timeout = timeout
+        self.stop_event = Event()
+        self.frames = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.failed = 0
+        self.last_block_id = None
+
+    def stop(self):
+        self.stop_event.set()
+        self.join(timeout=2 * self.timeout / 1000)
+
+    def stats(self):
+        return {'frames': self.frames, 'dropped': self.dropped, 'skipped': self.skipped, 'failed': self.failed}
+
+    def run(self):
+        while not self.stop_event.is_set() and self.cam.IsGrabbing():
+            try:
+                result = self.cam.RetrieveResult(self.timeout, pylon.TimeoutHandling_Return)
+            except Exception as ex:
+                print(f"Grab thread stopped, {ex}")
+                break
+
+            if result is None or not result.IsValid():
+                continue
+
+            try:
+                if not result.GrabSucceeded():
+                    self.failed += 1
+                    continue
+
+                block_id = result.BlockID
+                if self.last_block_id is not None and block_id > self.last_block_id + 1:
+                    self.dropped += block_id - self.last_block_id - 1
+                self.last_block_id = block_id
+                self.skipped += result.GetNumberOfSkippedImages()
+
+                image = result.Array
+                slot = self.frame_ring.next_slot(image.shape, self.dtype)
+                np.copyto(slot, image, casting='unsafe')
+                self.frame_ring.commit(timestamp=result.TimeStamp, frame_id=block_id)
+                self.frames += 1
+            finally:
+                result.Release()
 
 #class TimeoutException(Exception):
 #    print("Timeout of camera!")
@@ -28,8 +96,199 @@ class BaslerCamera(CameraInterface):
         self.cam2_max_height = 0
         self.cameratype = 'Basler' if self.num_cameras > 0 else 'Emulator'
 
+        # Continuous (free-running) grabbing into frame rings, see start_continuous.
+        self.continuous = False
+        self.frame_ring = None
+        self.camera_rings = []  # One ring per camera when two cameras are paired
+        self.pairer = FramePairer()
+        self.grab_strategy = 'OneByOne'
+        self.max_num_buffer = 20
+        self.grab_threads = []
+        self.frames_read = 0
+        self.frames_overwritten = 0  # Grabbed frames overwritten in the ring before capture_frames read them
+        self.triggered_settings = []  # TriggerMode, TriggerSource and MaxNumBuffer per camera, put back by stop_continuous
+
+        # Mono8 frames are uint8, Mono12 frames keep the 12 bits in uint16.
+        self.bit_depth = 8
+        self.dtype = np.uint8
+
+    def get_pixel_format(self):
+        return "Mono12" if self.bit_depth > 8 else "Mono8"
+
+    def set_bit_depth(self, bit_depth):
+        '''
+        Sets the pixel format to Mono8 (uint8 frames) or Mono12 (uint16 frames with values up to 4095).
+        '''
+        self.stop_grabbing()
+        self.bit_depth = 12 if bit_depth > 8 else 8
+        self.dtype = np.uint16 if self.bit_depth > 8 else np.uint8
+        try:
+            self.cam.PixelFormat = self.get_pixel_format()
+            if self.num_cameras > 1:
+                self.cam2.PixelFormat = self.get_pixel_format()
+        except Exception as ex:
+            print(f"Pixel format {self.get_pixel_format()} not accepted by camera, {ex}")
+
+    def start_continuous(self, frame_ring, grab_strategy='OneByOne', max_num_buffer=20, pair_tolerance=1_000_000):
+        '''
+        Switches to free-running acquisition where GrabThreads write every frame into frame rings.
+        capture_frames then returns the new frames of frame_ring instead of triggering the camera.
+
+        With two cameras each camera is drained by its own thread into its own ring. The frames are paired on their
+        hardware timestamps (see FramePairer) and the side by side view is written into frame_ring.
+
+        grab_strategy: 'OneByOne' (every frame, in order) or 'LatestImageOnly' (only the newest frame is kept by pylon).
+        max_num_buffer: Number of pylon buffers, frames arriving while all are full are dropped.
+        pair_tolerance: Maximum timestamp difference (ns) of paired frames.
+        '''
+        if grab_strategy not in GRAB_STRATEGIES:
+            print(f"Unknown grab strategy {grab_strategy}, choose from {list(GRAB_STRATEGIES)}")
+            return False
+
+        self.stop_grabbing()
+        if not self.continuous:
+            # Free-running mode turns the trigger off, keep the triggered settings for stop_continuous.
+            self.triggered_settings = []
+            for cam in [self.cam, self.cam2][:self.num_cameras]:
+                try:
+                    self.triggered_settings.append({
+                        'TriggerSource': cam.TriggerSource.GetValue(),
+                        'TriggerMode': cam.TriggerMode.GetValue(),
+                        'MaxNumBuffer': cam.MaxNumBuffer.GetValue(),
+                        })
+                except Exception as ex:
+                    print(f"Could not read the trigger settings, {ex}")
+                    self.triggered_settings.append(None)
+        self.frame_ring = frame_ring
+        self.grab_strategy = grab_strategy
+        self.max_num_buffer = max_num_buffer
+        self.pairer.tolerance = pair_tolerance
+        if self.num_cameras == 2:
+            self.camera_rings = [FrameRing(capacity=max_num_buffer), FrameRing(capacity=max_num_buffer)]
+        else:
+            self.camera_rings = [frame_ring]
+        self.continuous = True
+        return True
+
+    def stop_continuous(self):
+        self.stop_grabbing()
+        # Back to software triggering, otherwise RetrieveResult returns old frames of the free-running camera.
+        for cam, settings in zip([self.cam, self.cam2], self.triggered_settings):
+            if settings is None:
+                continue
+            try:
+                cam.MaxNumBuffer = settings['MaxNumBuffer']
+                cam.TriggerSource = settings['TriggerSource']
+                cam.TriggerMode = settings['TriggerMode']
+            except Exception as ex:
+                print(f"Could not restore the trigger settings, {ex}")
+        self.triggered_settings = []
+        self.continuous = False
+
+    def grab_stats(self):
+        '''
+        Frames, dropped (block ID gaps), skipped (overwritten in pylon) and failed grabs of the grab threads.
+        With one camera the frames overwritten in the ring before capture_frames read them are also counted as dropped
+        (and on their own as overwritten). With two cameras also the pairing statistics (matched, orphaned, skew in ns).
+        '''
+        if len(self.grab_threads) == 0:
+            return None
+        if len(self.grab_threads) == 1:
+            stats = self.grab_threads[0].stats()
+            stats['dropped'] += self.frames_overwritten
+            stats['overwritten'] = self.frames_overwritten
+            return stats
+        return {
+            'cam1': self.grab_threads[0].stats(),
+            'cam2': self.grab_threads[1].stats(),
+            'pairing': self.pairer.stats(),
+            }
+
+    def start_grab_threads(self):
+        cams = [self.cam, self.cam2][:len(self.camera_rings)]
+        for cam, ring in zip(cams, self.camera_rings):
+            try:
+                cam.TriggerMode = "Off"
+            except Exception as ex:
+                print(f"Could not turn off trigger mode, {ex}")
+            cam.MaxNumBuffer = self.max_num_buffer
+            cam.StartGrabbing(GRAB_STRATEGIES[self.grab_strategy])
+
+            grab_thread = GrabThread(cam, ring, self.dtype)
+            grab_thread.start()
+            self.grab_threads.append(grab_thread)
+
+        self.pairer.reset()
+        self.frames_read = self.camera_rings[-1].frames_written
+        self.frames_overwritten = 0
+        self.is_grabbing = True
+
+    def combine_images(self, image1, image2, out):
+        '''
+        Writes the flipped image of camera 1 and the image of camera 2 side by side into out.
+        '''
+        h1, w1 = image1.shape
+        h2, w2 = image2.shape
+        np.copyto(out[:h1, :w1], image1[::-1], casting='unsafe')
+        np.copyto(out[:h2, w1:w1 + w2], image2, casting='unsafe')
+        #Zero the rest of the shorter image
+        if h1 < out.shape[0]:
+            out[h1:, :w1] = 0
+        if h2 < out.shape[0]:
+            out[h2:, w1:] = 0
+        return out
+
+    def capture_paired_frames(self):
+        '''
+        Waits for new pairs of frames of the two camera rings and writes their combined views into frame_ring.
+        Returns the combined frames as in capture_frames, with the timestamp and block ID of camera 1.
+        '''
+        ring1, ring2 = self.camera_rings
+        for _ in range(100):
+            if not ring2.wait_for_frame(self.frames_read, timeout=3):
+                return []
+            self.frames_read = ring2.frames_written
+
+            frames = []
+            for slot1, slot2 in self.pairer.pair(ring1, ring2):
+                image1, image2 = ring1.frames[slot1], ring2.frames[slot2]
+                shape = (max(image1.shape[0], image2.shape[0]), image1.shape[1] + image2.shape[1])
+                self.combine_images(image1, image2, self.frame_ring.next_slot(shape, self.dtype))
+                self.frame_ring.commit(timestamp=ring1.timestamps[slot1], frame_id=ring1.frame_ids[slot1])
+                frames.append(self.frame_ring.copy_latest(with_info=True))
+            if len(frames) > 0:
+                return frames
+        return []
+
+    def capture_frames(self):
+        '''
+        Free-running mode: every frame grabbed since the last call, oldest first, as (image, timestamp, frame_id) with
+        the camera timestamp and block ID. Waits for at least one new frame, an empty list if none arrived.
+        Frames the grab thread overwrote in the ring before they were read are counted in grab_stats.
+        '''
+        if not self.is_grabbing:
+            self.start_grab_threads()
+
+        if len(self.camera_rings) == 2:
+            frames = self.capture_paired_frames()
+            if len(frames) == 0:
+                print("The two cameras failed to grab a pair of images")
+            return frames
+
+        if not self.frame_ring.wait_for_frame(self.frames_read, timeout=3):
+            print("Camera failed to grab an image")
+            return []
+        frames, self.frames_read, overwritten = self.frame_ring.copy_since(self.frames_read)
+        self.frames_overwritten += overwritten
+        return frames
+
     def capture_image(self):
-        
+
+        #Free-running, the grab threads fill the rings. The newest of the frames since the last call.
+        if self.continuous:
+            frames = self.capture_frames()
+            return frames[-1][0] if len(frames) > 0 else None
+
         #Define the cameras to use
         if not self.is_grabbing:
             self.is_grabbing = True
@@ -46,7 +305,9 @@ class BaslerCamera(CameraInterface):
             result = self.cam.RetrieveResult(3000)
             self.img.AttachGrabResultBuffer(result)
             if result.GrabSucceeded():
-                image = np.uint8(self.img.GetArray())
+                #GetArray already returns a new array (Mono8 uint8, Mono12 uint16), not a view of the grab buffer,
+                #so it is only converted when the dtype differs and never copied a second time.
+                image = self.img.GetArray().astype(self.dtype, copy=False)
                 return image
             else:
                 print("Camera failed to grab an image")
@@ -62,19 +323,12 @@ class BaslerCamera(CameraInterface):
             self.img2.AttachGrabResultBuffer(result2)
 
             if result.GrabSucceeded() and result2.GrabSucceeded():
-                image1 = np.flipud(np.uint8(self.img.GetArray()))
-                image2 = np.uint8(self.img2.GetArray())
-
-                #If they are the same size, concatenate them horisontally.
-                if image1.shape == image2.shape:
-                    image = np.concatenate((image1, image2), axis=1)
-                #If they are not the same size, make them the same size and concatenate them horisontally.
-                else:
-                    image = np.zeros((max(image1.shape[0], image2.shape[0]), image1.shape[1]+image2.shape[1]))
-                    image[0:image1.shape[0], 0:image1.shape[1]] = image1
-                    image[0:image2.shape[0], image1.shape[1]:image1.shape[1] + image2.shape[1]] = image2
+                image1 = self.img.GetArray()
+                image2 = self.img2.GetArray()
 
-                return image
+                #Side by side (padded with zeros if the sizes differ), written straight into one image.
+                image = np.empty((max(image1.shape[0], image2.shape[0]), image1.shape[1] + image2.shape[1]), dtype=self.dtype)
+                return self.combine_images(image1, image2, image)
             #exception if one of the cameras fail
             else:
                 print("One of the two cameras failed to grab an image")
@@ -161,14 +415,14 @@ class BaslerCamera(CameraInterface):
             #Set gain and exposure time, pixel format, fps
             self.cam.Gain = 0
             self.cam.ExposureTime = 1000
-            self.cam.PixelFormat = "Mono12"
+            self.cam.PixelFormat = self.get_pixel_format()
             self.cam.AcquisitionFrameRateEnable = True
             self.cam.AcquisitionFrameRate = 60
 
             if self.num_cameras > 1:
                 self.cam2.Gain = 0
                 self.cam2.ExposureTime = 1000
-                self.cam2.PixelFormat = "Mono12"
+                self.cam2.PixelFormat = self.get_pixel_format()
                 self.cam2.AcquisitionFrameRateEnable = True
                 self.cam2.AcquisitionFrameRate = 60
 
@@ -196,6 +450,13 @@ class BaslerCamera(CameraInterface):
             self.cam2 = None
 
     def stop_grabbing(self):
+        #The grab thread is restarted by capture_image after the new settings are applied.
+        if len(self.grab_threads) > 0:
+            stats = self.grab_stats()
+            for grab_thread in self.grab_threads:
+                grab_thread.stop()
+            print(f"Grab threads stopped: {stats}")
+            self.grab_threads = []
         try:
             self.cam.StopGrabbing()
             self.cam2.StopGrabbing()
@@ -10,11 +10,14 @@ import cv2 # Certain versions of this won't work
 import tkinter
 from tkinter import simpledialog
 from time import sleep, strftime, perf_counter
+from queue import Empty
 from threading import Thread
-from copy import copy, deepcopy
 # from queue import Queue
 import skvideo.io
 import numpy as np
+
+from FrameBuffers import RunningBackground
+from VideoWriters import SEGMENT_WRITERS, SegmentedWriter, available_hdf5_codecs
 from CustomMouseTools import MouseInterface
 from PyQt6.QtGui import  QColor,QPen
 
@@ -110,10 +113,17 @@ class CameraInterface(metaclass=abc.ABCMeta):
 
     @abc.abstractmethod
     def capture_image(self):
-        """Capture a single image"""
+        """
+        Capture a single image. The returned array must not be changed afterwards (a new array per frame or a
+        read-only view), the camera thread hands it to the recording without a copy.
+        """
         raise NotImplementedError
 
 
+# Camera ID stored with the recorded frames, a bitmask of the cameras in the frame.
+CAMERA_IDS = {'cam1': 1, 'cam2': 2, 'both': 3}
+
+
 class CameraThread(Thread):
 
     def __init__(self, c_p, camera):
@@ -146,10 +156,12 @@ class CameraThread(Thread):
         self.tmp_width_cam2 = c_p['camera_width2']
         self.tmp_height_cam2 = c_p['camera_height2']
         self.c_p = c_p
+        self.recording = False
 
         if self.camera.cameratype =='Basler':
             self.camera.cam.AcquisitionFrameRateEnable = False
             print("Framrate ", self.camera.cam.ResultingFrameRate())
+            self.camera.set_bit_depth(self.c_p['bit_depth'])
         
         # Zoom out
         self.c_p['AOI'] = [0, self.c_p['camera_width'], 0,
@@ -174,8 +186,29 @@ class CameraThread(Thread):
         elif self.c_p['new_settings_camera'][1] == 'burst_mode' and self.camera.cameratype =='Basler':
             self.camera.set_burst_mode(self.c_p['burst_mode'])
 
-        elif self.c_p['new_settings_camera'][1] == 'fps' and self.camera.cameratype =='Basler' and self.c_p['fps'] is not None:
+        elif self.c_p['new_settings_camera'][1] == 'fps' and self.camera.cameratype in ('Basler', 'Replay') and self.c_p['fps'] is not None:
             self.camera.set_fps(self.c_p['fps'])
+
+        elif self.c_p['new_settings_camera'][1] == 'bit_depth' and self.camera.cameratype =='Basler':
+            self.camera.set_bit_depth(self.c_p['bit_depth'])
+
+        elif self.c_p['new_settings_camera'][1] == 'grab_mode' and self.camera.cameratype =='Basler':
+            if self.c_p['grab_mode'] == 'Triggered':
+                self.camera.stop_continuous()
+            elif not self.camera.start_continuous(self.c_p['frame_ring'], self.c_p['grab_mode'], self.c_p['max_num_buffer'],
+                                                  pair_tolerance=self.c_p['pair_tolerance']):
+                self.c_p['grab_mode'] = 'Triggered'
+
+        elif self.c_p['new_settings_camera'][1] == 'buffer_size':
+            self.c_p['frame_ring'].set_capacity(self.c_p['buffer_size'])
+
+        elif self.c_p['new_settings_camera'][1] == 'background_mode':
+            # The background model costs a pass over every frame, it is only kept while subtraction mode is on.
+            if self.c_p['SubtractionMode']:
+                self.c_p['frame_ring'].set_background(
+                    RunningBackground(self.c_p['background_mode'], alpha=self.c_p['background_alpha']))
+            else:
+                self.c_p['frame_ring'].set_background(None)
         
         # Resetting the new_settings_camera parameter
         self.c_p['new_settings_camera'] = [False, None]
@@ -186,48 +219,71 @@ class CameraThread(Thread):
             self.c_p['exposure_time'] = self.camera.get_exposure_time()
 
         count = 0
+        n_frames = 0
         while self.c_p['program_running']:
             if self.c_p['new_settings_camera'][0]:
                 self.update_camera_settings()
             count += 1
             if count % 20 == 5:
                 p_t = perf_counter()
+                p_frames = n_frames
 
-            #Here the image is captured. If two cameras are connected it will always read both.
-            img=self.camera.capture_image()
-            
-            #Small buffer for background subtraction
-            if len(self.c_p['buffer']) < self.c_p['buffer_size'] and self.c_p['SubtractionMode']:
-                self.c_p['buffer'].append(img)
+            #Here the images are captured, (image, timestamp, frame_id). If two cameras are connected it will always read both.
+            #In continuous mode the grab threads of the camera already wrote the frames into the ring, every frame since
+            #the last loop is returned with its camera timestamp and block ID, so none are lost for the recording.
+            if getattr(self.camera, 'continuous', False):
+                frames = self.camera.capture_frames()
             else:
-                #pop n elements from the buffer depending on the buffer size
-                while len(self.c_p['buffer']) >= self.c_p['buffer_size']:
-                    self.c_p['buffer'].pop(0)
-                self.c_p['buffer'].append(img)
-            
-            #Camera 1
-            if self.c_p['camera_mode'] == 'cam1':
-                if self.c_p['num_cameras']==2: 
-                    self.c_p['image'] = img[:self.tmp_height_cam1, :self.tmp_width_cam1]
-                else:
+                frames = []
+                img = self.camera.capture_image()
+                if img is not None:
+                    #Small buffer for background subtraction, the frame is copied into a preallocated slot.
+                    ring = self.c_p['frame_ring']
+                    slot = ring.push(img)
+                    frames.append((img, ring.timestamps[slot], ring.frame_ids[slot]))
+
+            #Recording, start and stop go through the queue so the writer closes the file right after the last frame.
+            if self.c_p['recording'] != self.recording:
+                self.recording = self.c_p['recording']
+                self.c_p['frame_queue'].put_command('start' if self.recording else 'stop')
+            if self.c_p['rotate_recording']:
+                self.c_p['rotate_recording'] = False
+                self.c_p['frame_queue'].put_command('rotate')
+            event_recording = self.c_p['event_recording'] and self.c_p['event_recorder'] is not None
+
+            for img, timestamp, frame_id in frames:
+                n_frames += 1
+
+                #Camera 1
+                if self.c_p['camera_mode'] == 'cam1':
+                    if self.c_p['num_cameras']==2: 
+                        self.c_p['image'] = img[:self.tmp_height_cam1, :self.tmp_width_cam1]
+                    else:
+                        self.c_p['image'] = img
+
+                #Camera 2
+                elif self.c_p['camera_mode'] == 'cam2' and self.c_p['num_cameras']==2:
+                    self.c_p['image'] = img[:self.tmp_height_cam2, self.tmp_width_cam1:]
+                    
+                #Both cameras
+                elif self.c_p['camera_mode'] == 'both' and self.c_p['num_cameras']==2:
                     self.c_p['image'] = img
 
-            #Camera 2
-            elif self.c_p['camera_mode'] == 'cam2' and self.c_p['num_cameras']==2:
-                self.c_p['image'] = img[:self.tmp_height_cam2, self.tmp_width_cam1:]
-                
-            #Both cameras
-            elif self.c_p['camera_mode'] == 'both' and self.c_p['num_cameras']==2:
-                self.c_p['image'] = img
-
-            #Recording
-            if self.c_p['recording']:
-                img = copy(self.c_p['image'])
-                name = copy(self.c_p['video_name'])
-                self.c_p['frame_queue'].put([img, name,
-                                             self.c_p['video_format']])
+                # Timestamp and frame ID of the frame (from the camera in continuous mode), stored by the raw format.
+                frame_info = (timestamp, frame_id, CAMERA_IDS.get(self.c_p['camera_mode'], 0))
+                if self.recording:
+                    # The frame is handed to the writer as it is, neither thread changes it, so the only copy is the
+                    # one into the file.
+                    self.c_p['frame_queue'].put([self.c_p['image'], self.c_p['video_name'],
+                                                 self.c_p['video_format'], *frame_info])
+                #Event recording, the last seconds of frames are held (not copied) until a trigger, see EventRecorder.py
+                if event_recording:
+                    self.c_p['event_recorder'].push(self.c_p['image'], *frame_info)
             if count % 20 == 15:
-                self.c_p['fps'] = 11 / (perf_counter()-p_t)
+                # Frames over the 10 loops since p_t was set at count % 20 == 5
+                self.c_p['fps'] = (n_frames - p_frames) / (perf_counter()-p_t)
+                if getattr(self.camera, 'continuous', False):
+                    self.c_p['grab_stats'] = self.camera.grab_stats()
                 
 class VideoFormatError(Exception):
     """
@@ -261,6 +317,15 @@ def create_avi_video_writer(c_p, video_name, image_width, image_height):
     return video
 
 
+def to_uint8(image, bit_depth=8):
+    """
+    Converts frames with more than 8 bits to uint8 for the formats that only take 8 bits (avi, mp4, screen).
+    """
+    if image.dtype == np.uint8:
+        return image
+    return np.uint8(np.right_shift(image, max(bit_depth - 8, 0)))
+
+
 def create_mp4_video_writer(c_p, video_name=None, image_width=None,
                             image_height=None):
     """
@@ -286,6 +351,31 @@ def create_mp4_video_writer(c_p, video_name=None, image_width=None,
     return video
 
 
+def get_writer_kwargs(c_p, video_format, dtype):
+    """
+    Codec settings of the raw, hdf5 and mkv writers (VideoWriters.py) from the control parameters.
+    """
+    if video_format == 'hdf5':
+        codec = c_p['hdf5_codec']
+        if codec not in available_hdf5_codecs() and len(available_hdf5_codecs()) > 0:
+            print(f"HDF5 codec {codec} not available, using {available_hdf5_codecs()[0]}")
+            codec = available_hdf5_codecs()[0]
+        workers = c_p['compression_workers']
+        if workers is None:
+            # Share the cores between the segment writers
+            workers = max((os.cpu_count() or 1) // c_p['writer_threads'], 1)
+        return {'codec': codec, 'level': c_p['hdf5_level'], 'workers': workers}
+
+    if video_format == 'mkv':
+        codec = c_p['ffmpeg_codec']
+        if codec == 'x264' and dtype != np.uint8:
+            print("x264 only records 8-bit frames losslessly, using ffv1")
+            codec = 'ffv1'
+        return {'codec': codec, 'threads': c_p['ffmpeg_threads']}
+
+    return {}
+
+
 def npy_generator(path):
     """
     Used to read all the images in a npy image folder one at a time. Takes the
@@ -338,7 +428,6 @@ class VideoWriterThread(Thread):
         self.c_p = c_p
         self.setDaemon(True)
 
-        self.sleep_time = 0.1
         self.frame = None
         self.video_width = np.shape(self.c_p['image'])[0]
         self.video_height = np.shape(self.c_p['image'])[1]
@@ -352,6 +441,9 @@ class VideoWriterThread(Thread):
         self.frame_count = 0
         self.VideoWriter = None
         self.np_save_path = None
+        self.frame_info = ()
+        self.writer_failed = False  # Frames are discarded until the next 'stop' after a writer error
+        self.frames_discarded = 0
 
     def close_video(self):
         """
@@ -362,6 +454,9 @@ class VideoWriterThread(Thread):
         None.
 
         """
+        if not self.video_created:
+            # Nothing open, e.g. after a failed writer
+            return
         self.video_created = False
         try:
             if self.last_frame_format == 'mp4':
@@ -373,6 +468,11 @@ class VideoWriterThread(Thread):
                     self.VideoWriter.release()
                     print("Closed AVI writer")
                 del self.VideoWriter
+            elif self.last_frame_format in SEGMENT_WRITERS:
+                if self.VideoWriter is not None:
+                    self.VideoWriter.close()
+                    print(f"Closed {self.last_frame_format} writer, {self.VideoWriter.n_frames} frames")
+                self.VideoWriter = None
             else:
                 # is npy, save what remains of buffer then clear it
                 self.np_save_frames()
@@ -418,7 +518,7 @@ class VideoWriterThread(Thread):
             self.np_save_frames()
         try:
             # TODO fix error here
-            self.frame_buffer[nbr_frames, :, :] = deepcopy(self.frame)
+            self.frame_buffer[nbr_frames, :, :] = self.frame
             # Do we miss a frame here?
             self.frame_count += 1
         except Exception as ex:
@@ -436,9 +536,11 @@ class VideoWriterThread(Thread):
         """
         # TODO add bg removal as parameter for each saved frame
         if self.format == 'mp4':
-            self.VideoWriter.writeFrame(self.frame)
+            self.VideoWriter.writeFrame(to_uint8(self.frame, self.c_p['bit_depth']))
         elif self.format == 'avi':
-            self.VideoWriter.write(self.frame)
+            self.VideoWriter.write(to_uint8(self.frame, self.c_p['bit_depth']))
+        elif self.format in SEGMENT_WRITERS:
+            self.VideoWriter.write(self.frame, *self.frame_info)
         else:
             self.write_to_NPY()
 
@@ -464,22 +566,32 @@ class VideoWriterThread(Thread):
                                                        self.video_height)
             print("created avi writer")
 
+        elif self.format in SEGMENT_WRITERS:
+            path = self.c_p['recording_path'] + '/' + video_name
+            if self.c_p['writer_threads'] > 1:
+                self.VideoWriter = SegmentedWriter(path, self.frame.shape, self.frame.dtype, fps=self.c_p['fps'],
+                                                   video_format=self.format, n_workers=self.c_p['writer_threads'],
+                                                   block_frames=self.c_p['segment_frames'], **get_writer_kwargs(self.c_p, self.format, self.frame.dtype))
+            else:
+                extension, writer_class = SEGMENT_WRITERS[self.format]
+                self.VideoWriter = writer_class(path + extension, self.frame.shape, self.frame.dtype,
+                                                fps=self.c_p['fps'], **get_writer_kwargs(self.c_p, self.format, self.frame.dtype))
+
         elif self.format == 'npy':
             # calculate an appropriate buffer size based on the size in memory
-            # the frames take up.
-            self.frame_buffer_size = int(501760000 /(self.video_width *self.video_height))
+            # the frames take up. 12-bit frames are saved as uint16 to keep the full depth.
+            frame_nbytes = self.frame.nbytes
+            self.frame_buffer_size = max(int(501760000 / frame_nbytes), 1)
             if len(image_shape) < 3: # image_shape[2] == 1:
-                # TODO uing uint8 may not be the best choice
-                # Check if we can use higher bitrates too
-                self.frame_buffer = np.uint8(np.zeros([self.frame_buffer_size,
-                                                       self.video_width,
-                                                       self.video_height,
-                                                       ]))
+                self.frame_buffer = np.zeros([self.frame_buffer_size,
+                                              self.video_width,
+                                              self.video_height,
+                                              ], dtype=self.frame.dtype)
             elif image_shape[2] == 3:
                 # TODO check why  height and widht have changed order
-                self.frame_buffer = np.uint8(np.zeros([self.frame_buffer_size,
-                                                       self.video_width,
-                                                       self.video_height, 3]))
+                self.frame_buffer = np.zeros([self.frame_buffer_size,
+                                              self.video_width,
+                                              self.video_height, 3], dtype=self.frame.dtype)
             self.frame_count = 0
 
             self.create_NP_writer(video_name)
@@ -489,54 +601,89 @@ class VideoWriterThread(Thread):
 
         self.video_created = True
 
+    def handle_command(self, command):
+        """
+        Recorder commands from the frame queue, see FrameQueue.put_command.
+        """
+        if command == 'start':
+            self.c_p['saving_video'] = True
+        elif command in ('stop', 'rotate') and self.video_created:
+            # The next frame opens a new file
+            self.close_video()
+        if command == 'stop':
+            self.c_p['saving_video'] = False
+            if self.writer_failed:
+                print(f"Recording stopped, {self.frames_discarded} frames were discarded after the writer error")
+            self.writer_failed = False
+            self.frames_discarded = 0
+
     def run(self):
         self.c_p['video_idx'] = 0
         while self.c_p['program_running']:
-            sleep(self.sleep_time)
-            self.c_p['saving_video'] = False
-
-            while self.c_p['recording'] or not self.c_p['frame_queue'].empty()\
-                    and self.c_p['program_running']:
-                self.c_p['saving_video'] = True
-
-                # Check empty twice since we don't want to wait longer than
-                # necessary for the image to be printed to the videowriter
-
-                if not self.c_p['frame_queue'].empty():
-
-                    [self.frame, source_video, self.format] = self.c_p['frame_queue'].get()
-
-                    # Check that name and size are correct, if not create a new
-                    image_shape = np.shape(self.frame)
-                    if image_shape[0] != self.video_width or\
-                            image_shape[1] != self.video_height:
-                        self.video_width = image_shape[0]
-                        self.video_height = image_shape[1]
-                        self.close_video()
-                    # Check if name and format is ok
-                    # TODO check how this handles leftover frames in buffer?
-                    # Maybe change to comparing against source video?
-                    if self.video_name != source_video:
-                        self.close_video()
-                        self.video_name = source_video
-                    if not self.last_frame_format == self.format:
-                        self.close_video()
-
-                    if not self.video_created:
-                        # TODO check naming convention, what happens when we
-                        # change format
-                        size = '_' + str(self.video_width) + 'x'
-                        size += str(self.video_height)
-                        size += '_' + str(self.c_p['video_idx']) 
-                        self.c_p['video_idx'] += 1
-                        self.create_video_writer(self.video_name+size)
-                    self.last_frame_format = self.format
-                    self.write_frame()
-                else:
-                    # Queue empty
-                    sleep(0.001)
-            if self.video_created:
+            # Sleeps until a frame or a command arrives, the timeout is only for noticing that the program stopped.
+            try:
+                item = self.c_p['frame_queue'].get(timeout=0.5)
+            except Empty:
+                continue
+            if isinstance(item, str):
+                self.handle_command(item)
+                continue
+
+            if self.writer_failed:
+                self.frames_discarded += 1
+                continue
+
+            self.frame, source_video, self.format = item[:3]
+            self.frame_info = item[3:]  # timestamp, frame ID and camera ID
+
+            # Check that name and size are correct, if not create a new
+            image_shape = np.shape(self.frame)
+            if image_shape[0] != self.video_width or\
+                    image_shape[1] != self.video_height:
+                self.video_width = image_shape[0]
+                self.video_height = image_shape[1]
+                self.close_video()
+            # The npy buffer, raw, hdf5 and mkv files are made for one bit depth
+            if self.format == 'npy' and self.video_created and self.frame_buffer.dtype != self.frame.dtype:
+                self.close_video()
+            if self.format in SEGMENT_WRITERS and self.video_created and self.VideoWriter.dtype != self.frame.dtype:
                 self.close_video()
+            # Check if name and format is ok
+            # TODO check how this handles leftover frames in buffer?
+            # Maybe change to comparing against source video?
+            if self.video_name != source_video:
+                self.close_video()
+                self.video_name = source_video
+            if not self.last_frame_format == self.format:
+                self.close_video()
+
+            if not self.video_created:
+                # TODO check naming convention, what happens when we
+                # change format
+                size = '_' + str(self.video_width) + 'x'
+                size += str(self.video_height)
+                size += '_' + str(self.c_p['video_idx']) 
+                self.c_p['video_idx'] += 1
+            # A failing writer (missing h5py or ffmpeg, full disk, ...) must not stop the thread, the recording queue
+            # would fill up for the rest of the session. The frames are discarded until the recording is stopped.
+            try:
+                if not self.video_created:
+                    self.create_video_writer(self.video_name+size)
+                    self.c_p['writer_error'] = None
+                self.last_frame_format = self.format
+                self.write_frame()
+            except Exception as ex:
+                print(f"Could not record {self.format}, {ex}. Frames are discarded until the recording is stopped.")
+                self.c_p['writer_error'] = f"{self.format}: {ex}"
+                self.writer_failed = True
+                self.frames_discarded = 1
+                if self.video_created:
+                    self.close_video()
+                continue
+            self.c_p['frames_written'] += 1
+
+        if self.video_created:
+            self.close_video()
 
 
 class CameraControlMenu():
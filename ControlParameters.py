@@ -7,7 +7,8 @@ Created on Fri Oct  7 13:48:24 2022
 
 import numpy as np
 from PIL import Image # Errors with this, dont know why
-from queue import Queue
+
+from FrameBuffers import FrameRing, FrameQueue
 
 def default_c_p():
     """
@@ -28,7 +29,8 @@ def default_c_p():
            # Camera c_p
            'image': np.random.randint(0, 255, size = (500, 500)),#, 1]),
            'image_idx': 0, # Index of snapshot image, add also video idx maybe.
-           'color': "mono",  # Options are mono and color # Maybe add bit depth too
+           'color': "mono",  # Options are mono and color
+           'bit_depth': 8, # 8 (Mono8, uint8 frames) or 12 (Mono12, uint16 frames). The display is always 8 bit.
            'new_settings_camera': [False, None],
             # Camera sizes. These are the default values for the Basler camera
 
@@ -41,6 +43,15 @@ def default_c_p():
            'camera_height2': 1280,
 
            'recording': False,
+           'rotate_recording': False, # Close the recorded file and continue in a new one, see FrameQueue.put_command
+           'event_recording': False, # Hold the last event_pre_trigger seconds of frames for event recording
+           'event_recorder': None, # EventRecorder, started by the GUI (see EventRecorder.py)
+           'event_pre_trigger': 2, # Seconds written from before the trigger
+           'event_post_trigger': 2, # Seconds written after the trigger
+           'event_buffer_mb': 4096, # Memory budget of the held event frames
+           'event_format': 'raw', # 'raw', 'hdf5' or 'mkv'
+           'saving_video': False, # The VideoWriterThread has a recording open
+           'writer_error': None, # Last error of the VideoWriterThread, frames are discarded until the recording is stopped
            'exposure_time': 5000,
            'fps': 200,  # Frames per second of camera
            'filename': '',
@@ -52,20 +63,35 @@ def default_c_p():
            'AOI':[0,1000,0,1000], # Area of interest of camera
            'recording_path': '../Example data/',
            'bitrate': '30000000', #'300000000',
-           'frame_queue': Queue(maxsize=2_000_000),  # Frame buffer essentially
+           'hdf5_codec': 'blosc-lz4', # Compression of the hdf5 format, see VideoWriters.py
+           'hdf5_level': 5, # Compression level of the hdf5 format
+           'compression_workers': None, # Compression threads of the hdf5 format, None for all cores
+           'ffmpeg_codec': 'ffv1', # Lossless codec of the mkv format, 'ffv1' or 'x264' (8-bit only)
+           'ffmpeg_threads': None, # Encoder threads of the mkv format, None for all cores
+           'writer_threads': 1, # Writer threads for raw, hdf5 and mkv, more than 1 writes one file per thread (see SegmentedWriter)
+           'segment_frames': 16, # Consecutive frames written by the same writer thread
+           'frame_queue_mb': 2048, # Memory budget of the recording queue
+           'frame_queue_policy': 'drop_newest', # When the queue is full: 'block' capture, 'drop_newest' or 'drop_oldest'
+           'frame_queue': FrameQueue(max_bytes=2048 * 1024**2, policy='drop_newest'),  # Frame buffer essentially, see FrameBuffers.py
+           'frames_written': 0, # Frames written by the VideoWriterThread, see RecordingBenchmark.py
            'image_scale': 1,
            'microns_per_pix': 30/5000 * 1e-3, # 5000 pixels per 30 micron roughly, changed to have more movements
            
             #Settings for subtraction mode              
             'SubtractionMode':False,
             'buffer_size': 5,
-            'buffer': [],
+            'background_mode': 'mean', # 'mean' of the buffer, 'ema' or approximate 'median', see FrameBuffers.py
+            'background_alpha': 0.05, # Weight of new frames for 'ema'
+            'frame_ring': FrameRing(capacity=5), # Latest buffer_size frames, written in place by the camera thread. Has a background model only in subtraction mode
 
             #Settings for HighSpeedMode
             'HighSpeedMode':False,
             'HighSpeedMode_ds': 2, #Downsampling factor
             'HighSpeedMode_method':'bin', #'bin' is faster, 'avg' is more accurate
 
+            #FFT backend for the field windows, 'numpy', 'scipy' or 'pyfftw' (see Utils/fft_backend.py)
+            'fft_backend': 'numpy',
+
             #Settings for overlaying images
             'Overlay_image_mode':False,
 
@@ -75,6 +101,12 @@ def default_c_p():
 
             'burst_mode': False, 
 
+            #Acquisition, 'Triggered' (software trigger per frame) or free-running 'OneByOne'/'LatestImageOnly' (see BaslerCameras.py)
+            'grab_mode': 'Triggered',
+            'max_num_buffer': 20, # pylon buffers in free-running mode
+            'pair_tolerance': 1_000_000, # Maximum timestamp difference (ns) of paired frames of two free-running cameras
+            'grab_stats': None, # Frames, dropped and skipped counts of the grab threads and pairing statistics
+
            # Deep learning tracking
            'network': None,
            'tracking_on': False,
@@ -18,6 +18,8 @@ QVBoxLayout, QWidget, QLabel,
 # from PyQt6.QtCore import QTimer
 from PyQt6.QtCore import QTimer
 
+from Utils import fft_backend as FB
+
 
 class DataAnalytics(QMainWindow):
     def __init__(self, c_p):
@@ -93,7 +95,7 @@ class DataAnalytics(QMainWindow):
             #TODO could add more costumization here
 
     def fft_transform(dself, data):
-        im = np.log(np.abs(np.fft.fftshift(np.fft.fft2(data))))
+        im = np.log(np.abs(np.fft.fftshift(FB.fft2(data))))
         im[im == np.inf] = 0
         im[im == -np.inf] = 0
         return im
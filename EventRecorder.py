@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Event recording, for trapping events that are over before the operator can press record.
+
+While c_p['event_recording'] is on, the camera thread pushes every frame to the EventRecorder, which holds on to the
+frames of the last c_p['event_pre_trigger'] seconds. The frames are only referenced, not copied (a captured frame is
+never changed, see CameraInterface.capture_image). A trigger (File > Event recording > Trigger event, F9, trigger()
+or trigger_condition on the frames) writes the held frames and the frames of the following c_p['event_post_trigger']
+seconds to "<filename>_event<k>" in c_p['event_format'] ('raw', 'hdf5' or 'mkv'). A trigger during an event extends it.
+
+Writing runs on the EventRecorder thread, push never waits for the disk. The frames held before the trigger and the
+frames waiting to be written share the memory budget c_p['event_buffer_mb']. When it is used up the oldest pre-trigger
+frames are released first, then post-trigger frames are dropped (counted in the event info).
+The event info ("<filename>_event<k>_info.json") has the number of frames before and after the trigger, so the trigger
+frame is frame pre_trigger_frames of the file.
+"""
+
+import json
+from collections import deque
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import perf_counter
+
+import numpy as np
+
+from CameraControlsNew import get_writer_kwargs
+from VideoWriters import SEGMENT_WRITERS
+
+def frame_difference_trigger(threshold, step=4):
+    """
+    Trigger condition firing when the mean absolute difference to the previous checked frame exceeds threshold
+    (in grey levels). The frames are subsampled by step to keep the check cheap at full frame rate.
+    """
+    previous = [None]
+
+    def condition(frame):
+        frame = np.asarray(frame[::step, ::step], dtype=np.float32)
+        last, previous[0] = previous[0], frame
+        if last is None or last.shape != frame.shape:
+            return False
+        return np.mean(np.abs(frame - last)) > threshold
+
+    return condition
+
+class EventRecorder(Thread):
+    """
+    Rolling RAM buffer of the latest frames, written to disk around triggers. See the module docstring.
+    """
+
+    def __init__(self, c_p):
+        Thread.__init__(self)
+        self.c_p = c_p
+        self.setDaemon(True)
+
+        self.lock = Lock()
+        self.frames = deque()  # (time, item) of the pre-trigger frames
+        self.nbytes = 0  # Bytes of all held frames, pre-trigger and waiting to be written
+        self.queue = Queue()  # Event info, then the frames of the event, then None, for the writer
+        self.event = None  # Info of the event being collected
+        self.post_trigger_end = None
+        self.n_events = 0
+        self.events = []  # Info of the written events
+
+        # Optional trigger on the frames, condition(frame) -> bool, checked every condition_interval frames.
+        self.trigger_condition = None
+        self.condition_interval = 10
+        self.count = 0
+
+    def push(self, frame, timestamp=None, frame_id=None, camera_id=0):
+        """
+        Adds a frame, called by the camera thread. Only takes the lock, never waits for the disk.
+        """
+        self.count += 1
+        if self.trigger_condition is not None and self.count % self.condition_interval == 0:
+            if self.trigger_condition(frame):
+                self.trigger()
+
+        now = perf_counter()
+        item = (frame, timestamp, frame_id, camera_id)
+        max_bytes = self.c_p['event_buffer_mb'] * 1024**2
+        with self.lock:
+            if self.event is not None and now > self.post_trigger_end:
+                self.end_event()
+
+            if self.event is not None:
+                if self.nbytes + frame.nbytes > max_bytes:
+                    self.event['dropped'] += 1
+                    return
+                self.nbytes += frame.nbytes
+                self.event['post_trigger_frames'] += 1
+                self.queue.put(item)
+                return
+
+            self.frames.append((now, item))
+            self.nbytes += frame.nbytes
+            while len(self.frames) > 0 and (now - self.frames[0][0] > self.c_p['event_pre_trigger'] or self.nbytes > max_bytes):
+                self.nbytes -= self.frames.popleft()[1][0].nbytes
+
+    def trigger(self):
+        """
+        Starts an event with the held frames, or extends the running one. Can be called from any thread.
+        """
+        now = perf_counter()
+        with self.lock:
+            self.post_trigger_end = now + self.c_p['event_post_trigger']
+            if self.event is not None:
+                return
+
+            event = {
+                'path': f"{self.c_p['recording_path']}/{self.c_p['filename']}_event{self.n_events}",
+                'format': self.c_p['event_format'],
+                'pre_trigger_frames': len(self.frames),
+                'post_trigger_frames': 0,
+                'dropped': 0,
+                'pre_trigger_time': now - self.frames[0][0] if len(self.frames) > 0 else 0,
+                }
+            self.event = event
+            self.n_events += 1
+            self.queue.put(event)
+            # The held frames now belong to the event, their bytes are released as they are written.
+            for _, item in self.frames:
+                self.queue.put(item)
+            self.frames.clear()
+        print(f"Event triggered, writing {event['pre_trigger_frames']} frames from before the trigger")
+
+    def end_event(self):
+        # Called with the lock held
+        self.queue.put(None)
+        self.event = None
+
+    def clear(self):
+        """
+        Releases the pre-trigger frames and ends a running event, used when event recording is turned off.
+        """
+        with self.lock:
+            if self.event is not None:
+                self.end_event()
+            while len(self.frames) > 0:
+                self.nbytes -= self.frames.popleft()[1][0].nbytes
+
+    def stats(self):
+        with self.lock:
+            return {
+                'frames': len(self.frames),
+                'nbytes': self.nbytes,
+                'recording_event': self.event is not None,
+                'events': len(self.events),
+                }
+
+    def write_event_info(self, event, n_written):
+        info = {key: value for key, value in event.items() if key != 'path'}
+        info['frames_written'] = n_written
+        with open(event['path'] + '_info.json', 'w') as f:
+            json.dump(info, f, indent=2)
+        self.events.append(info)
+        print(f"Event written to {event['path']}, {n_written} frames, {event['dropped']} dropped")
+
+    def run(self):
+        event, writer, n_written = None, None, 0
+        while self.c_p['program_running']:
+            try:
+                item = self.queue.get(timeout=0.5)
+            except Empty:
+                # End an event when the camera stopped delivering frames during the post-trigger time.
+                with self.lock:
+                    if self.event is not None and perf_counter() > self.post_trigger_end:
+                        self.end_event()
+                continue
+
+            if isinstance(item, dict):
+                event, writer, n_written = item, None, 0
+            elif item is None:
+                if writer is not None:
+                    writer.close()
+                if event is not None:
+                    self.write_event_info(event, n_written)
+                event, writer = None, None
+            else:
+                frame = item[0]
+                try:
+                    if writer is None:
+                        extension, writer_class = SEGMENT_WRITERS[event['format']]
+                        writer = writer_class(event['path'] + extension, frame.shape, frame.dtype, fps=self.c_p['fps'],
+                                              **get_writer_kwargs(self.c_p, event['format'], frame.dtype))
+                    writer.write(*item)
+                    n_written += 1
+                except Exception as ex:
+                    # E.g. the AOI changed during the event, the frame is not written.
+                    if 'error' not in event:
+                        print(f"Could not write event frame, {ex}")
+                        event['error'] = str(ex)
+                    with self.lock:
+                        event['dropped'] += 1
+                with self.lock:
+                    self.nbytes -= frame.nbytes
+
+        # Program stopped during an event
+        if writer is not None:
+            writer.close()
+        if event is not None:
+            self.write_event_info(event, n_written)
@@ -18,15 +18,21 @@ from PyQt6.QtCore import QTimer
 
 from Utils import phase_utils as P
 from Utils import Utils_z as UZ
+from Utils import fft_backend as FB
+from Utils.reconstruction_plan import plan_cache, get_plan, get_plan_path
 
 class FieldAnalytics(QMainWindow):
     def __init__(self, c_p):
         super().__init__()
         self.setWindowTitle("Field Analytics")
         self.setGeometry(100, 100, 800, 800)
+        self.c_p = c_p
         self.update_rate = 3
         self.z_prop = 0
         self.precalculated = False
+        self.refresh_plan = False
+        self.rfft_mode = False
+        self.downsize = False
         self.image_size = c_p['image'].shape
         self.cmap = pg.colormap.get('CET-L9')
 
@@ -102,12 +108,24 @@ class FieldAnalytics(QMainWindow):
         self.button2.clicked.connect(self.on_click2)
         layout.addWidget(self.button2)
 
+        #Add a button to toggle the rfft2 reconstruction
+        self.button3 = QPushButton("rfft")
+        self.button3.clicked.connect(self.on_click3)
+        layout.addWidget(self.button3)
+
+        #Add a button to toggle downsized fields (only the sideband is inverse transformed)
+        self.button4 = QPushButton("Downsize")
+        self.button4.clicked.connect(self.on_click4)
+        layout.addWidget(self.button4)
+
         #Make the button smaller horizontally
         self.textbox.setMaximumWidth(100)
         self.textbox2.setMaximumWidth(100)
         self.image_size_box.setMaximumWidth(100)
         self.button.setMaximumWidth(100)
         self.button2.setMaximumWidth(100)
+        self.button3.setMaximumWidth(100)
+        self.button4.setMaximumWidth(100)
         
 
     def update_data(self, new_data):
@@ -120,11 +138,12 @@ class FieldAnalytics(QMainWindow):
 
             new_data, background = self.imgtofield_simple(
                 new_data,
-                self.G,
-                self.polynomial,
+                self.background_fitter_downsized if self.downsize else self.background_fitter,
                 self.kx_add_ky,
                 z_prop = self.z_prop,
                 masks = self.masks,
+                sideband = self.sideband if self.rfft_mode else None,
+                downsize = self.downsize,
             )
 
             #Draw the images
@@ -141,14 +160,21 @@ class FieldAnalytics(QMainWindow):
     def predalculations(self, image):
         'Pre-calculations for the field reconstruction.'
 
-        X, Y, X_c, Y_c, position_matrix, G, polynomial, KX, KY, KX2_add_KY2, kx_add_ky, dist_peak, masks, phase_background, rad  = P.pre_calculations(
+        #Plans are saved next to the recordings and cached on shape, reused while the fourier peak matches. The "Precalculate" button forces a new one.
+        plan = get_plan(
         image, 
+        plan_path = get_plan_path(self.c_p['recording_path'], image.shape),
         filter_radius = [], 
         cropping = 0, 
         mask_radie = [], 
         case = 'ellipse', 
-        first_phase_background = 0,
-        mask_out = True)
+        mask_out = True,
+        matrix_free = True,
+        refresh = self.refresh_plan)
+        self.refresh_plan = False
+        print(f"Reconstruction plan cache: {plan_cache.stats()}")
+
+        X, Y, X_c, Y_c, position_matrix, G, polynomial, KX, KY, KX2_add_KY2, kx_add_ky, dist_peak, masks, phase_background, rad  = plan.as_tuple()
 
         self.X = X
         self.Y = Y
@@ -163,6 +189,9 @@ class FieldAnalytics(QMainWindow):
         self.kx_add_ky = kx_add_ky
         self.dist_peak = dist_peak
         self.masks = masks
+        self.background_fitter = plan.background_fitter
+        self.sideband = P.SidebandExtractor(masks[0], kx_add_ky)
+        self.background_fitter_downsized = P.MomentBackgroundFitter(self.sideband.downsized_shape)
 
         #Set precalculated to true
         self.precalculated = True
@@ -170,40 +199,50 @@ class FieldAnalytics(QMainWindow):
     def imgtofield_simple(
                 self,
                 img, 
-                G, 
-                polynomial, 
+                background_fitter, 
                 kx_add_ky,
                 z_prop = 0,
                 masks = [],
+                sideband = None,
+                downsize = False,
                 ):
         
         #Scale image by its mean
         img = np.array(img, dtype = np.float32) 
         
-        #Compute the 2-dimensional discrete Fourier Transform with offset image.
-        fftImage = np.fft.fft2(img * np.exp(1j*(kx_add_ky)))
+        if sideband is not None:
+            #Sideband from a real rfft2, no complex carrier needed.
+            E_field = sideband.get_field(img, downsize = downsize)
+        else:
+            #Compute the 2-dimensional discrete Fourier Transform with offset image.
+            fftImage = FB.fft2(img * np.exp(1j*(kx_add_ky)))
 
-        #shifted fourier image centered on peak values in x and y. 
-        fftImage = np.fft.fftshift(fftImage)
-        
-        #Shift the zero-frequency component to the center of the spectrum.
-        E_field = np.fft.ifft2(
-            np.fft.fftshift(fftImage * masks[0])
-        )
+            #shifted fourier image centered on peak values in x and y. 
+            fftImage = np.fft.fftshift(fftImage)
+            
+            #Shift the zero-frequency component to the center of the spectrum.
+            if downsize:
+                #Only the box of the sideband is inverse transformed, field at reduced resolution.
+                E_field = self.sideband.sideband_to_field(self.sideband.crop_spectrum(fftImage * masks[0]), downsize = True)
+            else:
+                E_field = FB.ifft2(
+                    np.fft.fftshift(fftImage * masks[0])
+                )
         phase_img  = np.angle(E_field)
         
         # Get the phase background from phase image.
-        phase_background = P.correct_phase_4order(phase_img, G, polynomial)
+        phase_background = background_fitter.correct_phase_4order(phase_img)
         E_field_corr = E_field * np.exp( -1j * phase_background)
         
-        #Focus the field
-        if np.abs(z_prop) > 0:  
+        #Focus the field. The propagator assumes the camera pixel size, so not for downsized fields.
+        if np.abs(z_prop) > 0 and not downsize:  
             E_field_corr = UZ.refocus_field_z(E_field_corr, z_prop, padding = 256)
             
         return E_field_corr, phase_background
 
     def on_click(self):
         self.precalculated = False
+        self.refresh_plan = True
         self.button.setStyleSheet("background-color: green")
 
     def on_click2(self):
@@ -214,6 +253,20 @@ class FieldAnalytics(QMainWindow):
             self.cmap = pg.colormap.get('CET-L9')
             self.button2.setStyleSheet("background-color: gray")
 
+    def on_click3(self):
+        self.rfft_mode = not self.rfft_mode
+        if self.rfft_mode:
+            self.button3.setStyleSheet("background-color: green")
+        else:
+            self.button3.setStyleSheet("background-color: gray")
+
+    def on_click4(self):
+        self.downsize = not self.downsize
+        if self.downsize:
+            self.button4.setStyleSheet("background-color: green")
+        else:
+            self.button4.setStyleSheet("background-color: gray")
+
     def on_text_changed(self):
         update_rate = float(self.textbox.text()) if self.textbox.text() != '' else 0
         if update_rate > 0 and update_rate < 100:
@@ -17,6 +17,8 @@ from PyQt6.QtGui import QAction
 
 from Utils import phase_utils as P
 from Utils import Utils_z as UZ
+from Utils import fft_backend as FB
+from Utils.reconstruction_plan import get_plan, get_plan_path
 
 class FieldAnalyticsZ(QMainWindow):
     def __init__(self, c_p):
@@ -26,8 +28,9 @@ class FieldAnalyticsZ(QMainWindow):
         print('Calculating field...')
         self.c_p = c_p
         self.image_size = c_p['image'].shape
+        self.rfft_mode = False
         self.get_field(self.c_p['image'][:self.image_size[0], :self.image_size[1]])
-        self.field = np.fft.fft2(self.field)
+        self.field = FB.fft2(self.field)
         print('Field calculated')
 
         self.z = 0
@@ -94,6 +97,12 @@ class FieldAnalyticsZ(QMainWindow):
         self.update_field_action.triggered.connect(self.update_field)
         self.toolbar.addAction(self.update_field_action)
 
+        #Toggle the rfft2 sideband extraction, used from the next "Update field"
+        self.rfft_action = QAction("rfft", self)
+        self.rfft_action.setCheckable(True)
+        self.rfft_action.toggled.connect(self.set_rfft_mode)
+        self.toolbar.addAction(self.rfft_action)
+
         #Add a button to toggle grayscale colormap
         self.button2 = QPushButton("Grayscale")
         self.button2.clicked.connect(self.on_click_cmap)
@@ -132,9 +141,12 @@ class FieldAnalyticsZ(QMainWindow):
         
     def update_field(self):
         self.get_field(self.c_p['image'][:self.image_size[0], :self.image_size[1]])
-        self.field = np.fft.fft2(self.field)
+        self.field = FB.fft2(self.field)
         self.TZ = UZ.get_Tz(self.wavelength, self.zvals, np.shape(self.field), padding = 0)
 
+    def set_rfft_mode(self, checked):
+        self.rfft_mode = checked
+
     def set_wavelength(self):
         wavelength, ok = QInputDialog.getDouble(self, 'Set wavelength', 'Enter wavelength um:', decimals = 3)
 
@@ -149,7 +161,7 @@ class FieldAnalyticsZ(QMainWindow):
     def update_data(self):
 
         if self.field is not None:
-            curr_field = np.fft.ifft2(
+            curr_field = FB.ifft2(
                 self.field * self.TZ[np.argwhere(self.zvals==self.z)[0][0]]
                 ).T
             if self.padding > 0:
@@ -177,50 +189,55 @@ class FieldAnalyticsZ(QMainWindow):
     def imgtofield_simple(
                 self,
                 img, 
-                G, 
-                polynomial, 
+                background_fitter, 
                 kx_add_ky,
                 masks = [],
+                sideband = None,
                 ):
         
         #Scale image by its mean
         img = np.array(img, dtype = np.float32) 
         
-        #Compute the 2-dimensional discrete Fourier Transform with offset image.
-        fftImage = np.fft.fft2(img * np.exp(1j*(kx_add_ky)))
+        if sideband is not None:
+            #Sideband from a real rfft2, no complex carrier needed.
+            E_field = sideband.get_field(img)
+        else:
+            #Compute the 2-dimensional discrete Fourier Transform with offset image.
+            fftImage = FB.fft2(img * np.exp(1j*(kx_add_ky)))
 
-        #shifted fourier image centered on peak values in x and y. 
-        fftImage = np.fft.fftshift(fftImage)
-        
-        #Shift the zero-frequency component to the center of the spectrum.
-        E_field = np.fft.ifft2(
-            np.fft.fftshift(fftImage * masks[0])
-        )
+            #shifted fourier image centered on peak values in x and y. 
+            fftImage = np.fft.fftshift(fftImage)
+            
+            #Shift the zero-frequency component to the center of the spectrum.
+            E_field = FB.ifft2(
+                np.fft.fftshift(fftImage * masks[0])
+            )
         phase_img  = np.angle(E_field)
         
         # Get the phase background from phase image.
-        phase_background = P.correct_phase_4order(phase_img, G, polynomial)
+        phase_background = background_fitter.correct_phase_4order(phase_img)
         E_field_corr = E_field * np.exp( -1j * phase_background)
             
         return E_field_corr, phase_background
     
     def get_field(self, image):
          
-        _, _, _, _, _, G, polynomial, _, _, _, kx_add_ky, _, masks, _, _  = P.pre_calculations(
+        plan = get_plan(
         image, 
+        plan_path = get_plan_path(self.c_p['recording_path'], image.shape),
         filter_radius = [], 
         cropping = 0, 
         mask_radie = [], 
         case = 'ellipse', 
-        first_phase_background = 0,
-        mask_out = True)
+        mask_out = True,
+        matrix_free = True)
 
         self.field, _ = self.imgtofield_simple(
                 image, 
-                G, 
-                polynomial, 
-                kx_add_ky,
-                masks = masks,
+                plan.background_fitter, 
+                plan.kx_add_ky,
+                masks = plan.mask_list,
+                sideband = plan.get_sideband() if self.rfft_mode else None,
                 )
         
     def on_click_cmap(self):
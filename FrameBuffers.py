@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+"""
+Preallocated frame buffers shared between the camera thread and the consumers (display, subtraction mode, ...).
+
+RunningBackground keeps a background model of the frames in a FrameRing up to date as the frames are written,
+so subtraction mode costs the same for any buffer size.
+
+FrameQueue is the recording queue between the camera thread and the VideoWriterThread, bounded in bytes.
+"""
+
+from collections import deque
+from queue import Empty, Full
+from threading import Condition, Lock
+from time import perf_counter
+
+import numpy as np
+
+BACKGROUND_MODES = ('mean', 'ema', 'median')
+
+class RunningBackground:
+    """
+    Background model updated incrementally by the camera thread, get returns a float32 array ready to subtract.
+    Only attached to the ring while subtraction mode is on (FrameRing.set_background).
+
+    Modes:
+        'mean'   : Mean of the frames in the ring. A running sum (float64, exact for integer frames) where the frames
+                   are added when written and removed when their slot is overwritten. The mean is only calculated in get.
+        'ema'    : Exponential moving average, background += alpha * (frame - background).
+        'median' : Approximate running median, background += step * sign(frame - background).
+    Every update is a constant number of passes over one frame, independent of the buffer size.
+    """
+
+    def __init__(self, mode = 'mean', alpha = 0.05, step = 1.0):
+        if mode not in BACKGROUND_MODES:
+            raise ValueError(f"Unknown background mode {mode}, choose from {BACKGROUND_MODES}")
+        self.mode = mode
+        self.alpha = alpha
+        self.step = step
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.sum = None
+        self.background = None
+        self.tmp = None
+        self.count = 0
+
+    def _allocate(self, shape):
+        if self.mode == 'mean':
+            self.sum = np.zeros(shape, dtype = np.float64)
+        else:
+            self.background = np.zeros(shape, dtype = np.float32)
+            self.tmp = np.zeros(shape, dtype = np.float32)
+        self.count = 0
+
+    @property
+    def shape(self):
+        model = self.sum if self.mode == 'mean' else self.background
+        return None if model is None else model.shape
+
+    def add(self, frame):
+        with self.lock:
+            if self.shape != frame.shape:
+                self._allocate(frame.shape)
+
+            if self.mode == 'mean':
+                self.sum += frame
+                self.count += 1
+            elif self.count == 0:
+                self.background[...] = frame
+                self.count = 1
+            else:
+                np.subtract(frame, self.background, out = self.tmp, casting = 'unsafe')
+                if self.mode == 'ema':
+                    self.tmp *= self.alpha
+                else:
+                    np.sign(self.tmp, out = self.tmp)
+                    self.tmp *= self.step
+                self.background += self.tmp
+                self.count += 1
+
+    def remove(self, frame):
+        """
+        Removes a frame that leaves the ring, only the mean depends on it.
+        """
+        if self.mode != 'mean' or self.count == 0 or self.sum.shape != frame.shape:
+            return
+        with self.lock:
+            self.sum -= frame
+            self.count -= 1
+
+    def get(self):
+        """
+        Copy of the current background, None before the first frame.
+        """
+        with self.lock:
+            if self.count == 0:
+                return None
+            if self.mode == 'mean':
+                return (self.sum / self.count).astype(np.float32)
+            return self.background.copy()
+
+class FrameRing:
+    """
+    Fixed-capacity ring of frames in one contiguous array of shape (capacity, H, W).
+
+    The camera thread writes the frames in place (push, or next_slot + commit), so nothing is allocated per frame.
+    Consumers get views of the slots. A view is valid until its slot is overwritten, i.e. for capacity-1 new frames,
+    copy the frame if it is kept longer than that.
+
+    The array is (re)allocated on the first frame and whenever the shape or dtype of the frames change (e.g. new AOI).
+    A frame that was being written while the ring was reset from another thread (reset, set_capacity) is dropped by commit.
+    """
+
+    def __init__(self, capacity = 5, shape = None, dtype = np.uint8, background = None):
+        self.lock = Lock()
+        self.new_frame = Condition(self.lock)  # Notified on every commit
+        self.background = background  # Optional RunningBackground, updated as the frames are written
+        self.evicted = False  # The frame in the current write slot has been removed from the background
+        self.capacity = max(int(capacity), 1)
+        self.frames = None
+        self.timestamps = np.zeros(self.capacity, dtype = np.float64)
+        self.frame_ids = np.full(self.capacity, -1, dtype = np.int64)
+        self.write_index = 0  # Slot of the next frame
+        self.count = 0  # Number of valid frames
+        self.frames_written = 0
+        self.pending = None  # Array of the slot handed out by next_slot, None after a reset
+        if shape is not None:
+            self.reset(shape, dtype)
+
+    @property
+    def shape(self):
+        return None if self.frames is None else self.frames.shape[1:]
+
+    @property
+    def dtype(self):
+        return None if self.frames is None else self.frames.dtype
+
+    def reset(self, shape = None, dtype = None, capacity = None):
+        """
+        Reallocates the ring and drops all frames. Keeps the current shape, dtype and capacity if not given.
+        """
+        with self.lock:
+            self._reset(shape, dtype, capacity)
+
+    def _reset(self, shape = None, dtype = None, capacity = None):
+        # Called with the lock held
+        shape = self.shape if shape is None else tuple(shape)
+        dtype = self.dtype if dtype is None else dtype
+        if capacity is not None:
+            self.capacity = max(int(capacity), 1)
+
+        self.frames = None if shape is None else np.zeros((self.capacity, *shape), dtype = dtype)
+        self.timestamps = np.zeros(self.capacity, dtype = np.float64)
+        self.frame_ids = np.full(self.capacity, -1, dtype = np.int64)
+        self.write_index = 0
+        self.count = 0
+        self.evicted = False
+        self.pending = None
+        if self.background is not None:
+            self.background.reset()
+
+    def set_background(self, background):
+        """
+        Sets (or with None removes) the background model, which is rebuilt from the frames already in the ring.
+        """
+        with self.lock:
+            if background is not None:
+                background.reset()
+                for i in range(self.count):
+                    background.add(self.frames[(self.write_index - self.count + i) % self.capacity])
+            self.background = background
+            self.evicted = False
+
+    def set_capacity(self, capacity):
+        with self.lock:
+            if max(int(capacity), 1) != self.capacity:
+                self._reset(capacity = capacity)
+
+    def next_slot(self, shape, dtype = np.uint8):
+        """
+        View of the slot the next frame is written to, for writing a frame in place. Call commit when done.
+        """
+        with self.lock:
+            if self.frames is None or self.shape != tuple(shape) or self.dtype != np.dtype(dtype):
+                self._reset(shape, dtype)
+
+            # The oldest frame is about to be overwritten.
+            if self.background is not None and self.count == self.capacity and not self.evicted:
+                self.background.remove(self.frames[self.write_index])
+                self.evicted = True
+            self.pending = self.frames
+            return self.frames[self.write_index]
+
+    def commit(self, timestamp = None, frame_id = None):
+        """
+        Marks the slot from next_slot as written and advances the write index.
+        Returns the slot index, or None if the ring was reset since next_slot (the frame went to the old array).
+        """
+        with self.lock:
+            if self.frames is None or self.pending is not self.frames:
+                return None
+            self.pending = None
+            i = self.write_index
+            if self.background is not None:
+                self.background.add(self.frames[i])
+            self.evicted = False
+            self.timestamps[i] = perf_counter() if timestamp is None else timestamp
+            self.frame_ids[i] = self.frames_written if frame_id is None else frame_id
+            self.write_index = (i + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            self.frames_written += 1
+            self.new_frame.notify_all()
+            return i
+
+    def push(self, frame, timestamp = None, frame_id = None):
+        """
+        Copies frame into the next slot. Returns the slot index (None if the ring was reset meanwhile, see commit).
+        """
+        frame = np.asarray(frame)
+        self.next_slot(frame.shape, frame.dtype)[...] = frame
+        return self.commit(timestamp, frame_id)
+
+    def latest_index(self):
+        return (self.write_index - 1) % self.capacity
+
+    def latest(self):
+        """
+        View of the newest frame, None if the ring is empty.
+        """
+        if self.count == 0:
+            return None
+        return self.frames[self.latest_index()]
+
+    def copy_latest(self, with_info = False):
+        """
+        Copy of the newest frame, safe to keep while the ring is written to.
+        With with_info (frame, timestamp, frame_id), taken together under the lock.
+        """
+        with self.lock:
+            if self.count == 0:
+                return None
+            i = self.latest_index()
+            if with_info:
+                return self.frames[i].copy(), self.timestamps[i], self.frame_ids[i]
+            return self.frames[i].copy()
+
+    def copy_since(self, frames_read):
+        """
+        Copies of the frames written after frames_read (an earlier frames_written), oldest first, with their timestamps
+        and frame IDs. Every frame a grab thread wrote can so be handed on, not only the newest one.
+
+        Output:
+            frames : List of (frame, timestamp, frame_id)
+            frames_written : Pass as frames_read in the next call.
+            overwritten : Number of new frames that were overwritten (or dropped by a reset) before they were read.
+        """
+        with self.lock:
+            n_new = self.frames_written - frames_read
+            n = min(n_new, self.count)
+            frames = []
+            for k in range(n, 0, -1):
+                i = (self.write_index - k) % self.capacity
+                frames.append((self.frames[i].copy(), self.timestamps[i], self.frame_ids[i]))
+            return frames, self.frames_written, n_new - n
+
+    def wait_for_frame(self, frames_written, timeout = None):
+        """
+        Waits until more than frames_written frames have been written (e.g. by a grab thread).
+        Returns False on timeout.
+        """
+        with self.lock:
+            return self.new_frame.wait_for(lambda: self.frames_written > frames_written, timeout)
+
+    def valid(self):
+        """
+        View of all valid slots (not in time order), e.g. for sums and means over the buffer.
+        """
+        if self.count == 0:
+            return None
+        return self.frames[:self.count]
+
+    def last(self, n):
+        """
+        The n newest frames, oldest first. A view if they are contiguous in the ring, otherwise a copy.
+        """
+        n = min(int(n), self.count)
+        if n == 0:
+            return None
+        first = (self.write_index - n) % self.capacity
+        if first + n <= self.capacity:
+            return self.frames[first:first + n]
+        return np.concatenate((self.frames[first:], self.frames[:self.write_index]))
+
+    def __len__(self):
+        return self.count
+
+class FramePairer:
+    """
+    Pairs the frames of two FrameRings (one per camera) on their hardware timestamps.
+
+    The cameras run on their own clocks, so the offset between them is estimated from the newest frames of the first
+    call and then follows the drift through the matched pairs. Frames closer than tolerance (in timestamp ticks, ns for
+    Basler cameras) after removing the offset are paired, frames that can no longer be paired are counted as orphaned.
+    For free-running cameras that are not triggered together the tolerance should be about half a frame period.
+    """
+
+    def __init__(self, tolerance = 1_000_000, drift_gain = 0.05):
+        self.tolerance = tolerance
+        self.drift_gain = drift_gain
+        self.reset()
+
+    def reset(self):
+        self.offset = None
+        self.seen = [0, 0]  # frames_written of the rings at the last call
+        self.pending = [[], []]  # Unpaired (timestamp, frame_id, slot) that can still get a partner
+        self.matched = 0
+        self.orphaned = 0
+        self.skew_sum = 0.0
+        self.skew_max = 0.0
+
+    def _entries(self, ring, k):
+        """
+        The still unpaired frames of ring k, oldest first: the pending ones that are not overwritten and the new ones.
+        """
+        with ring.lock:
+            entries = []
+            for timestamp, frame_id, slot in self.pending[k]:
+                if ring.frame_ids[slot] == frame_id:
+                    entries.append((timestamp, frame_id, slot))
+                else:
+                    self.orphaned += 1
+
+            n_new = ring.frames_written - self.seen[k]
+            if n_new > ring.capacity:
+                self.orphaned += n_new - ring.capacity
+                n_new = ring.capacity
+            for i in range(n_new, 0, -1):
+                slot = (ring.write_index - i) % ring.capacity
+                entries.append((ring.timestamps[slot], ring.frame_ids[slot], slot))
+
+            self.seen[k] = ring.frames_written
+        return entries
+
+    def pair(self, ring1, ring2):
+        """
+        Pairs the frames written since the last call.
+
+        Output:
+            pairs : List of (slot1, slot2) of the new pairs, oldest first.
+        """
+        a = self._entries(ring1, 0)
+        b = self._entries(ring2, 1)
+        if self.offset is None:
+            if len(a) == 0 or len(b) == 0:
+                self.pending = [a, b]
+                return []
+            self.offset = b[-1][0] - a[-1][0]
+
+        pairs = []
+        i = j = 0
+        while i < len(a) and j < len(b):
+            skew = (b[j][0] - self.offset) - a[i][0]
+            if abs(skew) <= self.tolerance:
+                pairs.append((a[i][2], b[j][2]))
+                self.matched += 1
+                self.skew_sum += abs(skew)
+                self.skew_max = max(self.skew_max, abs(skew))
+                self.offset += self.drift_gain * skew
+                i += 1
+                j += 1
+            elif skew > 0:
+                # b[j] is later than a[i], so no later frame of camera 2 can match a[i].
+                self.orphaned += 1
+                i += 1
+            else:
+                self.orphaned += 1
+                j += 1
+
+        self.pending = [a[i:], b[j:]]
+        return pairs
+
+    def stats(self):
+        return {
+            'matched': self.matched,
+            'orphaned': self.orphaned,
+            'mean_skew': float(self.skew_sum / self.matched) if self.matched > 0 else 0.0,
+            'max_skew': float(self.skew_max),
+            'offset': None if self.offset is None else float(self.offset),
+            }
+
+QUEUE_POLICIES = ('block', 'drop_newest', 'drop_oldest')
+RECORDER_COMMANDS = ('start', 'stop', 'rotate')
+
+class FrameQueue:
+    """
+    Queue of [frame, video_name, video_format] items for the recording, bounded by the bytes of the frames.
+
+    When the writer falls behind and the queue is full, put follows the policy:
+        'block'       : Wait until the writer has made room (the camera thread stalls, frames are lost in the camera).
+        'drop_newest' : Discard the new frame.
+        'drop_oldest' : Discard the oldest frames in the queue to make room.
+    Dropped frames are counted, so a recording with lost frames can be recognized.
+    Recorder commands (RECORDER_COMMANDS, put_command) are queued in order with the frames and never dropped,
+    so the writer starts, stops and rotates files exactly between the right frames.
+    Same put/get/empty/qsize interface as queue.Queue.
+    """
+
+    def __init__(self, max_bytes = 2 * 1024**3, policy = 'drop_newest'):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Unknown queue policy {policy}, choose from {QUEUE_POLICIES}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.items = deque()
+        self.nbytes = 0
+        self.dropped = 0
+        self.max_nbytes_used = 0
+        self.lock = Lock()
+        self.not_empty = Condition(self.lock)
+        self.not_full = Condition(self.lock)
+
+    @staticmethod
+    def get_nbytes(item):
+        return item[0].nbytes if isinstance(item[0], np.ndarray) else 0
+
+    def _fits(self, nbytes):
+        # A frame larger than the whole budget is accepted into an empty queue, otherwise it could never be recorded.
+        return self.nbytes + nbytes <= self.max_bytes or len(self.items) == 0
+
+    def put(self, item, block = True, timeout = None):
+        """
+        Adds item. Returns False if a frame was dropped because the queue was full.
+        Raises queue.Full if the policy is 'block' and there was no room within timeout.
+        """
+        nbytes = self.get_nbytes(item)
+        with self.lock:
+            dropped = False
+            if not self._fits(nbytes):
+                if self.policy == 'block':
+                    if not block or not self.not_full.wait_for(lambda: self._fits(nbytes), timeout):
+                        raise Full
+                elif self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return False
+                else:
+                    while not self._fits(nbytes) and self._drop_oldest_frame():
+                        dropped = True
+
+            self.items.append(item)
+            self.nbytes += nbytes
+            self.max_nbytes_used = max(self.max_nbytes_used, self.nbytes)
+            self.not_empty.notify()
+            return not dropped
+
+    def _drop_oldest_frame(self):
+        # Commands are skipped, there is rarely more than one in front of the oldest frame.
+        for i, item in enumerate(self.items):
+            if not isinstance(item, str):
+                del self.items[i]
+                self.nbytes -= self.get_nbytes(item)
+                self.dropped += 1
+                return True
+        return False
+
+    def put_command(self, command):
+        """
+        Queues a recorder command after the frames already in the queue, regardless of the policy and the budget.
+        """
+        if command not in RECORDER_COMMANDS:
+            raise ValueError(f"Unknown recorder command {command}, choose from {RECORDER_COMMANDS}")
+        with self.lock:
+            self.items.append(command)
+            self.not_empty.notify()
+
+    def get(self, block = True, timeout = None):
+        with self.lock:
+            if not self.items:
+                if not block or not self.not_empty.wait_for(lambda: len(self.items) > 0, timeout):
+                    raise Empty
+            item = self.items.popleft()
+            self.nbytes -= self.get_nbytes(item)
+            self.not_full.notify_all()
+            return item
+
+    def empty(self):
+        return len(self.items) == 0
+
+    def qsize(self):
+        return len(self.items)
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.not_full.notify_all()
+
+    def set_policy(self, policy):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Unknown queue policy {policy}, choose from {QUEUE_POLICIES}")
+        with self.lock:
+            self.policy = policy
+            self.not_full.notify_all()
+
+    def reset_stats(self):
+        with self.lock:
+            self.dropped = 0
+            self.max_nbytes_used = self.nbytes
+
+    def stats(self):
+        return {
+            'frames': len(self.items),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            'max_nbytes_used': self.max_nbytes_used,
+            'dropped': self.dropped,
+            'policy': self.policy,
+            }
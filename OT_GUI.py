@@ -5,6 +5,7 @@ Graphical User Interface for camera. This is the main file that should be run.
 //Fredrik
 """
 import sys, os
+import argparse
 import cv2 # Certain versions of this won't work
 
 from PyQt6.QtWidgets import (
@@ -13,7 +14,7 @@ from PyQt6.QtWidgets import (
     QToolBar, QFileDialog, QInputDialog
 )
 
-from PyQt6.QtCore import Qt, QThread, pyqtSignal, pyqtSlot
+from PyQt6.QtCore import Qt, QThread, QTimer, pyqtSignal, pyqtSlot
 from PyQt6.QtGui import QPixmap, QImage, QPainter, QColor, QAction, QDoubleValidator, QPen, QIntValidator
 
 from random import randint
@@ -24,12 +25,17 @@ import gc
 
 
 import BaslerCameras
+from ReplayCamera import ReplayCamera
 from CameraControlsNew import CameraThread, VideoWriterThread, CameraClicks
+from EventRecorder import EventRecorder
 from ControlParameters import default_c_p, get_data_dicitonary_new
+from FrameBuffers import BACKGROUND_MODES, QUEUE_POLICIES
+from VideoWriters import HDF5_CODECS, FFMPEG_CODECS, available_hdf5_codecs, is_format_available
 from SaveDataWidget import SaveDataWindow
 from DataAnalytics import DataAnalytics
 from FieldRecon import FieldAnalytics
 from FieldRecon_Z import FieldAnalyticsZ
+from Utils import fft_backend as FB
 
 class Worker(QThread):
     '''
@@ -55,9 +61,26 @@ class Worker(QThread):
         self.args = args
         self.kwargs = kwargs
         self.test_mode = test_mode
-        self.buffer = self.c_p['buffer']
+        self.frame_ring = self.c_p['frame_ring']
+        self.display_lut = None
+        self.display_lut_key = None
+
+    def get_display_lut(self):
+        "Lookup table from 16-bit frames to the 8-bit screen, with the offset and gain (in 8-bit units) included"
+        key = (self.c_p['bit_depth'], self.c_p['image_offset'], self.c_p['image_gain'])
+        if self.display_lut_key != key:
+            values = np.arange(2**16, dtype=np.float32) * (255 / (2**self.c_p['bit_depth'] - 1))
+            values = (values + self.c_p['image_offset']) * self.c_p['image_gain']
+            self.display_lut = np.uint8(np.clip(values, 0, 255))
+            self.display_lut_key = key
+        return self.display_lut
 
     def preprocess_image(self):
+        # Frames with more than 8 bits are only mapped to 8 bits for the screen.
+        if self.image.dtype == np.uint16:
+            self.image = self.get_display_lut()[self.image]
+            return
+
         # Check if offset and gain should be applied.
         if self.c_p['image_offset'] != 0:
             self.image += int(self.c_p['image_offset'])
@@ -71,9 +94,10 @@ class Worker(QThread):
 
     def subtraction_mode_image(self):
         "Subtracts the current image from the previous image in the buffer"
-        if self.c_p['SubtractionMode']:
+        if self.c_p['SubtractionMode'] and len(self.frame_ring) > 1 and self.frame_ring.background is not None:
             try:
-                self.image = self.buffer[-1].astype(np.float32) - np.mean(np.array(self.buffer).astype(np.float32)[:-1], axis=0)
+                #The background is kept up to date by the camera thread, so this does not depend on the buffer size.
+                self.image = self.frame_ring.latest() - self.frame_ring.background.get()
             except:
                 pass
 
@@ -175,7 +199,7 @@ class MainWindow(QMainWindow):
     Main window of the program. It contains the menu bar and the main widget.
     """
 
-    def __init__(self):
+    def __init__(self, replay=None, replay_fps=100):
         super(MainWindow, self).__init__()
 
         self.setWindowTitle("Main window")
@@ -184,11 +208,20 @@ class MainWindow(QMainWindow):
         self.video_idx = 0
         self.widgets = []
 
+        # The menu only changes the FFT backend later, apply the one in c_p now. Falls back to the current backend
+        # if it is not installed, so c_p (and the wisdom saved in __del__) matches the backend in use.
+        self.set_fft_backend(self.c_p['fft_backend'])
+        self.c_p['fft_backend'] = FB.get_backend()
+
         # Start camera threads
         self.CameraThread = None
         try:
             camera = None
-            camera = BaslerCameras.BaslerCamera()
+            if replay is not None:
+                #Replays recorded frames instead of using a camera, see ReplayCamera.py
+                camera = ReplayCamera(replay, fps=replay_fps)
+            else:
+                camera = BaslerCameras.BaslerCamera()
             
             if camera is not None:
                 self.CameraThread = CameraThread(self.c_p, camera)
@@ -210,6 +243,11 @@ class MainWindow(QMainWindow):
        
         self.VideoWriterThread = VideoWriterThread(2, 'video thread', self.c_p)
         self.VideoWriterThread.start()
+
+        # Holds the latest frames while event recording is on and writes them around triggers
+        self.EventRecorder = EventRecorder(self.c_p)
+        self.c_p['event_recorder'] = self.EventRecorder
+        self.EventRecorder.start()
         
         # Set up camera window. This is just how it looks once starting.
         H = int(1024/4)
@@ -237,8 +275,29 @@ class MainWindow(QMainWindow):
         self.create_filemenu()
         self.drop_down_window_menu()
         self.create_cameramenu()
+
+        # Status bar with the state of the recording queue
+        self.status_timer = QTimer()
+        self.status_timer.timeout.connect(self.update_status_bar)
+        self.status_timer.start(500)
         self.show()
 
+    def update_status_bar(self):
+        stats = self.c_p['frame_queue'].stats()
+        message = (f"Recording queue: {stats['frames']} frames, {stats['nbytes'] / 1024**2:.0f}/{stats['max_bytes'] / 1024**2:.0f} MB, "
+                   f"{stats['policy']}, dropped: {stats['dropped']} | Written: {self.c_p['frames_written']}")
+        if self.c_p['event_recording']:
+            event_stats = self.EventRecorder.stats()
+            message += (f" | Event buffer: {event_stats['frames']} frames, {event_stats['nbytes'] / 1024**2:.0f} MB"
+                        f"{', recording event' if event_stats['recording_event'] else ''}, events: {event_stats['events']}")
+        if self.c_p['writer_error'] is not None:
+            message += f" | Writer error: {self.c_p['writer_error']}"
+        if stats['dropped'] > 0 or self.c_p['writer_error'] is not None:
+            self.statusBar().setStyleSheet("color: red")
+        else:
+            self.statusBar().setStyleSheet("")
+        self.statusBar().showMessage(message)
+
     @pyqtSlot(QImage)
     def setImage(self, image):
         self.label.setPixmap(QPixmap.fromImage(image))
@@ -306,6 +365,33 @@ class MainWindow(QMainWindow):
             mode_action.triggered.connect(mode_command)
             burst_submenu.addAction(mode_action)
 
+        #Add a submenu for the bit depth of the frames
+        bit_depth_submenu = cemera_menu.addMenu("Bit depth")
+        for bit_depth in [8, 12]:
+            bit_depth_command = partial(self.set_bit_depth, bit_depth)
+            bit_depth_action = QAction(f"{bit_depth} bit", self)
+            bit_depth_action.setStatusTip(f"Set bit depth to {bit_depth}")
+            bit_depth_action.triggered.connect(bit_depth_command)
+            bit_depth_submenu.addAction(bit_depth_action)
+
+        #Add a submenu for the acquisition mode
+        grab_submenu = cemera_menu.addMenu("Grab mode")
+        for mode in ['Triggered', 'OneByOne', 'LatestImageOnly']:
+            mode_command = partial(self.set_grab_mode, mode)
+            mode_action = QAction(mode, self)
+            mode_action.setStatusTip(f"Set grab mode to {mode}")
+            mode_action.triggered.connect(mode_command)
+            grab_submenu.addAction(mode_action)
+
+        #Add a submenu for the background model of subtraction mode
+        background_submenu = cemera_menu.addMenu("Background mode")
+        for mode in BACKGROUND_MODES:
+            mode_command = partial(self.set_background_mode, mode)
+            mode_action = QAction(mode, self)
+            mode_action.setStatusTip(f"Set subtraction mode background to {mode}")
+            mode_action.triggered.connect(mode_command)
+            background_submenu.addAction(mode_action)
+
         # Create a submenu for setting exact region of interest
         AOI_submenu = cemera_menu.addMenu("Set AOI")
         AOI_command = partial(self.set_AOI)
@@ -329,15 +415,35 @@ class MainWindow(QMainWindow):
 
         # Create submenu for setting recording(video) format
         format_submenu = file_menu.addMenu("Recording format")
-        video_formats = ['avi','mp4','npy']
+        video_formats = ['avi','mp4','npy','raw','hdf5','mkv']
 
         for f in video_formats :
             format_command = partial(self.set_video_format, f)
             format_action = QAction(f, self)
             format_action.setStatusTip(f"Set recording format to {f}")
             format_action.triggered.connect(format_command)
+            # hdf5 needs h5py and mkv needs ffmpeg
+            format_action.setEnabled(is_format_available(f))
             format_submenu.addAction(format_action)
 
+        # Submenu for the compression of the hdf5 format
+        codec_submenu = file_menu.addMenu("HDF5 codec")
+        for codec in HDF5_CODECS:
+            codec_command = partial(self.set_hdf5_codec, codec)
+            codec_action = QAction(codec, self)
+            codec_action.setStatusTip(f"Compress hdf5 recordings with {codec}")
+            codec_action.triggered.connect(codec_command)
+            codec_submenu.addAction(codec_action)
+
+        # Submenu for the lossless codec of the mkv format
+        ffmpeg_codec_submenu = file_menu.addMenu("MKV codec")
+        for codec in FFMPEG_CODECS:
+            codec_command = partial(self.set_ffmpeg_codec, codec)
+            codec_action = QAction(codec, self)
+            codec_action.setStatusTip(f"Encode mkv recordings with {codec}")
+            codec_action.triggered.connect(codec_command)
+            ffmpeg_codec_submenu.addAction(codec_action)
+
         # Submenu for setting the image format
         image_format_submenu = file_menu.addMenu("Image format")
         image_formats = ['png','jpg','npy']
@@ -348,12 +454,62 @@ class MainWindow(QMainWindow):
             format_action.triggered.connect(format_command)
             image_format_submenu.addAction(format_action)
 
+        # Submenu for the recording queue, what to do when the writer falls behind
+        queue_submenu = file_menu.addMenu("Recording queue")
+        for policy in QUEUE_POLICIES:
+            policy_command = partial(self.set_queue_policy, policy)
+            policy_action = QAction(policy, self)
+            policy_action.setStatusTip(f"Set recording queue policy to {policy}")
+            policy_action.triggered.connect(policy_command)
+            queue_submenu.addAction(policy_action)
+        queue_size_action = QAction("Set queue size (MB)", self)
+        queue_size_action.setStatusTip("Set the memory budget of the recording queue")
+        queue_size_action.triggered.connect(self.set_queue_size)
+        queue_submenu.addAction(queue_size_action)
+        writer_threads_action = QAction("Set writer threads", self)
+        writer_threads_action.setStatusTip("Number of threads (and files) writing raw, hdf5 and mkv recordings")
+        writer_threads_action.triggered.connect(self.set_writer_threads)
+        queue_submenu.addAction(writer_threads_action)
+
         # Add command to set the savepath of the experiments.
         set_save_action = QAction("Set save path", self)
         set_save_action.setStatusTip("Set save path")
         set_save_action.triggered.connect(self.set_save_path)
         file_menu.addAction(set_save_action)
 
+        # Submenu for event recording, frames from before and after a trigger
+        event_submenu = file_menu.addMenu("Event recording")
+        self.event_recording_action = QAction("Event recording", self)
+        self.event_recording_action.setStatusTip("Hold the latest frames in memory so they can be written on a trigger")
+        self.event_recording_action.setCheckable(True)
+        self.event_recording_action.triggered.connect(self.toggle_event_recording)
+        event_submenu.addAction(self.event_recording_action)
+        trigger_action = QAction("Trigger event", self)
+        trigger_action.setStatusTip("Write the held frames and the frames after the trigger")
+        trigger_action.setShortcut('F9')
+        trigger_action.triggered.connect(self.trigger_event)
+        event_submenu.addAction(trigger_action)
+        event_time_action = QAction("Set pre/post-trigger time", self)
+        event_time_action.setStatusTip("Seconds written from before and after the trigger")
+        event_time_action.triggered.connect(self.set_event_times)
+        event_submenu.addAction(event_time_action)
+        event_buffer_action = QAction("Set event buffer (MB)", self)
+        event_buffer_action.setStatusTip("Memory budget of the held event frames")
+        event_buffer_action.triggered.connect(self.set_event_buffer_size)
+        event_submenu.addAction(event_buffer_action)
+        for f in ['raw', 'hdf5', 'mkv']:
+            format_command = partial(self.set_event_format, f)
+            format_action = QAction(f"Format {f}", self)
+            format_action.setStatusTip(f"Write events as {f}")
+            format_action.triggered.connect(format_command)
+            format_action.setEnabled(is_format_available(f))
+            event_submenu.addAction(format_action)
+
+        split_recording_action = QAction("Split recording", self)
+        split_recording_action.setStatusTip("Continue the recording in a new file")
+        split_recording_action.triggered.connect(self.split_recording)
+        file_menu.addAction(split_recording_action)
+
         set_filename_action = QAction("Set filename", self)
         set_filename_action.setStatusTip("Set filename for saved, data, video and image files")
         set_filename_action.triggered.connect(self.set_default_filename)
@@ -513,9 +669,55 @@ class MainWindow(QMainWindow):
         self.open_field_recon_window_z.setCheckable(False)
         window_menu.addAction(self.open_field_recon_window_z)
 
+        #Submenu for the FFT backend used by the field windows
+        fft_submenu = window_menu.addMenu("FFT backend")
+        for backend in FB.available_backends():
+            backend_command = partial(self.set_fft_backend, backend)
+            backend_action = QAction(backend, self)
+            backend_action.setStatusTip(f"Set FFT backend to {backend}")
+            backend_action.triggered.connect(backend_command)
+            fft_submenu.addAction(backend_action)
+
+    def set_fft_backend(self, backend):
+        try:
+            FB.set_backend(backend, wisdom_path=os.path.join(self.c_p['recording_path'], 'fftw_wisdom.pkl'))
+            self.c_p['fft_backend'] = backend
+            print(f"FFT backend set to {backend}")
+        except Exception as ex:
+            print(f"Could not set FFT backend {backend}, {ex}")
+
+    def set_queue_policy(self, policy):
+        self.c_p['frame_queue_policy'] = policy
+        self.c_p['frame_queue'].set_policy(policy)
+
+    def set_queue_size(self):
+        size, ok = QInputDialog.getInt(self, 'Queue size', 'Memory budget of the recording queue (MB):',
+                                       self.c_p['frame_queue_mb'], 1, 1_000_000)
+        if ok:
+            self.c_p['frame_queue_mb'] = size
+            self.c_p['frame_queue'].set_max_bytes(size * 1024**2)
+
+    def set_writer_threads(self):
+        threads, ok = QInputDialog.getInt(self, 'Writer threads', 'Writer threads for raw, hdf5 and mkv (takes effect on the next recording):',
+                                          self.c_p['writer_threads'], 1, 64)
+        if ok:
+            self.c_p['writer_threads'] = threads
+
     def set_video_format(self, video_format):
+        if not is_format_available(video_format):
+            print(f"Recording format {video_format} not available, hdf5 needs h5py and mkv needs ffmpeg")
+            return
         self.c_p['video_format'] = video_format
 
+    def set_hdf5_codec(self, codec):
+        if codec not in available_hdf5_codecs():
+            print(f"HDF5 codec {codec} not available, available: {available_hdf5_codecs()}")
+            return
+        self.c_p['hdf5_codec'] = codec
+
+    def set_ffmpeg_codec(self, codec):
+        self.c_p['ffmpeg_codec'] = codec
+
     def set_image_format(self, image_format):
         self.c_p['image_format'] = image_format
         
@@ -532,6 +734,21 @@ class MainWindow(QMainWindow):
         self.c_p['buffer_size'] = int(self.buffer_size_LineEdit.text())
         self.c_p['new_settings_camera'] = [True, 'buffer_size']
 
+    def set_bit_depth(self, bit_depth):
+        # Mono8 or Mono12 frames
+        self.c_p['bit_depth'] = bit_depth
+        self.c_p['new_settings_camera'] = [True, 'bit_depth']
+
+    def set_grab_mode(self, mode):
+        # Triggered or free-running acquisition
+        self.c_p['grab_mode'] = mode
+        self.c_p['new_settings_camera'] = [True, 'grab_mode']
+
+    def set_background_mode(self, mode):
+        # Background model used in subtraction mode
+        self.c_p['background_mode'] = mode
+        self.c_p['new_settings_camera'] = [True, 'background_mode']
+
     def set_camera_mode(self, mode):
         # Updates the camera mode to what is inside the textbox
         self.c_p['camera_mode'] = mode
@@ -571,6 +788,8 @@ class MainWindow(QMainWindow):
 
     def SubtractionMode(self):
         self.c_p['SubtractionMode'] = not self.c_p['SubtractionMode']
+        # Attaches (or detaches) the background model of the frame ring
+        self.c_p['new_settings_camera'] = [True, 'background_mode']
 
     def HighSpeedMode(self):
         self.c_p['HighSpeedMode'] = not self.c_p['HighSpeedMode']
@@ -580,18 +799,60 @@ class MainWindow(QMainWindow):
 
     def get_fps(self):
         self.frame_rate_label.setText("Frame rate: %d\n" % self.c_p['fps'])
+        if self.c_p['grab_stats'] is not None:
+            print(f"Grab stats: {self.c_p['grab_stats']}")
+
+    def toggle_event_recording(self):
+        self.c_p['event_recording'] = not self.c_p['event_recording']
+        if not self.c_p['event_recording']:
+            self.EventRecorder.clear()
+        self.event_recording_action.setChecked(self.c_p['event_recording'])
+
+    def trigger_event(self):
+        if not self.c_p['event_recording']:
+            print("Event recording is off, turn it on in File > Event recording")
+            return
+        self.EventRecorder.trigger()
+
+    def set_event_times(self):
+        pre, ok = QInputDialog.getDouble(self, 'Pre-trigger time', 'Seconds written from before the trigger:',
+                                         self.c_p['event_pre_trigger'], 0, 600, 2)
+        if not ok:
+            return
+        post, ok = QInputDialog.getDouble(self, 'Post-trigger time', 'Seconds written after the trigger:',
+                                          self.c_p['event_post_trigger'], 0, 3600, 2)
+        if ok:
+            self.c_p['event_pre_trigger'] = pre
+            self.c_p['event_post_trigger'] = post
+
+    def set_event_buffer_size(self):
+        size, ok = QInputDialog.getInt(self, 'Event buffer', 'Memory budget of the held event frames (MB):',
+                                       self.c_p['event_buffer_mb'], 1, 1_000_000)
+        if ok:
+            self.c_p['event_buffer_mb'] = size
+
+    def set_event_format(self, video_format):
+        if not is_format_available(video_format):
+            print(f"Event format {video_format} not available, hdf5 needs h5py and mkv needs ffmpeg")
+            return
+        self.c_p['event_format'] = video_format
 
     def ToggleRecording(self):
         # Turns on/off recording
         # Need to add somehting to indicate the number of frames left to save when recording.
         self.c_p['recording'] = not self.c_p['recording']
         if self.c_p['recording']:
+            self.c_p['frame_queue'].reset_stats()
             self.c_p['video_name'] = self.c_p['filename'] + '_video' + str(self.video_idx)
             self.video_idx += 1
             self.record_action.setToolTip("Turn OFF recording.")
         else:
             self.record_action.setToolTip("Turn ON recording.")
 
+    def split_recording(self):
+        if self.c_p['recording']:
+            self.c_p['rotate_recording'] = True
+
     def snapshot(self):
         # Captures a snapshot of what the camera is viewing and saves that
         idx = str(self.c_p['image_idx'])
@@ -692,6 +953,9 @@ class MainWindow(QMainWindow):
  
     def __del__(self):
         self.c_p['program_running'] = False
+        #Keep the FFTW plans measured this session
+        if self.c_p['fft_backend'] == 'pyfftw':
+            FB.save_wisdom()
         # TODO organize this better
         if self.CameraThread is not None:
             self.CameraThread.join()
@@ -789,7 +1053,7 @@ def create_camera_toolbar_external(main_window):
     
     main_window.buffer_size_LineEdit = QLineEdit()
     main_window.buffer_size_LineEdit.setFixedWidth(60)
-    main_window.buffer_size_LineEdit.setValidator(QIntValidator(1,100))
+    main_window.buffer_size_LineEdit.setValidator(QIntValidator(1,1000))
     main_window.buffer_size_LineEdit.setText(str(main_window.c_p['buffer_size']))
     main_window.camera_toolbar.addAction(main_window.set_buffer_size)
     main_window.camera_toolbar.addWidget(main_window.buffer_size_LineEdit)
@@ -807,8 +1071,13 @@ def create_camera_toolbar_external(main_window):
     main_window.camera_toolbar_sec.addWidget(main_window.frame_rate_label)
 
 if __name__ == '__main__':
-    app = QApplication(sys.argv)
-    w = MainWindow()
+    parser = argparse.ArgumentParser(description="Camera GUI")
+    parser.add_argument('--replay', default=None, help="Replay a folder of images, folder of .npy chunks or video instead of using a camera")
+    parser.add_argument('--replay-fps', type=float, default=100, help="Frame rate of the replay, 0 for as fast as possible")
+    args, qt_args = parser.parse_known_args()
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    w = MainWindow(replay=args.replay, replay_fps=args.replay_fps)
     w.show()
     app.exec()
     w.c_p['program_running'] = False
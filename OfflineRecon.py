@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Offline reconstruction of recorded holography videos (.avi/.mp4 or a folder of .npy chunks) to optical fields.
+
+Frames are streamed from disk in batches and reconstructed by a pool of worker processes. The plan (sideband box,
+carrier shift, masks) is calculated once from the first frame and shared with the workers through shared memory.
+Each worker writes its fields straight into the output .npy (memory-mapped) at the index of the frames, so the
+fields end up in order and videos larger than RAM can be processed.
+
+Example:
+    python OfflineRecon.py "../Example data/Video.avi" fields.npy --workers 8 --batch-size 16 --downsize
+"""
+
+import argparse
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from time import perf_counter
+
+import numpy as np
+
+from Utils import phase_utils as P
+from Utils import fft_backend as FB
+from Utils.reconstruction_plan import get_plan
+from Utils_pytorch.read_video import count_frames, iter_video_frames
+
+# State of a worker process, set by init_worker.
+_worker = {}
+
+class SharedArrays:
+    """
+    Copies a dict of arrays to shared memory. spec is picklable and is used by attach in the worker processes.
+    """
+
+    def __init__(self, arrays):
+        self.blocks = []
+        self.spec = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+            self.blocks.append(shm)
+            self.spec[name] = (shm.name, array.shape, array.dtype.str)
+
+    @staticmethod
+    def attach(spec):
+        """
+        Returns the arrays (read-only views of the shared memory) and the blocks, which must be kept alive.
+        """
+        arrays, blocks = {}, []
+        for name, (shm_name, shape, dtype) in spec.items():
+            shm = shared_memory.SharedMemory(name=shm_name)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            array.flags.writeable = False
+            arrays[name] = array
+            blocks.append(shm)
+        return arrays, blocks
+
+    def close(self):
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+        self.blocks = []
+
+def init_worker(spec, output_path, downsize, fft_backend):
+    """
+    Attaches the shared plan and the output file in a worker process.
+    """
+    arrays, blocks = SharedArrays.attach(spec)
+
+    # The processes already run in parallel, one FFT thread each.
+    FB.set_backend(fft_backend, workers=1)
+
+    sideband = P.SidebandExtractor(arrays['mask'], arrays['kx_add_ky'])
+    shape = sideband.downsized_shape if downsize else sideband.shape
+
+    _worker['blocks'] = blocks
+    _worker['sideband'] = sideband
+    _worker['background_fitter'] = P.MomentBackgroundFitter(shape)
+    _worker['downsize'] = downsize
+    _worker['output'] = np.load(output_path, mmap_mode='r+')
+
+def reconstruct_frames(start, frames):
+    """
+    Reconstructs frames and writes the fields to output[start:start+len(frames)]. Runs in a worker process.
+    """
+    sideband = _worker['sideband']
+    background_fitter = _worker['background_fitter']
+    output = _worker['output']
+
+    for i, frame in enumerate(frames):
+        E_field = sideband.get_field(np.asarray(frame, dtype=np.float32), downsize=_worker['downsize'])
+        phase_background = background_fitter.correct_phase_4order(np.angle(E_field))
+        output[start + i] = E_field * np.exp(-1j * phase_background)
+
+    output.flush()
+    return len(frames)
+
+def reconstruct_video(
+        filename,
+        output_path,
+        start=0,
+        stop=None,
+        step=1,
+        workers=None,
+        batch_size=16,
+        max_in_flight=None,
+        downsize=False,
+        case='ellipse',
+        mask_out=True,
+        plan_path=None,
+        fft_backend='numpy'
+        ):
+    """
+    Reconstructs all frames of a recording and saves the fields (complex64, shape (N, H, W)) to output_path.
+
+    Input:
+        filename : Video file or folder of .npy chunks.
+        output_path : .npy file for the fields.
+        start, stop, step : Frames to reconstruct, see iter_video_frames.
+        workers : Number of worker processes, default all cores.
+        batch_size : Frames per task.
+        max_in_flight : Maximum number of tasks submitted but not finished, bounds the memory used. Default 2*workers.
+        downsize : Reconstruct the fields at the reduced resolution of the sideband (see SidebandExtractor).
+        case, mask_out : See pre_calculations.
+        plan_path : Saved plan to use/create (see reconstruction_plan.get_plan).
+        fft_backend : FFT backend of the workers (see Utils/fft_backend.py).
+    Output:
+        n_frames : Number of reconstructed frames.
+    """
+    workers = workers if workers is not None else (os.cpu_count() or 1)
+    max_in_flight = max_in_flight if max_in_flight is not None else 2 * workers
+
+    total = count_frames(filename)
+    n_frames = len(range(start, total if stop is None else min(stop, total), step))
+    batches = iter_video_frames(filename, start=start, stop=stop, step=step, batch_size=batch_size)
+    first_batch = next(batches, None)
+    if first_batch is None:
+        print(f"No frames found in {filename}")
+        return 0
+
+    # The plan is calculated once, from the first frame.
+    plan = get_plan(first_batch[0], plan_path=plan_path, case=case, mask_out=mask_out, matrix_free=True)
+    shared = SharedArrays({'mask': plan.mask_list[0], 'kx_add_ky': plan.kx_add_ky})
+    shape = plan.get_sideband().downsized_shape if downsize else first_batch.shape[1:]
+
+    output = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.complex64, shape=(n_frames, *shape))
+    del output
+
+    print(f"Reconstructing {n_frames} frames of {filename} with {workers} workers, fields of shape {tuple(shape)}.")
+    t_start = perf_counter()
+    done = 0
+    start = 0
+    in_flight = deque()
+
+    try:
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_worker,
+                initargs=(shared.spec, output_path, downsize, fft_backend)
+                ) as executor:
+
+            batch = first_batch
+            while batch is not None:
+                # The frame count of videos can be too low, the rest is skipped.
+                batch = batch[:max(n_frames - start, 0)]
+                if len(batch) == 0:
+                    print(f"More frames than the {n_frames} expected, the rest are skipped.")
+                    break
+
+                in_flight.append(executor.submit(reconstruct_frames, start, batch))
+                start += len(batch)
+
+                # Wait for the oldest task so at most max_in_flight batches are in memory.
+                while len(in_flight) >= max_in_flight:
+                    done += in_flight.popleft().result()
+
+                batch = next(batches, None)
+
+            while in_flight:
+                done += in_flight.popleft().result()
+
+    finally:
+        shared.close()
+
+    if done < n_frames:
+        print(f"Only {done} of {n_frames} frames could be read, the remaining fields are zero.")
+
+    elapsed = perf_counter() - t_start
+    print(f"Reconstructed {done} frames in {elapsed:.1f} s ({done / max(elapsed, 1e-9):.1f} frames/s), saved to {output_path}")
+    return done
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconstruct the fields of a recorded holography video.")
+    parser.add_argument('filename', help="Video file (.avi/.mp4) or folder of .npy chunks")
+    parser.add_argument('output', help="Output .npy file for the fields")
+    parser.add_argument('--start', type=int, default=0, help="First frame")
+    parser.add_argument('--stop', type=int, default=None, help="Frame to stop before (default the end)")
+    parser.add_argument('--step', type=int, default=1, help="Reconstruct every step-th frame")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default all cores)")
+    parser.add_argument('--batch-size', type=int, default=16, help="Frames per task")
+    parser.add_argument('--max-in-flight', type=int, default=None, help="Maximum number of unfinished tasks (default 2*workers)")
+    parser.add_argument('--downsize', action='store_true', help="Reconstruct at the reduced resolution of the sideband")
+    parser.add_argument('--case', default='ellipse', choices=['ellipse', 'circular'], help="Mask case")
+    parser.add_argument('--no-mask-out', action='store_true', help="Do not mask out disturbing peaks in the fourier space")
+    parser.add_argument('--plan', default=None, help="Saved reconstruction plan (.npz) to use or create")
+    parser.add_argument('--fft-backend', default='numpy', choices=FB.BACKENDS, help="FFT backend of the workers")
+    args = parser.parse_args()
+
+    reconstruct_video(
+        args.filename,
+        args.output,
+        start=args.start,
+        stop=args.stop,
+        step=args.step,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        max_in_flight=args.max_in_flight,
+        downsize=args.downsize,
+        case=args.case,
+        mask_out=not args.no_mask_out,
+        plan_path=args.plan,
+        fft_backend=args.fft_backend
+        )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the recording chain, CameraThread -> frame_queue -> VideoWriterThread -> disk.
+
+A synthetic camera delivers holograms of the given size at the target rate, the chain records for a while in each
+video format and the following is measured:
+    - sustained capture and write rates (fps),
+    - queue depth over time and the time to drain the queue after the recording is stopped,
+    - dropped frames (frames the camera should have delivered at the target rate but were not recorded) and
+      the frames dropped by the recording queue,
+    - CPU usage of the process (all threads) and bytes/s written to disk.
+The results are printed and saved as JSON so regressions can be tracked.
+
+Example:
+    python RecordingBenchmark.py --width 1920 --height 1280 --fps 500 --duration 10 --formats avi npy --output bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+from time import perf_counter, process_time, sleep, strftime
+
+import numpy as np
+
+from CameraControlsNew import CameraThread, VideoWriterThread
+from ControlParameters import default_c_p
+from FrameBuffers import QUEUE_POLICIES
+from ReplayCamera import ReplayCamera
+
+VIDEO_FORMATS = ('avi', 'mp4', 'npy', 'raw', 'hdf5', 'mkv')
+
+class SyntheticCamera(ReplayCamera):
+    """
+    ReplayCamera with generated off-axis holograms (fringes, a few moving particles and noise) instead of a recording.
+    """
+
+    def __init__(self, width, height, fps, n_frames=50, bit_depth=8):
+        super().__init__(None, fps=fps)
+        self.width = width
+        self.height = height
+        self.n_frames = n_frames
+        self.bit_depth = bit_depth
+
+    def load_frames(self):
+        rng = np.random.default_rng(0)
+        y, x = np.mgrid[:self.height, :self.width].astype(np.float32)
+        max_value = 2**self.bit_depth - 1
+
+        frames = np.zeros((self.n_frames, self.height, self.width), dtype=np.uint16 if self.bit_depth > 8 else np.uint8)
+        for i in range(self.n_frames):
+            phase = np.zeros_like(x)
+            for k in range(3):
+                px = (0.2 + 0.3 * k) * self.width + 2 * i
+                py = (0.3 + 0.2 * k) * self.height
+                phase += np.exp(-((x - px)**2 + (y - py)**2) / 200)
+            frame = 0.5 + 0.3 * np.cos(2 * np.pi * (x / 6 + y / 9) + phase) + 0.02 * rng.standard_normal(x.shape)
+            frames[i] = np.clip(frame * max_value, 0, max_value)
+
+        self.frames = frames
+        self.frames.flags.writeable = False
+
+def get_dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return size
+
+def run_benchmark(video_format, width, height, fps, duration, bit_depth=8, sample_interval=0.1, drain_timeout=60,
+                  queue_mb=2048, queue_policy='drop_newest', writer_threads=1):
+    """
+    Records duration seconds in video_format and returns the measurements as a dict.
+    """
+    recording_path = tempfile.mkdtemp(prefix=f"recording_benchmark_{video_format}_")
+
+    c_p = default_c_p()
+    c_p['recording_path'] = recording_path
+    c_p['video_format'] = video_format
+    c_p['video_name'] = 'benchmark'
+    c_p['bit_depth'] = bit_depth
+    c_p['image'] = np.zeros((height, width), dtype=np.uint8)
+    c_p['fps'] = fps if fps else 200  # Frame rate of the avi/mp4 files
+    c_p['frame_queue'].set_max_bytes(queue_mb * 1024**2)
+    c_p['frame_queue'].set_policy(queue_policy)
+    c_p['writer_threads'] = writer_threads
+
+    camera = SyntheticCamera(width, height, fps, bit_depth=bit_depth)
+    camera_thread = CameraThread(c_p, camera)
+    writer_thread = VideoWriterThread(2, 'video thread', c_p)
+    camera_thread.start()
+    writer_thread.start()
+
+    result = {'format': video_format, 'width': width, 'height': height, 'target_fps': fps, 'bit_depth': bit_depth,
+              'queue_mb': queue_mb, 'queue_policy': queue_policy, 'writer_threads': writer_threads}
+    try:
+        # Let the threads start and the AOI settle before recording.
+        sleep(0.5)
+        c_p['recording'] = True
+        cpu_start = process_time()
+        t_start = perf_counter()
+
+        queue_depth = []
+        while perf_counter() - t_start < duration:
+            sleep(sample_interval)
+            if c_p['writer_error'] is not None:
+                raise RuntimeError(f"VideoWriterThread could not record, {c_p['writer_error']}")
+            queue_depth.append((round(perf_counter() - t_start, 3), c_p['frame_queue'].qsize(), c_p['frames_written']))
+
+        c_p['recording'] = False
+        record_time = perf_counter() - t_start
+        frames_written_at_stop = c_p['frames_written']
+
+        # Wait for the writer to empty the queue and close the file.
+        t_stop = perf_counter()
+        while (not c_p['frame_queue'].empty() or c_p['saving_video']) and perf_counter() - t_stop < drain_timeout:
+            if not writer_thread.is_alive():
+                raise RuntimeError("VideoWriterThread stopped while recording")
+            sleep(0.01)
+        drain_time = perf_counter() - t_stop
+        queued = c_p['frames_written'] + c_p['frame_queue'].qsize()
+        total_time = perf_counter() - t_start
+        cpu_time = process_time() - cpu_start
+
+        bytes_written = get_dir_size(recording_path)
+        expected = int(fps * record_time) if fps else queued
+        result.update(
+            record_time=round(record_time, 3),
+            frames_recorded=queued,
+            frames_written=c_p['frames_written'],
+            capture_fps=round(queued / record_time, 1),
+            write_fps=round(frames_written_at_stop / record_time, 1),
+            dropped_frames=max(expected - queued, 0),
+            queue_dropped=c_p['frame_queue'].dropped,
+            max_queue_mb=round(c_p['frame_queue'].max_nbytes_used / 1024**2, 1),
+            max_queue_depth=max((q for _, q, _ in queue_depth), default=0),
+            queue_depth=queue_depth,
+            drain_time=round(drain_time, 3),
+            cpu_percent=round(100 * cpu_time / total_time, 1),
+            bytes_written=bytes_written,
+            bytes_per_s=round(bytes_written / total_time),
+            )
+    except Exception as ex:
+        result['error'] = str(ex)
+        print(f"Benchmark of {video_format} failed, {ex}")
+    finally:
+        c_p['recording'] = False
+        c_p['program_running'] = False
+        camera_thread.join(timeout=5)
+        writer_thread.join(timeout=5)
+        shutil.rmtree(recording_path, ignore_errors=True)
+
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the recording chain.")
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1280)
+    parser.add_argument('--fps', type=float, default=200, help="Target frame rate of the synthetic camera, 0 for as fast as possible")
+    parser.add_argument('--duration', type=float, default=5, help="Recording time per format (s)")
+    parser.add_argument('--bit-depth', type=int, default=8, choices=[8, 12])
+    parser.add_argument('--formats', nargs='+', default=list(VIDEO_FORMATS), choices=VIDEO_FORMATS)
+    parser.add_argument('--queue-mb', type=int, default=2048, help="Memory budget of the recording queue")
+    parser.add_argument('--queue-policy', default='drop_newest', choices=QUEUE_POLICIES)
+    parser.add_argument('--writer-threads', type=int, default=1, help="Writer threads for raw, hdf5 and mkv (segmented recording)")
+    parser.add_argument('--output', default=None, help="JSON file for the results")
+    args = parser.parse_args()
+
+    results = {
+        'date': strftime('%Y-%m-%d %H:%M:%S'),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'runs': [],
+        }
+    for video_format in args.formats:
+        print(f"Benchmarking {video_format}, {args.width}x{args.height} at {args.fps} fps for {args.duration} s")
+        run = run_benchmark(video_format, args.width, args.height, args.fps, args.duration, args.bit_depth,
+                            queue_mb=args.queue_mb, queue_policy=args.queue_policy, writer_threads=args.writer_threads)
+        results['runs'].append(run)
+        if 'error' not in run:
+            print(f"  capture {run['capture_fps']} fps, write {run['write_fps']} fps, dropped {run['dropped_frames']} "
+                  f"({run['queue_dropped']} in the queue), "
+                  f"max queue {run['max_queue_depth']}, drain {run['drain_time']} s, CPU {run['cpu_percent']} %, "
+                  f"{run['bytes_per_s'] / 1e6:.1f} MB/s")
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+    else:
+        print(json.dumps(results))
+
+    return results
+
+if __name__ == '__main__':
+    main()
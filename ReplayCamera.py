@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Camera that replays recorded holograms, for development and load testing without a camera.
+
+Frames are read from a folder of images (.png, .tif, ...), a folder of .npy chunks, a raw recording or a video (.avi/.mp4) and kept in
+memory, then returned by capture_image at the target rate. AOI cropping is honored like on the Basler cameras.
+
+Start the GUI with a replay camera:
+    python OT_GUI.py --replay test_data --replay-fps 500
+"""
+
+import os
+from time import perf_counter, sleep
+
+import cv2
+import numpy as np
+
+from CameraControlsNew import CameraInterface
+from Utils_pytorch.read_video import iter_video_frames
+
+IMAGE_EXTENSIONS = ('.png', '.tif', '.tiff', '.bmp', '.jpg')
+
+# Delays shorter than this are spun instead of slept, sleep could overshoot them by more than the delay itself.
+SPIN_DELAY = 0.0005
+
+def read_image_folder(path, max_frames=None):
+    """
+    Images of a folder, sorted on the number in the file name if there is one ("0.png", "1.png", ..., "10.png").
+    """
+    files = [f for f in os.listdir(path) if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS]
+    files.sort(key=lambda f: (0, int(os.path.splitext(f)[0]), f) if os.path.splitext(f)[0].isdigit() else (1, 0, f))
+
+    frames = []
+    for file in files[:max_frames]:
+        image = cv2.imread(os.path.join(path, file), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            continue
+        frames.append(image[..., 0] if image.ndim == 3 else image)
+    return frames
+
+class ReplayCamera(CameraInterface):
+    """
+    Replays frames at fps (None for as fast as possible), looping at the end.
+
+    Input:
+        source : Folder of images, folder of .npy chunks, raw recording (.raw) or a video file.
+        fps : Target frame rate.
+        max_frames : Maximum number of frames loaded into memory.
+        max_bytes : Maximum memory of the loaded frames, the rest of the recording is not used.
+    """
+
+    def __init__(self, source, fps=100, max_frames=None, max_bytes=1024**3):
+        self.source = source
+        self.target_fps = fps
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.cameratype = 'Replay'
+        self.frames = None
+        self.frame_index = 0
+        self.next_time = None
+        self.exposure_time = 5000
+        self.AOI = None
+
+        # The GUI counts the connected cameras with cam and cam2.
+        self.cam = None
+        self.cam2 = None
+        self.num_cameras = 1
+
+        # Measured replay rate
+        self.fps = 0
+        self.count = 0
+        self.count_start = perf_counter()
+
+    def load_frames(self):
+        if os.path.isdir(self.source) and not any(f.endswith('.npy') for f in os.listdir(self.source)):
+            frames = read_image_folder(self.source, self.max_frames)
+        else:
+            frames, nbytes = [], 0
+            for batch in iter_video_frames(self.source, stop=self.max_frames):
+                frames.extend(batch)
+                nbytes += batch.nbytes
+                if nbytes >= self.max_bytes:
+                    break
+
+        if len(frames) == 0:
+            raise ValueError(f"No frames found in {self.source}")
+
+        # Frames of other sizes than the first one are skipped.
+        frames = [f for f in frames if f.shape == frames[0].shape]
+        n_frames = max(min(len(frames), self.max_bytes // frames[0].nbytes), 1)
+        self.frames = np.stack(frames[:n_frames])
+        self.frames.flags.writeable = False
+        print(f"Replaying {len(self.frames)} frames of shape {self.frames.shape[1:]} ({self.frames.dtype}) from {self.source}")
+
+    def connect_camera(self):
+        try:
+            self.load_frames()
+        except Exception as ex:
+            print(f"Could not open replay source {self.source}, {ex}")
+            return False
+
+        height, width = self.frames.shape[1:3]
+        self.AOI = [0, width, 0, height]
+        self.cam = self
+        return True
+
+    def disconnect_camera(self):
+        self.frames = None
+        self.cam = None
+
+    def wait_for_next_frame(self):
+        if not self.target_fps:
+            return
+        now = perf_counter()
+        if self.next_time is None or now - self.next_time > 0.1:
+            # First frame or we fell far behind, do not try to catch up.
+            self.next_time = now
+        delay = self.next_time - now
+        # The frame times are fixed, so a late wake-up is caught up on the next frame and does not add up.
+        # Sleeping the whole delay keeps the camera thread from holding a core (and from inflating the cpu_percent
+        # of RecordingBenchmark), only very short delays are spun.
+        if delay > SPIN_DELAY:
+            sleep(delay)
+        else:
+            while perf_counter() < self.next_time:
+                pass
+        self.next_time += 1 / self.target_fps
+
+    def capture_image(self):
+        """
+        The next frame cropped to the AOI. A read-only view of the loaded frames, nothing is allocated.
+        """
+        if self.frames is None:
+            print("Replay camera is not connected")
+            return None
+
+        self.wait_for_next_frame()
+        image = self.frames[self.frame_index, self.AOI[2]:self.AOI[3], self.AOI[0]:self.AOI[1]]
+        self.frame_index = (self.frame_index + 1) % len(self.frames)
+
+        self.count += 1
+        if self.count == 100:
+            self.fps = self.count / (perf_counter() - self.count_start)
+            self.count = 0
+            self.count_start = perf_counter()
+        return image
+
+    def set_AOI(self, AOI):
+        '''
+        AOI = [x1, x2, y1, y2], rounded to multiples of 16 and clipped to the frames like on the Basler cameras.
+        '''
+        height, width = self.frames.shape[1:3]
+        AOI[0] = min(max(AOI[0] - AOI[0] % 16, 0), width)
+        AOI[1] = min(max(AOI[1] - AOI[1] % 16, 0), width)
+        AOI[2] = min(max(AOI[2] - AOI[2] % 16, 0), height)
+        AOI[3] = min(max(AOI[3] - AOI[3] % 16, 0), height)
+
+        if AOI[1] - AOI[0] < 16 or AOI[3] - AOI[2] < 16:
+            print(f"AOI not accepted, AOI: {AOI}")
+            return
+        self.AOI = list(AOI)
+
+    def set_exposure_time(self, exposure_time):
+        # Only stored, the recorded frames are replayed as they are.
+        self.exposure_time = exposure_time
+
+    def get_exposure_time(self):
+        return self.exposure_time
+
+    def set_fps(self, fps):
+        self.target_fps = fps
+        self.next_time = None
+
+    def get_fps(self):
+        return round(self.fps, 1)
+
+    def get_sensor_size(self):
+        height, width = self.frames.shape[1:3]
+        return width, height, 0, 0
+
+    def stop_grabbing(self):
+        pass
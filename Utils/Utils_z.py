@@ -10,6 +10,7 @@ Created on Wed Mar 03 09:14:39 2022
 
 import numpy as np
 from scipy import ndimage
+from Utils import fft_backend as FB
 
 def precalc_Tz (k, zv, K, C):
     """
@@ -101,10 +102,10 @@ def refocus_field_z(field, z_prop, padding = 128, wavelength = 0.532):
     Tz = precalc_Tz(k, z, K, C)    
     
     #Fourier transform of field
-    f1 = np.fft.fft2(field)
+    f1 = FB.fft2(field)
     
     #Propagate f1 by z_prop
-    refocused = np.array(np.fft.ifft2(Tz*f1), dtype = np.complex64)
+    refocused = np.array(FB.ifft2(Tz*f1), dtype = np.complex64)
     
     if padding > 0:
         refocused = refocused[:, padding:-padding, padding:-padding]
@@ -145,10 +146,10 @@ def refocus_field_zrange(field, steps=51, interval = [-10, 10], z_range = None,
         Tz = precalc_Tz(k, zv, K, C)    
     
     #Fourier transform
-    f1 = np.fft.fft2(field)
+    f1 = FB.fft2(field)
     
     #Stack of different refocused images.
-    refocused =  np.array([np.fft.ifft2(Tz[i]*f1) for i in range(len(zv))], dtype = np.complex64)
+    refocused =  np.array([FB.ifft2(Tz[i]*f1) for i in range(len(zv))], dtype = np.complex64)
     
     if padding > 0:
         refocused = refocused[:, padding:-padding, padding:-padding]
@@ -202,7 +203,7 @@ def find_focus_field(field, steps=51, interval = [-10, 10], m = 'fft', padding=0
                         
     #Some ways of finding criterions.
     if m == 'fft':
-        criterion = [-(np.std((np.fft.fft2(im)).real) + np.std((np.fft.fft2(im)).imag)) for im in field]    
+        criterion = [-(np.std((FB.fft2(im)).real) + np.std((FB.fft2(im)).imag)) for im in field]    
     elif m == 'abs':
         criterion = [np.std(np.abs(im)) for im in field]
     elif m == 'maxabs':
@@ -256,7 +257,7 @@ def find_focus_field_stack(field,  m = 'fft', padmin = 6, ma=0):
 
     #Calculate criterions.
     if m == 'fft':
-        criterion = [-(np.std((np.fft.fft2(im)).real) + np.std((np.fft.fft2(im)).imag)) for im in field] 
+        criterion = [-(np.std((FB.fft2(im)).real) + np.std((FB.fft2(im)).imag)) for im in field] 
     elif m == 'abs':
         criterion = [np.std(np.abs(im)) for im in field]
     elif m == 'maxabs':
@@ -0,0 +1,213 @@
+"""
+FFT backend for the numpy code. All FFTs in Utils and the field windows go through this module,
+so the backend can be changed at runtime with set_backend:
+
+    'numpy'  : np.fft, single threaded.
+    'scipy'  : scipy.fft with workers threads.
+    'pyfftw' : pyFFTW with cached FFTW plans (one per shape, dtype and transform), aligned buffers and wisdom
+               that can be saved to file so the plans do not have to be measured again next session.
+
+Run "python -m Utils.fft_backend" for a benchmark of the available backends on our typical frame sizes.
+"""
+
+import os
+import pickle
+from threading import Lock
+from time import perf_counter
+
+import numpy as np
+
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+try:
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
+
+BACKENDS = ('numpy', 'scipy', 'pyfftw')
+
+_settings = {
+    'backend': 'numpy',
+    'workers': os.cpu_count() or 1,
+    'planner_effort': 'FFTW_MEASURE',
+    'wisdom_path': None,
+    }
+
+# (FFTW object, lock), keyed on (transform, shape, dtype, axes, s, threads). The field windows run FFTs from
+# different threads and a FFTW object has one set of buffers, so it is only run with its lock held.
+_fftw_plans = {}
+_fftw_plans_lock = Lock()
+
+def available_backends():
+    """
+    Backends that can be used in this environment.
+    """
+    backends = ['numpy']
+    if scipy_fft is not None:
+        backends.append('scipy')
+    if pyfftw is not None:
+        backends.append('pyfftw')
+    return backends
+
+def set_backend(backend, workers = None, planner_effort = None, wisdom_path = None):
+    """
+    Selects the FFT backend.
+
+    Input:
+        backend : 'numpy', 'scipy' or 'pyfftw'
+        workers : Number of threads for scipy and pyfftw, default all cores.
+        planner_effort : FFTW planner effort for pyfftw, e.g. 'FFTW_ESTIMATE' or 'FFTW_MEASURE'.
+        wisdom_path : File with FFTW wisdom for pyfftw. Loaded if it exists, save_wisdom writes to it.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown FFT backend {backend}, choose from {BACKENDS}")
+    if backend not in available_backends():
+        raise ImportError(f"FFT backend {backend} is not installed")
+
+    _settings['backend'] = backend
+    if workers is not None:
+        _settings['workers'] = int(workers)
+    if planner_effort is not None:
+        _settings['planner_effort'] = planner_effort
+    if wisdom_path is not None:
+        _settings['wisdom_path'] = wisdom_path
+
+    if backend == 'pyfftw':
+        if _settings['wisdom_path'] is not None and os.path.isfile(_settings['wisdom_path']):
+            load_wisdom(_settings['wisdom_path'])
+
+def get_backend():
+    return _settings['backend']
+
+def load_wisdom(path):
+    with open(path, 'rb') as f:
+        pyfftw.import_wisdom(pickle.load(f))
+
+def save_wisdom(path = None):
+    """
+    Saves the FFTW wisdom collected so far (pyfftw only).
+    """
+    path = path if path is not None else _settings['wisdom_path']
+    if pyfftw is None or path is None:
+        return
+    with open(path, 'wb') as f:
+        pickle.dump(pyfftw.export_wisdom(), f)
+
+def clear_plans():
+    with _fftw_plans_lock:
+        _fftw_plans.clear()
+
+def _fftw(transform, a, s = None, axes = (-2, -1)):
+    """
+    Runs a cached FFTW plan. The plan copies the input into its own aligned buffer,
+    the output buffer is reused by the next call so a copy is returned (taken before the lock of the plan is released).
+    """
+    a = np.asarray(a)
+    key = (transform, a.shape, a.dtype.str, tuple(axes), None if s is None else tuple(s), _settings['workers'])
+
+    with _fftw_plans_lock:
+        entry = _fftw_plans.get(key)
+    if entry is None:
+        builder = getattr(pyfftw.builders, transform)
+        kwargs = dict(axes = axes, threads = _settings['workers'], planner_effort = _settings['planner_effort'], avoid_copy = False)
+        if transform in ('rfft', 'irfft'):
+            kwargs.pop('axes')
+            kwargs['axis'] = axes[-1]
+            if s is not None:
+                kwargs['n'] = s[-1]
+        elif s is not None:
+            kwargs['s'] = s
+        plan = builder(pyfftw.empty_aligned(a.shape, dtype = a.dtype), **kwargs)
+        with _fftw_plans_lock:
+            # Another thread may have planned the same transform meanwhile, every thread then uses the stored one.
+            entry = _fftw_plans.setdefault(key, (plan, Lock()))
+
+    plan, lock = entry
+    with lock:
+        return plan(a).copy()
+
+def _transform(transform, a, s = None, axes = (-2, -1)):
+    backend = _settings['backend']
+
+    if backend == 'pyfftw':
+        return _fftw(transform, a, s = s, axes = axes)
+
+    if transform in ('rfft', 'irfft'):
+        n = None if s is None else s[-1]
+        if backend == 'scipy':
+            return getattr(scipy_fft, transform)(a, n = n, axis = axes[-1], workers = _settings['workers'])
+        return getattr(np.fft, transform)(a, n = n, axis = axes[-1])
+
+    if backend == 'scipy':
+        return getattr(scipy_fft, transform)(a, s = s, axes = axes, workers = _settings['workers'])
+    return getattr(np.fft, transform)(a, s = s, axes = axes)
+
+def fft2(a, s = None, axes = (-2, -1)):
+    return _transform('fft2', a, s = s, axes = axes)
+
+def ifft2(a, s = None, axes = (-2, -1)):
+    return _transform('ifft2', a, s = s, axes = axes)
+
+def rfft2(a, s = None, axes = (-2, -1)):
+    return _transform('rfft2', a, s = s, axes = axes)
+
+def irfft2(a, s = None, axes = (-2, -1)):
+    return _transform('irfft2', a, s = s, axes = axes)
+
+def rfft(a, n = None, axis = -1):
+    return _transform('rfft', a, s = None if n is None else (n,), axes = (axis,))
+
+def irfft(a, n = None, axis = -1):
+    return _transform('irfft', a, s = None if n is None else (n,), axes = (axis,))
+
+def benchmark(shapes = ((1024, 1024), (1280, 1920)), repeats = 10, backends = None):
+    """
+    Times fft2, ifft2 and rfft2 of each backend on frames of the given shapes.
+
+    Input:
+        shapes : Frame shapes to test.
+        repeats : Number of timed calls (after one warm-up call that also does the planning).
+        backends : Backends to test, default all available.
+    Output:
+        results : dict[(backend, shape, transform)] = mean time in seconds.
+    """
+    backends = available_backends() if backends is None else backends
+    previous = _settings['backend']
+    results = {}
+
+    for shape in shapes:
+        img = np.random.rand(*shape).astype(np.float32)
+        field = (img * np.exp(1j * img)).astype(np.complex64)
+        inputs = {'fft2': field, 'ifft2': field, 'rfft2': img}
+
+        for backend in backends:
+            set_backend(backend)
+            for transform, a in inputs.items():
+                f = globals()[transform]
+                f(a)
+                t = perf_counter()
+                for _ in range(repeats):
+                    f(a)
+                results[(backend, shape, transform)] = (perf_counter() - t) / repeats
+
+    set_backend(previous)
+
+    print(f"FFT benchmark, {_settings['workers']} workers, {repeats} repeats (ms per call, speedup vs numpy)")
+    for shape in shapes:
+        for transform in ('fft2', 'ifft2', 'rfft2'):
+            base = results[('numpy', shape, transform)] if 'numpy' in backends else None
+            row = []
+            for backend in backends:
+                t = results[(backend, shape, transform)]
+                speedup = f" (x{base / t:.1f})" if base else ""
+                row.append(f"{backend}: {t*1e3:.1f}{speedup}")
+            print(f"  {shape[0]}x{shape[1]} {transform:6s} " + ", ".join(row))
+
+    return results
+
+if __name__ == '__main__':
+    benchmark()
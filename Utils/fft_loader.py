@@ -1,4 +1,5 @@
 import numpy as np
+from Utils import fft_backend as FB
 
 #TODO add commenting etc.
 
@@ -59,7 +60,7 @@ def field_to_vec(field, pupil_radius, mask = None):
         field = field[...,0] + 1j*field[..., 1]
 
     h, w = field.shape
-    fft = np.fft.fftshift(np.fft.fft2(field))
+    fft = np.fft.fftshift(FB.fft2(field))
 
     if mask is None:
         mask = create_circular_mask(h, w, radius=pupil_radius)
@@ -84,7 +85,7 @@ def field_to_vec_multi(fields, pupil_radius, mask = None):
 
     fvec = []
     for field in fields:
-        fft = np.fft.fftshift(np.fft.fft2(field))
+        fft = np.fft.fftshift(FB.fft2(field))
         vec = np.array(fft[mask])
         fvec.append(vec)
     
@@ -103,7 +104,7 @@ def vec_to_field(vec, pupil_radius, shape, mask=None, to_real=False):
     mask = np.array(mask, dtype = np.complex64)
     mask[mask == 1] = vec
 
-    field = np.fft.ifft2(np.fft.ifftshift(mask))
+    field = FB.ifft2(np.fft.ifftshift(mask))
     if to_real:
         field = data_to_real(field)
 
@@ -123,7 +124,7 @@ def vec_to_field_multi(vecs, pupil_radius, shape, mask=None, to_real = False):
     for vec in vecs:
         mm = mask.copy()
         mm[mm == 1] = vec
-        field = np.fft.ifft2(np.fft.ifftshift(mm))
+        field = FB.ifft2(np.fft.ifftshift(mm))
         fields.append(field)
     fields = np.array(fields, dtype = np.complex64)
 
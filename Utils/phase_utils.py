@@ -12,11 +12,53 @@ from skimage import morphology
 from skimage.restoration import unwrap_phase
 #import cv2
 import scipy
+import scipy.linalg
 from scipy import ndimage
+from Utils import fft_backend as FB
+
+def get_phase_derivatives(phase_img):
+    """
+    Wrapped derivatives of the phase image in x and y, evaluated between the pixels.
+
+    Input:
+        phase_img : phase image
+    Output:
+        dx1, dy1 : derivatives w.r.t X and Y, both of shape (yr-1, xr-1)
+    """
+    An0 = phase_img - phase_img[0, 0] #Set phase to "0"
+
+    # Derivative the phase to handle the modulus
+    dx = -np.pi + np.mod(np.pi + (np.diff(An0, axis = 0)), 2*np.pi)
+    dy = -np.pi + np.mod(np.pi + (np.diff(An0, axis = 1)), 2*np.pi)
+    
+    #dx1, dy1 the derivatives
+    dx1 = 1/2 * (dx[:, 1:] + dx[:, :-1])
+    dy1 = 1/2 * (dy[1:, :] + dy[:-1, :])
+
+    return dx1, dy1
+
+def get_phase_gradients(phase_img):
+    """
+    Wrapped derivatives of the phase image, ordered as the rows of G (x-derivative on even rows, y-derivative on uneven rows).
+
+    Input:
+        phase_img : phase image
+    Output:
+        dt : Vector of length 2 * (xr-1) * (yr-1)
+    """
+    dx1, dy1 = get_phase_derivatives(phase_img)
+
+    #(derivate w.r.t to X and Y respectively.) Each factor have a constant b_i to be fitted later on.
+    dt = np.empty(2 * dx1.size)
+    dt[0::2] = dx1.flatten(order='F')
+    dt[1::2] = dy1.flatten(order='F')
+
+    return dt
 
 def correct_phase_4order (phase_img, G, polynomial):
     """ 
     Calculates the coefficients (4th order) by taking the derivative of phase image to fit an phase background. 
+    When fitting many frames of the same shape, PolynomialBackgroundFitter is faster.
 
     Input: 
         phase_img : phase image
@@ -26,27 +68,7 @@ def correct_phase_4order (phase_img, G, polynomial):
         Phase bakground fit
 
     """
-    An0 = phase_img.copy()
-    yr, xr = An0.shape
-
-    An0 = An0 - An0[0, 0] #Set phase to "0"
-
-    # Derivative the phase to handle the modulus
-    dx = -np.pi + np.mod(np.pi + (np.diff(An0, axis = 0)), 2*np.pi)
-    dy = -np.pi + np.transpose(np.mod(np.pi + np.transpose((np.diff(An0))), 2*np.pi))
-    
-    #dx1, dy1 the derivatives
-    dx1 = 1/2 * ((dx[:, 1:] + dx[:, :-1])).flatten(order='F')
-    dy1 = 1/2 * ((dy[1:, :] + dy[:-1, :])).flatten(order='F')
-
-    #(derivate w.r.t to X and Y respectively.) Each factor have a constant b_i to be fitted later on.
-    G_end = G.shape[0]
-    uneven_range = np.arange(1, G_end+1, 2)
-    even_range = np.arange(0, G_end, 2)
-    
-    dt = np.zeros(2 * (xr-1) * (yr-1))
-    dt[even_range] = dx1
-    dt[uneven_range] = dy1          
+    dt = get_phase_gradients(phase_img)
     
     # Here the coefficients to the polonomial are calculated. Note that np.linalg.lstsq(b,B)[0] is equivivalent to \ in MATLAB              
     R = np.transpose(np.linalg.cholesky(np.matmul(np.transpose(G),G)))
@@ -63,6 +85,128 @@ def correct_phase_4order (phase_img, G, polynomial):
     
     return phase_background
 
+class PolynomialBackgroundFitter:
+    """
+    Reusable version of correct_phase_4order for frames of one shape.
+    G'G is Cholesky factorized once and the polynomial is stacked once, 
+    so each frame costs one matrix-vector product G'*dt, a 14x14 solve and one tensordot.
+
+    Input:
+        G : Matrix that store 4-order polynominal (see get_G_matrix)
+        polynomial : polynomial matrix of meshes (see get_4th_polynomial)
+    """
+
+    def __init__(self, G, polynomial):
+        self.G = G
+        self.polynomial = np.asarray(polynomial)
+        self.shape = self.polynomial.shape[1:]
+        self.cho_factor = scipy.linalg.cho_factor(np.matmul(np.transpose(G), G))
+
+    def fit(self, phase_img):
+        """
+        Fitted coefficients b of the 4th order polynomial.
+        """
+        dt = get_phase_gradients(phase_img)
+        return scipy.linalg.cho_solve(self.cho_factor, np.matmul(np.transpose(self.G), dt))
+
+    def correct_phase_4order(self, phase_img):
+        """
+        Phase bakground fit, same as correct_phase_4order(phase_img, G, polynomial).
+        """
+        b = self.fit(phase_img)
+        return np.tensordot(b, self.polynomial, axes=1)
+
+# Exponents (a, b) of X_c**a * Y_c**b for the 14 factors of the 4th order polynomial, same order as get_4th_polynomial.
+POLYNOMIAL_4ORDER_EXPONENTS = [
+    (2, 0), (1, 1), (0, 2), (1, 0), (0, 1),
+    (3, 0), (2, 1), (1, 2), (0, 3),
+    (4, 0), (3, 1), (2, 2), (1, 3), (0, 4)
+    ]
+
+class MomentBackgroundFitter:
+    """
+    Matrix-free version of PolynomialBackgroundFitter, gives the same fit without building G or the polynomial.
+    The grid is separable, so every entry of G'G and G'*dt is a sum of x1**a * y1**b (times the derivatives),
+    which is calculated from 1D power sums of the coordinate vectors. 
+    Scratch memory is O(xr*yr) instead of a float64 G with 14 columns, and the precalculation takes milliseconds.
+
+    Input:
+        input_shape : Shape of the phase images
+    """
+
+    def __init__(self, input_shape):
+        yrc, xrc = input_shape
+        self.shape = tuple(input_shape)
+
+        # Coordinates along the rows (X_c) and columns (Y_c), as in get_4th_polynomial.
+        self.xc = np.arange(-(yrc/2-1/2), (yrc/2 + 1/2), 1)[:yrc]
+        self.yc = np.arange(-(xrc/2-1/2), (xrc/2 + 1/2), 1)[:xrc]
+
+        # Coordinates between the pixels, x1 and y1 in get_G_matrix.
+        self.x1 = 1/2 * (self.xc[1:] + self.xc[:-1])
+        self.y1 = 1/2 * (self.yc[1:] + self.yc[:-1])
+
+        # Vandermonde matrices, powers 0-4 of the coordinates.
+        self.Vx1 = self.x1[:, None] ** np.arange(5)
+        self.Vy1 = self.y1[:, None] ** np.arange(5)
+        self.Vxc = self.xc[:, None] ** np.arange(5)
+        self.Vyc = self.yc[:, None] ** np.arange(5)
+
+        self.cho_factor = scipy.linalg.cho_factor(self.get_GtG())
+
+    def get_GtG(self):
+        """
+        G'G from the power sums of x1 and y1. 
+        Column k of G is d/dx (even rows) and d/dy (uneven rows) of X_c**a * Y_c**b.
+        """
+        Sx = np.sum(self.x1[:, None] ** np.arange(9), axis=0)
+        Sy = np.sum(self.y1[:, None] ** np.arange(9), axis=0)
+
+        GtG = np.zeros((14, 14))
+        for k, (ak, bk) in enumerate(POLYNOMIAL_4ORDER_EXPONENTS):
+            for l, (al, bl) in enumerate(POLYNOMIAL_4ORDER_EXPONENTS):
+                if ak > 0 and al > 0:
+                    GtG[k, l] += ak * al * Sx[ak + al - 2] * Sy[bk + bl]
+                if bk > 0 and bl > 0:
+                    GtG[k, l] += bk * bl * Sx[ak + al] * Sy[bk + bl - 2]
+        return GtG
+
+    def get_Gtdt(self, phase_img):
+        """
+        G'*dt from the moments of the phase derivatives.
+        """
+        dx1, dy1 = get_phase_derivatives(phase_img)
+
+        # Mx[a, b] = sum(x1**a * y1**b * dx1), My the same for dy1.
+        Mx = self.Vx1.T @ dx1 @ self.Vy1
+        My = self.Vx1.T @ dy1 @ self.Vy1
+
+        Gtdt = np.zeros(14)
+        for k, (a, b) in enumerate(POLYNOMIAL_4ORDER_EXPONENTS):
+            if a > 0:
+                Gtdt[k] += a * Mx[a - 1, b]
+            if b > 0:
+                Gtdt[k] += b * My[a, b - 1]
+        return Gtdt
+
+    def fit(self, phase_img):
+        """
+        Fitted coefficients b of the 4th order polynomial.
+        """
+        return scipy.linalg.cho_solve(self.cho_factor, self.get_Gtdt(phase_img))
+
+    def correct_phase_4order(self, phase_img):
+        """
+        Phase bakground fit, same as correct_phase_4order(phase_img, G, polynomial).
+        """
+        b = self.fit(phase_img)
+
+        # Coefficient matrix C[a, b] of X_c**a * Y_c**b, the background is Vxc @ C @ Vyc'.
+        C = np.zeros((5, 5))
+        for k, (a, b_exp) in enumerate(POLYNOMIAL_4ORDER_EXPONENTS):
+            C[a, b_exp] = b[k]
+        return self.Vxc @ C @ self.Vyc.T
+
 def phaseunwrap_skimage(field, norm_phase_after = True):
     """
     Unwrap the phase of the field using skimage.
@@ -353,6 +497,80 @@ def get_G_matrix (input_shape):
     return G
 
 
+def find_fourier_peak(first_frame, filter_radius = [], correct_fourier_peak = [0, 0]):
+    """
+    Finds the off-center peak in the fourier space of a frame. 
+
+    Input:
+        first_frame : An 2D image
+        filter_radius : How large the radius of the circular selection filter to use. 
+        correct_fourier_peak : correct fourier peak with this amount (pre analyzed that the peak is slightly shifted)
+    Output:
+        idx_max : (row, col) of the peak in the shifted fft image.
+    """
+    yr, xr = first_frame.shape
+
+    x = np.arange(-(xr/2-1/2), (xr/2 + 1/2), 1)
+    y = np.arange(-(yr/2-1/2), (yr/2 + 1/2), 1)
+    X, Y = np.meshgrid(x, y)
+    position_matrix = np.sqrt(X**2 + Y**2)
+
+    fftImage = FB.fft2(first_frame) #Compute the 2-dimensional discrete Fourier Transform
+    fftImage = np.fft.fftshift(fftImage) #Shift the zero-frequency component to the center of the spectrum.
+    
+    yr, xr = fftImage.shape 
+    if not isinstance(filter_radius, (int, np.uint8)):
+        filter_radius = int(np.min([xr, yr]) / 7)
+
+    fftImage = np.where(position_matrix < filter_radius, 0, fftImage) #Set values within filter_radius to 0
+    fftImage = np.where(X < -5, 0, fftImage) #Set "left" values to 0 
+    fftImage = np.where(np.abs(Y) < 5, 0, fftImage) #Set "fourier boundary" to 0. 
+
+    #Find max with some minor gaussian convolutions
+    imag_c = scipy.ndimage.gaussian_filter(fftImage.imag, sigma = 3)
+    real_c = scipy.ndimage.gaussian_filter(fftImage.real, sigma = 3)
+    idx_max_real = np.unravel_index(np.argmax(real_c, axis=None), fftImage.shape)
+    idx_max_imag = np.unravel_index(np.argmax(imag_c, axis=None), fftImage.shape)
+    
+    idx_max = (int((idx_max_real[0] + idx_max_imag[0])/2), int((idx_max_real[1] + idx_max_imag[1])/2))   
+    idx_max = (idx_max[0]+correct_fourier_peak[0], idx_max[1]+correct_fourier_peak[1])
+    idx_max = (int(idx_max[0]), int(idx_max[1]))
+
+    return idx_max
+
+def fourier_peak_energy(first_frame, peak_index, radius = 4):
+    """
+    Fraction of the (non-DC) energy of a frame that lies in a small window around a fourier peak. Used to check that a
+    previously found peak is still where the sideband is without a new find_fourier_peak: only the (2*radius+1)^2
+    window of the fourier transform is computed, with two small matrix products instead of a full fft2.
+
+    Input:
+        first_frame : An 2D image
+        peak_index : (row, col) of the peak in the shifted fft image (see find_fourier_peak).
+        radius : Half size of the window.
+    Output:
+        fraction : Energy in the window divided by the total energy of the mean-subtracted frame.
+    """
+    frame = np.asarray(first_frame, dtype = np.float32)
+    frame = frame - frame.mean()
+    yr, xr = frame.shape
+
+    #Frequencies of the window, index k of the shifted spectrum is frequency k - n//2.
+    offsets = np.arange(-radius, radius + 1)
+    ky = peak_index[0] - yr//2 + offsets
+    kx = peak_index[1] - xr//2 + offsets
+    Ey = np.exp(-2j * np.pi * np.outer(ky, np.arange(yr)) / yr).astype(np.complex64)
+    Ex = np.exp(-2j * np.pi * np.outer(np.arange(xr), kx) / xr)
+
+    rows = (frame @ Ex.real.astype(np.float32)) + 1j * (frame @ Ex.imag.astype(np.float32))
+    window = np.abs(Ey @ rows.astype(np.complex64)).astype(np.float64)
+
+    #Parseval, the sum of |F|^2 over the whole spectrum is yr*xr times the sum of the squared frame.
+    energy = yr * xr * np.sum(frame.astype(np.float64)**2)
+    if energy == 0:
+        return 0.0
+    return float(np.sum(window**2) / energy)
+
 def pre_calculations(
     first_frame, 
     filter_radius, 
@@ -361,7 +579,9 @@ def pre_calculations(
     case = 'circular', 
     correct_fourier_peak = [0, 0], 
     first_phase_background = False,
-    mask_out = False
+    mask_out = False,
+    matrix_free = False,
+    peak_index = None
     ):
     """
     When retriving the phase from a set of frames, many calculations only has to be done once. Hence precalculations can be useful to speed up computations.
@@ -375,6 +595,8 @@ def pre_calculations(
         correct_fourier_peak : correct fourier peak with this amount (pre analyzed that the peak is slightly shifted)
         first_phase_background : If you want to use a phase background for the first frame.
         mask_out : Create a mask that ignores certain peaks in fft image that may disturb the phase retrieval.
+        matrix_free : Skip G and the polynomial (returned as None), fit backgrounds with MomentBackgroundFitter instead.
+        peak_index : (row, col) of the fourier peak if already known (see find_fourier_peak), skips the peak search.
     Output:
         X, Y : meshes
         X_c, Y_c : meshes cropped 
@@ -403,56 +625,14 @@ def pre_calculations(
     yc = np.arange(-(yrc/2-1/2), (yrc/2 + 1/2), 1)
     Y_c, X_c = np.meshgrid(xc, yc)
     
-    #4th order polynomial.
-    polynomial = [
-        X_c**2, 
-        X_c*Y_c, 
-        Y_c**2, 
-        X_c, 
-        Y_c, 
-        X_c**3, 
-        X_c**2*Y_c, 
-        X_c*Y_c**2, 
-        Y_c**3, 
-        X_c**4, 
-        X_c**3*Y_c, 
-        X_c**2*Y_c**2, 
-        X_c*Y_c**3, 
-        Y_c**4
-        ]
-    
-    #Vectors of equal size. x1 and y1 spatial coordinates
-    x1 = 1/2 * ((X_c[1:, 1:] + X_c[:-1, :-1])).flatten(order='F')
-    y1 = 1/2 * ((Y_c[1:, 1:] + Y_c[:-1, :-1])).flatten(order='F')
-    
-    G = np.zeros((2 * (xrc-1) * (yrc-1) , 14)) # Matrix to store 4-order polynominal. (Not including constant)
-    G_end = G.shape[0]
-    #(derivate w.r.t to X and Y respectively.)
-    uneven_range = np.arange(1, G_end+1, 2)
-    even_range = np.arange(0, G_end, 2)
-    
-    G[uneven_range, 4] = 1
-    G[even_range, 3] = 1
-    G[even_range, 1] = y1
-    G[even_range, 0] = 2*x1
-    G[uneven_range, 1] = x1
-    G[uneven_range, 2] = 2*y1
-    
-    G[even_range, 5] = 3*x1**2
-    G[even_range, 6] = 2*x1*y1
-    G[uneven_range, 6] = x1**2
-    G[uneven_range, 7] = 2*x1*y1
-    G[even_range, 7] = y1**2
-    G[uneven_range, 8] = 3*y1**2
-    
-    G[even_range, 9] = 4*x1**3
-    G[even_range, 10] = 3*x1**2*y1
-    G[uneven_range, 10] = x1**3
-    G[even_range, 11] = 2*x1*y1**2
-    G[uneven_range, 11] = 2*x1**2*y1
-    G[even_range, 12] = y1**3
-    G[uneven_range, 12] = 3*x1*y1**2
-    G[uneven_range, 13] = 4*y1**3
+    if matrix_free:
+        G, polynomial = None, None
+    else:
+        #4th order polynomial.
+        polynomial = get_4th_polynomial((yrc, xrc))
+
+        # Matrix to store 4-order polynominal. (Not including constant)
+        G = get_G_matrix((yrc, xrc))
     
     #### Constants in phaseunwrap function.
     KY_, KX_ = np.meshgrid(np.arange(1, xrc+1,1), np.arange(1, yrc+1, 1))
@@ -464,26 +644,10 @@ def pre_calculations(
     KX, KY = np.meshgrid(kx, ky)
     
     ##### The peak coordinates in the fourier space are the same for all frames (should be very similar atleast.)
-    fftImage = np.fft.fft2(first_frame) #Compute the 2-dimensional discrete Fourier Transform
-    fftImage = np.fft.fftshift(fftImage) #Shift the zero-frequency component to the center of the spectrum.
-    
-    yr, xr = fftImage.shape 
-    if not isinstance(filter_radius, (int, np.uint8)):
-        filter_radius = int(np.min([xr, yr]) / 7)
-
-    fftImage = np.where(position_matrix < filter_radius, 0, fftImage) #Set values within filter_radius to 0
-    fftImage = np.where(X < -5, 0, fftImage) #Set "left" values to 0 
-    fftImage = np.where(np.abs(Y) < 5, 0, fftImage) #Set "fourier boundary" to 0. 
-
-    #Find max with some minor gaussian convolutions
-    imag_c = scipy.ndimage.gaussian_filter(fftImage.imag, sigma = 3)
-    real_c = scipy.ndimage.gaussian_filter(fftImage.real, sigma = 3)
-    idx_max_real = np.unravel_index(np.argmax(real_c, axis=None), fftImage.shape)
-    idx_max_imag = np.unravel_index(np.argmax(imag_c, axis=None), fftImage.shape)
-    
-    idx_max = (int((idx_max_real[0] + idx_max_imag[0])/2), int((idx_max_real[1] + idx_max_imag[1])/2))   
-    idx_max = (idx_max[0]+correct_fourier_peak[0], idx_max[1]+correct_fourier_peak[1])
-    idx_max = (idx_max[0], idx_max[1])
+    if peak_index is None:
+        idx_max = find_fourier_peak(first_frame, filter_radius, correct_fourier_peak)
+    else:
+        idx_max = (int(peak_index[0]), int(peak_index[1]))
 
     x_pos = X[idx_max] #In X
     y_pos = Y[idx_max] #In Y
@@ -513,7 +677,7 @@ def pre_calculations(
 
     #FFT image shifted to center and masked out
     fftImage2 = np.fft.fftshift(
-            np.fft.fft2(
+            FB.fft2(
             (first_frame - np.mean(first_frame)) * np.exp(1j*(kx_add_ky)))
             ) * mask_list[0]
 
@@ -537,11 +701,14 @@ def pre_calculations(
             phase_img = phase_frequencefilter(fftImage2, mask = mask_list[1] , is_field = False, crop = cropping)
         else:
             if cropping > 0: 
-                phase_img = np.angle(np.fft.ifft2(np.fft.fftshift(fftImage2))[cropping:-cropping, cropping:-cropping])
+                phase_img = np.angle(FB.ifft2(np.fft.fftshift(fftImage2))[cropping:-cropping, cropping:-cropping])
             else: 
-                phase_img = np.angle(np.fft.ifft2(np.fft.fftshift(fftImage2)))
+                phase_img = np.angle(FB.ifft2(np.fft.fftshift(fftImage2)))
         # Get the phase background from phase image.
-        phase_background = correct_phase_4order(phase_img, G, polynomial)
+        if matrix_free:
+            phase_background = MomentBackgroundFitter(phase_img.shape).correct_phase_4order(phase_img)
+        else:
+            phase_background = correct_phase_4order(phase_img, G, polynomial)
     else:
         phase_background = []
 
@@ -566,7 +733,7 @@ def get_shifted_fft(frame, filter_radius=200, correct_fourier_peak = [0, 0]):
 
     position_matrix = np.sqrt(X**2 + Y**2) #"circle", values are smaller if closer to the center and vice verca.
 
-    fftImage = np.fft.fft2(frame) #Compute the 2-dimensional discrete Fourier Transform
+    fftImage = FB.fft2(frame) #Compute the 2-dimensional discrete Fourier Transform
     fftImage = np.fft.fftshift(fftImage) #Shift the zero-frequency component to the center of the spectrum.
 
     #If not filter radius inputted. Estimate it somewhat. 
@@ -603,7 +770,7 @@ def get_shifted_fft(frame, filter_radius=200, correct_fourier_peak = [0, 0]):
     img = img - np.mean(img) #img = img - np.mean(img)
     
     #Compute the 2-dimensional discrete Fourier Transform with offset image.
-    fftImage = np.fft.fft2(img * np.exp(1j*(kx_add_ky)))
+    fftImage = FB.fft2(img * np.exp(1j*(kx_add_ky)))
 
     #shifted fourier image centered on peak values in x and y. 
     fftImage = np.fft.fftshift(fftImage)
@@ -611,6 +778,97 @@ def get_shifted_fft(frame, filter_radius=200, correct_fourier_peak = [0, 0]):
     return fftImage
 
 
+class SidebandExtractor:
+    """
+    Extracts the 1st order sideband from a real rfft2 of the hologram, without multiplying the image with 
+    np.exp(1j*kx_add_ky) and doing a full complex fft2. The carrier only shifts the spectrum, so the masked sideband 
+    is gathered by index arithmetic (conjugate symmetry is used for the columns not stored by rfft2).
+    The shift is rounded to whole frequency bins, the remaining linear phase (less than half a bin) is removed by the 
+    linear terms of the 4th order background fit.
+
+    Input:
+        mask : Mask in the shifted fourier space, e.g. mask_list[0] from pre_calculations.
+        kx_add_ky : offset for shifting image to one of the off-center peaks (from pre_calculations).
+    """
+
+    def __init__(self, mask, kx_add_ky):
+        yr, xr = mask.shape
+        self.shape = (yr, xr)
+
+        # Carrier frequencies in radians per pixel, along the rows and columns.
+        ky_pos = kx_add_ky[1, 0] - kx_add_ky[0, 0]
+        kx_pos = kx_add_ky[0, 1] - kx_add_ky[0, 0]
+        self.shift = (int(np.round(ky_pos * yr / (2*np.pi))), int(np.round(kx_pos * xr / (2*np.pi))))
+
+        # Bounding box of the mask, symmetric around the zero frequency (yr//2, xr//2).
+        self.rows = self.get_box(np.nonzero(np.any(mask, axis = 1))[0], yr)
+        self.cols = self.get_box(np.nonzero(np.any(mask, axis = 0))[0], xr)
+        self.mask_crop = mask[self.rows[0]:self.rows[1], self.cols[0]:self.cols[1]]
+        self.downsized_shape = self.mask_crop.shape
+
+        # Index in the unshifted full spectrum for each position in the box.
+        src_r = (np.arange(*self.rows) - yr//2 - self.shift[0]) % yr
+        src_c = (np.arange(*self.cols) - xr//2 - self.shift[1]) % xr
+
+        # rfft2 only stores columns 0...xr//2, F[r, c] = conj(F[-r, -c]) for the others.
+        self.in_half = src_c <= xr//2
+        self.idx_r = np.where(self.in_half[None, :], src_r[:, None], (-src_r[:, None]) % yr)
+        self.idx_c = np.where(self.in_half, src_c, (-src_c) % xr)[None, :]
+
+    @staticmethod
+    def get_box(idx, n):
+        """
+        Start and stop of an even sized range centered on n//2 that covers idx.
+        """
+        if len(idx) == 0:
+            return (n//2, n//2)
+        a = int(max(n//2 - idx.min(), idx.max() + 1 - n//2))
+        if 2*a > n:
+            return (0, n)
+        return (n//2 - a, n//2 + a)
+
+    def get_sideband(self, img):
+        """
+        Masked sideband of the image, centered in the box (same as the box of fftshift(fft2(img * np.exp(1j*kx_add_ky))) * mask).
+        """
+        fftImage = FB.rfft2(img)
+        sideband = fftImage[self.idx_r, self.idx_c]
+        sideband = np.where(self.in_half, sideband, np.conj(sideband))
+        return sideband * self.mask_crop
+
+    def sideband_to_field(self, sideband, downsize = False):
+        """
+        Complex valued optical field from a sideband in the box (from get_sideband or cropped from a shifted spectrum).
+        With downsize the box itself is inverse transformed, giving the field at the reduced resolution (h, w) 
+        that the sideband supports. It is scaled with (h*w)/(yr*xr) to keep the amplitude of the full size field.
+        """
+        if downsize:
+            h, w = sideband.shape
+            return FB.ifft2(np.fft.ifftshift(sideband)) * (h*w / (self.shape[0]*self.shape[1]))
+
+        fftImage = np.zeros(self.shape, dtype = np.complex128)
+        fftImage[self.rows[0]:self.rows[1], self.cols[0]:self.cols[1]] = sideband
+        return FB.ifft2(np.fft.ifftshift(fftImage))
+
+    def crop_spectrum(self, fftImage):
+        """
+        Crops a shifted (and masked) spectrum to the box of the mask.
+        """
+        return fftImage[self.rows[0]:self.rows[1], self.cols[0]:self.cols[1]]
+
+    def get_field(self, img, downsize = False):
+        """
+        Complex valued optical field of the image, at full size or downsized to the box of the mask.
+        """
+        return self.sideband_to_field(self.get_sideband(img), downsize = downsize)
+
+def get_selection_sideband(position_matrix, dist_peak, kx_add_ky):
+    """
+    SidebandExtractor for the selection filter of imgtofield_simple (rfft_mode and downsize).
+    Build it once together with the other precalculated matrices and pass it to imgtofield_simple.
+    """
+    return SidebandExtractor(~(position_matrix > dist_peak / 3), kx_add_ky)
+
 def imgtofield_simple(img, 
                G, 
                polynomial, 
@@ -622,6 +880,9 @@ def imgtofield_simple(img,
                dist_peak,
                cropping=50,
                mask_f_case = 'sinc',
+               rfft_mode = False,
+               downsize = False,
+               sideband = None,
                ):
     """
     Function that takes in a set of precalculated matrices and scalars to reconstruct an optical field from the interference pattern in image.
@@ -640,6 +901,10 @@ def imgtofield_simple(img,
         mask_f_case : weight fourier image with function. 'sinc', 'jinc, or no weighting.
         radius_fourier_selection : Radius of the circular selection filter to use.
         cropping : crops away some edges. E.g. good to use 50, to avoid edge effects. Important to keep same as in precalculations.
+        rfft_mode : Extract the sideband from a real rfft2 with SidebandExtractor instead of a complex fft2 of the shifted image.
+        downsize : Inverse transform only the bounding box of the selected sideband, the field is returned at reduced resolution. 
+                   G, polynomial, X_c, Y_c and KX2_add_KY2 must then be calculated for the downsized shape (SidebandExtractor.downsized_shape).
+        sideband : SidebandExtractor from get_selection_sideband, used by rfft_mode and downsize. Built on every call if not given.
     Output:
         Complex valued optical field.
 
@@ -648,26 +913,38 @@ def imgtofield_simple(img,
     #Make image float.
     img = np.array(img, dtype = np.float32) 
 
-    #Compute the 2-dimensional fourier transform with offset kx_add_ky.
-    fftImage = np.fft.fft2(img * np.exp(1j*(kx_add_ky)))
-
-    #shifted fourier image centered on peak values in x and y. 
-    fftImage = np.fft.fftshift(fftImage)
-    
     #Selection fourier filter.
     selection_filter = position_matrix > dist_peak / 3 
 
-    #Sets values outside the defined circle to zero. Ie. take out the information for this peak.
-    fftImage2 = np.where(selection_filter, 0, fftImage)
+    if (rfft_mode or downsize) and sideband is None:
+        sideband = get_selection_sideband(position_matrix, dist_peak, kx_add_ky)
 
-    #Scale fftimage with sinc function
-    if mask_f_case == 'sinc':
-        fftImage2 = fftImage2 * np.sinc(selection_filter)
-    elif mask_f_case == 'jinc':
-        fftImage2 = fftImage2 * jinc(selection_filter)
+    if rfft_mode:
+        #The weighting of the boolean filter is constant inside the selected circle, sinc(0) = 1 and jinc(0) = 1/2.
+        E_field = sideband.get_field(img, downsize = downsize)
+        if mask_f_case == 'jinc':
+            E_field = E_field * jinc(0)
+    else:
+        #Compute the 2-dimensional fourier transform with offset kx_add_ky.
+        fftImage = FB.fft2(img * np.exp(1j*(kx_add_ky)))
 
-    #Retrieve optical field.
-    E_field = np.fft.ifft2(np.fft.fftshift(fftImage2)) 
+        #shifted fourier image centered on peak values in x and y. 
+        fftImage = np.fft.fftshift(fftImage)
+
+        #Sets values outside the defined circle to zero. Ie. take out the information for this peak.
+        fftImage2 = np.where(selection_filter, 0, fftImage)
+
+        #Scale fftimage with sinc function
+        if mask_f_case == 'sinc':
+            fftImage2 = fftImage2 * np.sinc(selection_filter)
+        elif mask_f_case == 'jinc':
+            fftImage2 = fftImage2 * jinc(selection_filter)
+
+        #Retrieve optical field.
+        if downsize:
+            E_field = sideband.sideband_to_field(sideband.crop_spectrum(fftImage2), downsize = True)
+        else:
+            E_field = FB.ifft2(np.fft.fftshift(fftImage2)) 
     
     #Crop optical field to avoid edge effects.
     if cropping > 0:
@@ -720,14 +997,14 @@ def phase_frequencefilter(field, mask, is_field = True, crop = 0):
         phase_img : phase of optical field.
     """
     if is_field:
-        freq = np.fft.fftshift(np.fft.fft2(field))
+        freq = np.fft.fftshift(FB.fft2(field))
     else:
         freq = field
         
     #construct low-pass mask
     freq_low = freq * mask
     
-    E_field = np.fft.ifft2(np.fft.fftshift(freq_low)) #Shift the zero-frequency component to the center of the spectrum. and compute inverse fft
+    E_field = FB.ifft2(np.fft.fftshift(freq_low)) #Shift the zero-frequency component to the center of the spectrum. and compute inverse fft
     
     if crop > 0:
         phase_img = np.angle(E_field[crop:-crop, crop:-crop])
@@ -926,7 +1203,7 @@ def dct(y):
     y2[:N] = y[:]
     y2[N:] = y[::-1]
 
-    c = np.fft.rfft(y2)
+    c = FB.rfft(y2)
     phi = np.exp(-1j*np.pi*np.arange(N)/(2*N))
     return np.real(phi*c[:N])    
 
@@ -963,7 +1240,7 @@ def idct(a):
     phi = np.exp(1j*np.pi*np.arange(N)/(2*N))
     c[:N] = phi*a
     c[N] = 0.0
-    return np.fft.irfft(c)[:N]    
+    return FB.irfft(c)[:N]    
 
 def idct2(b):
     """
@@ -1006,6 +1283,9 @@ def jinc(x):
     Output:
         Transformed Image
     """
-    return  scipy.special.j1(x) / x
+    x = np.asarray(x, dtype = float)
+    #j1(x)/x goes to 1/2 at x = 0.
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.where(x == 0, 0.5, scipy.special.j1(x) / np.where(x == 0, 1, x))
 
 
@@ -0,0 +1,411 @@
+"""
+Cache of reconstruction plans, i.e. everything pre_calculations derives from the image shape and the optical parameters.
+
+Switching back and forth between AOIs or reopening the field windows then reuses the meshes, masks and background
+fitter instead of recalculating them. The cache is a LRU with a cap on the total memory of the stored arrays.
+
+Plans can also be saved to a versioned .npz next to the recordings and memory-mapped at startup (save_plan, load_plan),
+which skips the fourier peak search and mask_out_pipeline as long as the AOI and the parameters are the same and the
+fourier peak of the saved plan still matches the frames. A loaded plan is kept in the cache, the file is read once.
+"""
+
+import os
+import struct
+import zipfile
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from Utils import phase_utils as P
+
+# Names of the outputs of pre_calculations, in order.
+PLAN_FIELDS = (
+    'X', 'Y', 'X_c', 'Y_c', 'position_matrix', 'G', 'polynomial', 'KX', 'KY', 'KX2_add_KY2',
+    'kx_add_ky', 'dist_peak', 'mask_list', 'phase_background', 'rad'
+    )
+
+# Bump when the content of the saved plans changes, old files are then recalculated.
+PLAN_FILE_VERSION = 3
+
+# A cached plan is reused as long as the energy around its fourier peak is at least this fraction of the energy there
+# when the plan was made (see P.fourier_peak_energy), otherwise the peak is searched for again.
+PEAK_ENERGY_TOLERANCE = 0.5
+
+# Arrays of the plan that are saved to file. G and the polynomial are rebuilt from the exponents when loading.
+SAVED_ARRAYS = (
+    'X', 'Y', 'X_c', 'Y_c', 'position_matrix', 'KX', 'KY', 'KX2_add_KY2', 'kx_add_ky', 'dist_peak', 'rad'
+    )
+
+def get_nbytes(obj):
+    """
+    Memory used by the arrays in obj (arrays, lists/tuples of arrays or the arrays attributes of an object).
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (list, tuple)):
+        return sum(get_nbytes(o) for o in obj)
+    if hasattr(obj, '__dict__'):
+        return sum(v.nbytes for v in vars(obj).values() if isinstance(v, np.ndarray))
+    return 0
+
+@dataclass
+class ReconstructionPlan:
+    """
+    The outputs of pre_calculations together with a background fitter for the cropped shape.
+    """
+    key: tuple
+    peak_index: tuple
+    arrays: dict
+    background_fitter: object
+    peak_energy: float = None
+    sideband: object = field(default = None, init = False, repr = False)
+    nbytes: int = field(init = False)
+
+    def __post_init__(self):
+        self.nbytes = get_nbytes(list(self.arrays.values())) + get_nbytes(self.background_fitter)
+
+    def __getattr__(self, name):
+        arrays = self.__dict__.get('arrays', {})
+        if name in arrays:
+            return arrays[name]
+        raise AttributeError(name)
+
+    def as_tuple(self):
+        """
+        Same output as pre_calculations.
+        """
+        return tuple(self.arrays[name] for name in PLAN_FIELDS)
+
+    def get_sideband(self):
+        """
+        SidebandExtractor of mask_list[0] (rfft2 and downsized reconstruction), built on the first call and kept with the plan.
+        """
+        if self.sideband is None:
+            self.sideband = P.SidebandExtractor(self.mask_list[0], self.kx_add_ky)
+        return self.sideband
+
+    def matches_frame(self, frame):
+        """
+        Cheap check that the fourier peak of the plan is still the sideband of frame (e.g. not after a realignment).
+        """
+        if self.peak_energy is None:
+            return False
+        return P.fourier_peak_energy(frame, self.peak_index) >= PEAK_ENERGY_TOLERANCE * self.peak_energy
+
+def get_plan_key(
+    shape, filter_radius = [], cropping = 0, mask_radie = [], case = 'circular', correct_fourier_peak = [0, 0],
+    mask_out = False, matrix_free = False
+    ):
+    # filter_radius is an int or [] (the default radius, see find_fourier_peak)
+    filter_radius = int(filter_radius) if isinstance(filter_radius, (int, np.integer)) else None
+    return (
+        tuple(shape), filter_radius, cropping, tuple(mask_radie), case, tuple(int(c) for c in correct_fourier_peak),
+        bool(mask_out), bool(matrix_free)
+        )
+
+def get_background_fitter(arrays, matrix_free):
+    if matrix_free:
+        return P.MomentBackgroundFitter(arrays['X_c'].shape)
+    return P.PolynomialBackgroundFitter(arrays['G'], arrays['polynomial'])
+
+class ReconstructionPlanCache:
+    """
+    LRU cache of ReconstructionPlan.
+
+    Input:
+        max_bytes : Cap on the total memory of the cached plans. The least recently used plans are evicted first.
+    """
+
+    def __init__(self, max_bytes = 512 * 1024**2):
+        self.max_bytes = max_bytes
+        self.plans = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_plan(
+        self,
+        first_frame,
+        filter_radius = [],
+        cropping = 0,
+        mask_radie = [],
+        case = 'circular',
+        correct_fourier_peak = [0, 0],
+        mask_out = False,
+        matrix_free = False,
+        refresh = False
+        ):
+        """
+        Returns the plan for the frame, calculated with pre_calculations on a miss.
+        A cached plan for the same shape and parameters is only reused if its fourier peak still matches the frame
+        (ReconstructionPlan.matches_frame), the full peak search is only done on a miss.
+
+        Input:
+            first_frame : An 2D image
+            filter_radius, cropping, mask_radie, case, correct_fourier_peak, mask_out, matrix_free : See pre_calculations
+            refresh : Recalculate the plan even if it is cached (e.g. the "Precalculate" button).
+        Output:
+            plan : ReconstructionPlan
+        """
+        key = get_plan_key(first_frame.shape, filter_radius, cropping, mask_radie, case, correct_fourier_peak, mask_out, matrix_free)
+
+        if not refresh:
+            plan = self.lookup(first_frame, key)
+            if plan is not None:
+                return plan
+
+        self.misses += 1
+        peak_index = P.find_fourier_peak(first_frame, filter_radius, correct_fourier_peak)
+        outputs = P.pre_calculations(
+            first_frame,
+            filter_radius,
+            cropping,
+            mask_radie = mask_radie,
+            case = case,
+            first_phase_background = False,
+            mask_out = mask_out,
+            matrix_free = matrix_free,
+            peak_index = peak_index
+            )
+        arrays = dict(zip(PLAN_FIELDS, outputs))
+
+        plan = ReconstructionPlan(
+            key, peak_index, arrays, get_background_fitter(arrays, matrix_free),
+            peak_energy = P.fourier_peak_energy(first_frame, peak_index)
+            )
+        self.put(plan)
+        return plan
+
+    def lookup(self, first_frame, key):
+        """
+        The cached plan for key if its fourier peak still matches first_frame, otherwise None.
+        """
+        plan = self.plans.get(key)
+        if plan is None:
+            return None
+        if not plan.matches_frame(first_frame):
+            print("Fourier peak of the cached reconstruction plan moved, recalculating.")
+            return None
+        self.hits += 1
+        self.plans.move_to_end(key)
+        return plan
+
+    def put(self, plan):
+        """
+        Adds a plan and evicts the least recently used plans until the cache is below max_bytes.
+        Plans larger than max_bytes are not stored.
+        """
+        if plan.key in self.plans:
+            self.nbytes -= self.plans.pop(plan.key).nbytes
+
+        if plan.nbytes > self.max_bytes:
+            return
+
+        self.plans[plan.key] = plan
+        self.nbytes += plan.nbytes
+
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.plans.popitem(last = False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self.plans.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """
+        Hit/miss counters and memory use of the cache.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'plans': len(self.plans),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+            }
+
+# Shared between the field windows.
+plan_cache = ReconstructionPlanCache()
+
+def get_plan_path(directory, shape):
+    """
+    Plan file for an AOI of the given shape, e.g. "reconstruction_plan_1280x1920.npz".
+    """
+    return os.path.join(directory, f"reconstruction_plan_{shape[0]}x{shape[1]}.npz")
+
+def save_plan(plan, path):
+    """
+    Saves the plan as an uncompressed .npz (needed for memory-mapping in load_plan).
+    Written to a temporary file first so a failed save never leaves a broken plan behind.
+    """
+    shape, filter_radius, cropping, mask_radie, case, correct_fourier_peak, mask_out, matrix_free = plan.key
+
+    arrays = {name: np.asarray(plan.arrays[name]) for name in SAVED_ARRAYS}
+    arrays.update({f'mask_{i}': np.asarray(mask) for i, mask in enumerate(plan.mask_list)})
+    arrays.update(
+        version = np.array(PLAN_FILE_VERSION),
+        shape = np.array(shape),
+        filter_radius = np.array(-1 if filter_radius is None else filter_radius),
+        cropping = np.array(cropping),
+        mask_radie = np.array(mask_radie, dtype = float),
+        case = np.array(case),
+        correct_fourier_peak = np.array(correct_fourier_peak),
+        peak_index = np.array(plan.peak_index),
+        peak_energy = np.array(np.nan if plan.peak_energy is None else plan.peak_energy),
+        mask_out = np.array(mask_out),
+        matrix_free = np.array(matrix_free),
+        n_masks = np.array(len(plan.mask_list)),
+        polynomial_exponents = np.array(P.POLYNOMIAL_4ORDER_EXPONENTS),
+        )
+
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+    except Exception as ex:
+        print(f"Could not save reconstruction plan to {path}, {ex}")
+
+def load_npz_mmap(path):
+    """
+    Loads an uncompressed .npz with every (non-empty) array memory-mapped read-only.
+    The members of the zip are plain .npy files, so the data offset is found from the local zip header and the npy header.
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+
+            # Local file header: 30 bytes followed by the file name and the extra field.
+            f.seek(info.header_offset)
+            name_len, extra_len = struct.unpack('<HH', f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            if len(shape) == 0 or np.prod(shape) == 0 or dtype.hasobject:
+                with zf.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+            else:
+                arrays[name] = np.memmap(
+                    path, dtype = dtype, mode = 'r', offset = f.tell(), shape = shape, order = 'F' if fortran_order else 'C'
+                    )
+    return arrays
+
+def load_plan(
+    path,
+    shape,
+    filter_radius = [],
+    cropping = 0,
+    mask_radie = [],
+    case = 'circular',
+    correct_fourier_peak = [0, 0],
+    mask_out = False,
+    matrix_free = False
+    ):
+    """
+    Loads a plan saved by save_plan. Returns None if there is no file or it does not match the current AOI and parameters.
+    Whether the fourier peak still matches the frames is checked by the caller (ReconstructionPlan.matches_frame).
+
+    Input:
+        path : Plan file (see get_plan_path)
+        shape : Shape of the current frames
+        filter_radius, cropping, mask_radie, case, correct_fourier_peak, mask_out, matrix_free : See pre_calculations
+    Output:
+        plan : ReconstructionPlan with memory-mapped arrays, or None.
+    """
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        saved = load_npz_mmap(path)
+    except Exception as ex:
+        print(f"Could not read reconstruction plan {path}, {ex}")
+        return None
+
+    key = get_plan_key(shape, filter_radius, cropping, mask_radie, case, correct_fourier_peak, mask_out, matrix_free)
+    if int(saved['version']) != PLAN_FILE_VERSION:
+        print(f"Reconstruction plan {path} is from an older version, recalculating.")
+        return None
+
+    checks = {
+        'shape': tuple(saved['shape']) == tuple(shape),
+        'filter_radius': int(saved['filter_radius']) == (-1 if key[1] is None else key[1]),
+        'cropping': int(saved['cropping']) == cropping,
+        'mask_radie': np.array_equal(saved['mask_radie'], np.array(mask_radie, dtype = float)),
+        'case': str(saved['case']) == case,
+        'correct_fourier_peak': tuple(saved['correct_fourier_peak']) == key[5],
+        'mask_out': bool(saved['mask_out']) == bool(mask_out),
+        'matrix_free': bool(saved['matrix_free']) == bool(matrix_free),
+        'polynomial_exponents': np.array_equal(saved['polynomial_exponents'], P.POLYNOMIAL_4ORDER_EXPONENTS),
+        }
+    failed = [name for name, ok in checks.items() if not ok]
+    if failed:
+        print(f"Reconstruction plan {path} does not match ({', '.join(failed)}), recalculating.")
+        return None
+
+    arrays = {name: saved[name] for name in SAVED_ARRAYS}
+    arrays['dist_peak'] = arrays['dist_peak'][()]
+    arrays['rad'] = arrays['rad'][()]
+    arrays['mask_list'] = [saved[f'mask_{i}'] for i in range(int(saved['n_masks']))]
+    arrays['phase_background'] = []
+
+    if matrix_free:
+        arrays['G'], arrays['polynomial'] = None, None
+    else:
+        arrays['G'] = P.get_G_matrix(arrays['X_c'].shape)
+        arrays['polynomial'] = P.get_4th_polynomial(arrays['X_c'].shape)
+
+    peak_index = tuple(int(i) for i in saved['peak_index'])
+    peak_energy = float(saved['peak_energy'])
+
+    return ReconstructionPlan(
+        key, peak_index, arrays, get_background_fitter(arrays, matrix_free),
+        peak_energy = None if np.isnan(peak_energy) else peak_energy
+        )
+
+def get_plan(first_frame, plan_path = None, refresh = False, **kwargs):
+    """
+    Plan for the frame. Uses the plan in plan_cache, or else the saved plan at plan_path (which is then added to
+    plan_cache), if it matches the parameters and its fourier peak matches the frame. Otherwise the plan is calculated
+    and saved to plan_path.
+
+    Input:
+        first_frame : An 2D image
+        plan_path : Plan file, None to only use the in-memory cache.
+        refresh : Recalculate the plan and overwrite the saved one.
+        kwargs : Parameters of ReconstructionPlanCache.get_plan
+    Output:
+        plan : ReconstructionPlan
+    """
+    if not refresh:
+        plan = plan_cache.lookup(first_frame, get_plan_key(first_frame.shape, **kwargs))
+        if plan is not None:
+            return plan
+
+        if plan_path is not None:
+            plan = load_plan(plan_path, first_frame.shape, **kwargs)
+            if plan is not None and plan.matches_frame(first_frame):
+                plan_cache.put(plan)
+                return plan
+            if plan is not None:
+                print(f"Fourier peak of the reconstruction plan {plan_path} moved, recalculating.")
+
+    # plan_cache was checked above
+    plan = plan_cache.get_plan(first_frame, refresh = True, **kwargs)
+    if plan_path is not None:
+        save_plan(plan, plan_path)
+    return plan
@@ -84,17 +84,17 @@ def phase_frequencefilter(field, mask, is_field=True, return_phase=True, crop=0)
     """
 
     if is_field:
-        freq = torch.fft.fftshift(torch.fft.fft2(field))
+        freq = torch.fft.fftshift(torch.fft.fft2(field), dim=(-2, -1))
     else:
         freq = field
         
     #construct low-pass mask
     freq_low = freq * mask
     
-    E_field = torch.fft.ifft2(torch.fft.fftshift(freq_low)) #Shift the zero-frequency component to the center of the spectrum. and compute inverse fft
+    E_field = torch.fft.ifft2(torch.fft.fftshift(freq_low, dim=(-2, -1))) #Shift the zero-frequency component to the center of the spectrum. and compute inverse fft
     
     if crop > 0:
-        E_field = E_field[crop:-crop, crop:-crop]
+        E_field = E_field[..., crop:-crop, crop:-crop]
 
     if return_phase:
         return torch.angle(E_field)
@@ -104,7 +104,7 @@ def phase_frequencefilter(field, mask, is_field=True, return_phase=True, crop=0)
 
 def correctfield(field, n_iter=5):
     """
-    Correct field
+    Correct field. Works on a single field (H, W) or a batch of fields (N, H, W).
     """
 
     if field.dtype == torch.float32:
@@ -113,10 +113,10 @@ def correctfield(field, n_iter=5):
     f_new = field.clone()
 
     # Normalize with mean of absolute value.
-    f_new = f_new / torch.mean(torch.abs(f_new))
+    f_new = f_new / torch.mean(torch.abs(f_new), dim=(-2, -1), keepdim=True)
 
     for _ in range(n_iter):
-        f_new = f_new * torch.exp(-1j * torch.median(torch.angle(f_new)))
+        f_new = f_new * torch.exp(-1j * torch.angle(f_new).flatten(-2).median(dim=-1).values[..., None, None])
 
     return f_new
 
@@ -1,28 +1,162 @@
+import os
+
 import cv2
 import numpy as np
 
-def read_video(filename, start_frame=0, max_frames=None, step=1):
+def get_npy_chunks(path):
     """
-    Read a video file and return the frames as a numpy array.
+    The .npy chunks of a recording folder ("lower-upper.npy", written by VideoWriterThread), sorted on the first frame.
     """
+    chunks = []
+    for file in os.listdir(path):
+        name, ext = os.path.splitext(file)
+        lower, _, upper = name.partition('-')
+        if ext == '.npy' and lower.isdigit() and upper.isdigit():
+            chunks.append((int(lower), int(upper), os.path.join(path, file)))
+    return sorted(chunks)
 
-    video = cv2.VideoCapture(filename) # videobject
-    
-    n_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT)) # Number of frames
+def count_frames(filename):
+    """
+    Number of frames in a video file, raw, hdf5 or segmented recording or a folder of .npy chunks. For videos this is the count in the header.
+    """
+    if os.path.isdir(filename):
+        return sum(upper - lower + 1 for lower, upper, _ in get_npy_chunks(filename))
+    if filename.endswith('.raw'):
+        from VideoWriters import RawVideoReader
+        return len(RawVideoReader(filename))
+    if filename.endswith('.json'):
+        from VideoWriters import read_manifest
+        return read_manifest(filename)['n_frames']
+    if filename.endswith('.h5'):
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            return len(f['frames'])
 
-    frames = []
-    for i in range(start_frame, n_frames, step):
-        ret, frame = video.read()
+    video = cv2.VideoCapture(filename)
+    n_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    video.release()
+    return n_frames
 
-        if not ret:
+def _iter_npy_frames(path, start, stop, step):
+    for lower, upper, chunk in get_npy_chunks(path):
+        if stop is not None and lower >= stop:
             break
+        if upper < start:
+            continue
 
-        if max_frames is not None and i >= max_frames:
-            break
-        frames.append(frame[...,0])
+        # First index in the chunk on the start + k*step grid.
+        first = max(start, lower)
+        first += (start - first) % step
 
-    frames = np.array(frames, dtype=np.float32)
+        frames = np.load(chunk, mmap_mode='r')
+        last = upper + 1 if stop is None else min(upper + 1, stop)
+        for i in range(first, last, step):
+            yield frames[i - lower]
 
-    video.release()
+def _iter_raw_frames(filename, start, stop, step):
+    # Raw recordings (VideoWriters.py) are memory-mapped, any frame can be read directly.
+    from VideoWriters import RawVideoReader
+    reader = RawVideoReader(filename)
+    for i in range(start, len(reader) if stop is None else min(stop, len(reader)), step):
+        yield reader[i]
+
+def _iter_hdf5_frames(filename, start, stop, step):
+    # Recordings of the hdf5 format (VideoWriters.py), the blosc codecs need hdf5plugin to be imported.
+    import h5py
+    try:
+        import hdf5plugin
+    except ImportError:
+        pass
+    with h5py.File(filename, 'r') as f:
+        frames = f['frames']
+        stop = len(frames) if stop is None else min(stop, len(frames))
+        chunk = frames.chunks[0] if frames.chunks is not None else len(frames)
+
+        # Read one chunk at a time so each chunk is decompressed once.
+        i = start
+        while i < stop:
+            end = min((i // chunk + 1) * chunk, stop)
+            yield from frames[i:end:step]
+            i += -(-(end - i) // step) * step
+
+def _iter_video_file_frames(filename, start, stop, step):
+    video = cv2.VideoCapture(filename)
+    if start > 0:
+        video.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+    i = start
+    try:
+        while stop is None or i < stop:
+            ret, frame = video.read()
+            if not ret:
+                break
+            yield frame[..., 0] if frame.ndim == 3 else frame
+
+            # Skipped frames are only grabbed, not decoded to an image.
+            for _ in range(step - 1):
+                i += 1
+                if (stop is not None and i >= stop) or not video.grab():
+                    return
+            i += 1
+    finally:
+        video.release()
+
+def _iter_segmented_frames(filename, start, stop, step):
+    # Segmented recordings (VideoWriters.py), the blocks of frames are read from the files in recording order.
+    from VideoWriters import read_manifest, get_segment_ranges
+    for file, first, last, offset in get_segment_ranges(read_manifest(filename), start, stop):
+        skip = (start - offset) % step
+        if first + skip < last:
+            yield from _iter_frames(file, first + skip, last, step)
+
+def _iter_frames(filename, start, stop, step):
+    if os.path.isdir(filename):
+        return _iter_npy_frames(filename, start, stop, step)
+    if filename.endswith('.raw'):
+        return _iter_raw_frames(filename, start, stop, step)
+    if filename.endswith('.h5'):
+        return _iter_hdf5_frames(filename, start, stop, step)
+    if filename.endswith('.json'):
+        return _iter_segmented_frames(filename, start, stop, step)
+    return _iter_video_file_frames(filename, start, stop, step)
+
+def iter_video_frames(filename, start=0, stop=None, step=1, batch_size=16):
+    """
+    Streams the frames of a recording in batches, only one batch is in memory at a time.
+
+    Input:
+        filename : Video file (.avi/.mp4/.mkv), raw (.raw) or hdf5 (.h5) recording, manifest of a segmented
+            recording (.json) or folder of .npy chunks.
+        start : First frame.
+        stop : Frame to stop before, None for the end of the recording.
+        step : Read every step-th frame.
+        batch_size : Frames per batch (the last batch can be smaller).
+    Output:
+        Generator of arrays (B, H, W) in the dtype of the recording, uint8 for videos.
+    """
+    if step < 1 or batch_size < 1:
+        raise ValueError("step and batch_size must be positive")
+
+    batch = []
+    for frame in _iter_frames(filename, start, stop, step):
+        batch.append(frame)
+        if len(batch) == batch_size:
+            yield np.stack(batch)
+            batch = []
+
+    if len(batch) > 0:
+        yield np.stack(batch)
+
+def read_video(filename, start_frame=0, max_frames=None, step=1):
+    """
+    Read a video file and return the frames as a numpy array.
+    max_frames is the number of frames returned, counted from start_frame.
+    Loads the whole range into memory, use iter_video_frames for long recordings.
+    """
+    stop = None if max_frames is None else start_frame + max_frames * step
+
+    batches = list(iter_video_frames(filename, start=start_frame, stop=stop, step=step))
+    if len(batches) == 0:
+        return np.zeros((0, 0, 0), dtype=np.float32)
 
-    return frames
+    return np.concatenate(batches).astype(np.float32)
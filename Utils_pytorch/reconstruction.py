@@ -5,7 +5,7 @@ import torch.nn.functional as F
 import other_utils as OU
 import fft_loader as FL
 
-from reconstruction_utils import FourierPeakFinder, PolynomialFitterV2 #PolynomialFitter, PhaseFrequencyFilter,
+from reconstruction_utils import FourierPeakFinder, PolynomialFitterV2, SidebandExtractor #PolynomialFitter, PhaseFrequencyFilter,
 
 
 class HolographicReconstruction(nn.Module):
@@ -27,7 +27,10 @@ class HolographicReconstruction(nn.Module):
             correct_field=True,
             lowpass_kernel_end=False,
             kernel_size=27,
-            sigma=9
+            sigma=9,
+            batch_size=8,
+            rfft_mode=False,
+            downsize=False
             ):
 
         super(HolographicReconstruction, self).__init__()
@@ -51,6 +54,9 @@ class HolographicReconstruction(nn.Module):
         self.lowpass_kernel_end = lowpass_kernel_end
         self.kernel_size = kernel_size
         self.sigma = sigma
+        self.batch_size = batch_size
+        self.rfft_mode = rfft_mode
+        self.downsize = downsize
 
         # Do precalculations
         if do_precalculations:
@@ -74,7 +80,10 @@ class HolographicReconstruction(nn.Module):
             "correct_field": self.correct_field,
             "lowpass_kernel_end": self.lowpass_kernel_end,
             "kernel_size": self.kernel_size,
-            "sigma": self.sigma
+            "sigma": self.sigma,
+            "batch_size": self.batch_size,
+            "rfft_mode": self.rfft_mode,
+            "downsize": self.downsize
             }
 
         return settings
@@ -126,6 +135,24 @@ class HolographicReconstruction(nn.Module):
         #Create the masks
         self.masks_precalculate()
 
+        #Extracts the sideband from a rfft2 of the holograms (rfft_mode) and crops the spectrum for downsized fields (downsize)
+        self.SE = SidebandExtractor(self.mask_list[0], device=self.device)
+
+        #Downsized fields have the size of the box around the sideband, crop is then in pixels of the downsized field
+        if self.downsize:
+            self.xrc = self.SE.rows[1] - self.SE.rows[0] - self.crop*2
+            self.yrc = self.SE.cols[1] - self.SE.cols[0] - self.crop*2
+
+            xc = torch.arange(self.xrc, device=self.first_image.device) - self.xrc // 2
+            yc = torch.arange(self.yrc, device=self.first_image.device) - self.yrc // 2
+            self.Y_c, self.X_c = torch.meshgrid(xc, yc, indexing='ij')
+
+            #Lowpass masks for the downsized field
+            self.masks_precalculate()
+
+        #Mask of the field spectrum, used when saving ffts
+        self.fft_mask = self.SE.mask_crop if self.downsize else self.mask_list[0]
+
         # Initialize FourierPeakFinder with the required arguments. This class is used to find the peak coordinates.
         self.FPF = FourierPeakFinder(
             self.position_matrix, 
@@ -143,8 +170,11 @@ class HolographicReconstruction(nn.Module):
             )
 
         #Find the peak coordinates
-        self.kx_add_ky, self.dist_peak = self.FPF.find_peak_coordinates(self.first_image)
+        kx_pos, ky_pos, self.dist_peak = self.FPF.find_peak_wavevectors(self.first_image)
+        self.kx_add_ky = kx_pos * self.X + ky_pos * self.Y
         self.kx_add_ky.to(self.device)
+
+        self.sideband_shift = self.SE.get_shift(kx_pos, ky_pos)
         
         #Calculate the fft of the first image
         self.fftIm2 = torch.fft.fftshift(
@@ -153,7 +183,10 @@ class HolographicReconstruction(nn.Module):
             ) * self.mask_list[0]
         
         # Calculate the first field and phase
-        self.first_field = torch.fft.ifft2(torch.fft.fftshift(self.fftIm2)).to(self.device)
+        if self.downsize:
+            self.first_field = self.SE.sideband_to_field(self.SE.crop_spectrum(self.fftIm2), downsize=True).to(self.device)
+        else:
+            self.first_field = torch.fft.ifft2(torch.fft.fftshift(self.fftIm2)).to(self.device)
         self.first_phase = torch.angle(self.first_field).to(self.device)
 
         if not self.skip_background_correction:
@@ -249,13 +282,20 @@ class HolographicReconstruction(nn.Module):
         return kernel
 
 
-    def forward(self, holograms):
+    def forward(self, holograms, batch_size=None):
         """
-        Forward pass of the reconstruction
+        Forward pass of the reconstruction. The holograms are processed in micro-batches,
+        all frames of a batch are reconstructed at once with batched FFTs and a batched background fit.
 
         Parameters:
-        - holograms (torch.Tensor): Holograms to reconstruct.
+        - holograms (torch.Tensor): Holograms to reconstruct, shape (N, H, W).
+        - batch_size (int): Number of holograms per micro-batch. If None, self.batch_size is used.
         """
+        if batch_size is None:
+            batch_size = self.batch_size
+
+        if not isinstance(holograms, torch.Tensor):
+            holograms = torch.as_tensor(holograms)
 
         #Check if holograms need to be cropped
         if holograms.shape[1] != self.xr or holograms.shape[2] != self.yr:
@@ -267,71 +307,102 @@ class HolographicReconstruction(nn.Module):
             ).type(torch.complex64)
 
         print(f"Reconstructing {holograms.shape[0]} holograms.")
-        for i, holo in enumerate(holograms):
+        for start in range(0, holograms.shape[0], batch_size):
+            stop = min(start + batch_size, holograms.shape[0])
+            reconstructed_fields[start:stop] = self.reconstruct_batch(holograms[start:stop])
+
+        #Save the fft instead of the field if fft_save is True 
+        if self.fft_save:
+            reconstructed_fields = FL.field_to_vec_multi(reconstructed_fields, self.rad, mask=self.fft_mask)
+
+        return reconstructed_fields
+
+    def reconstruct_batch(self, holograms):
+        """
+        Reconstruct a micro-batch of holograms.
+
+        Parameters:
+        - holograms (torch.Tensor): Holograms to reconstruct, shape (B, H, W).
+
+        Returns:
+        - torch.Tensor: Reconstructed fields, shape (B, xrc, yrc).
+        """
 
-            #Subtract the mean
-            holo = holo - holo.mean()
+        holograms = holograms.to(self.device, dtype=torch.float32)
+
+        #Subtract the mean of each hologram
+        holograms = holograms - holograms.mean(dim=(-2, -1), keepdim=True)
+
+        if self.rfft_mode:
+            #Find the peak for each hologram, only the shift in whole frequency bins is needed
+            if self.recalculate_offset:
+                kx_pos, ky_pos, _ = self.FPF.find_peak_wavevectors(holograms)
+                shift_r, shift_c = self.SE.get_shift(kx_pos, ky_pos)
+                self.sideband_shift = (shift_r[-1:], shift_c[-1:])
+                self.kx_add_ky = kx_pos[-1] * self.X + ky_pos[-1] * self.Y
+            else:
+                shift_r, shift_c = self.sideband_shift
+
+            #Sideband from a real rfft2 of the holograms, no complex carrier needed
+            fields = self.SE.get_field(holograms, shift_r, shift_c, downsize=self.downsize)
+
+        else:
+            #Find the peak coordinates for each hologram
+            if self.recalculate_offset:
+                kx_add_ky, _ = self.FPF.find_peak_coordinates(holograms)
+                self.kx_add_ky = kx_add_ky[-1]
+            else:
+                kx_add_ky = self.kx_add_ky
 
             #Compute the 2-dimensional discrete Fourier Transform with offset image.
-            if not self.recalculate_offset:
-                fftImage = torch.fft.fftshift(
-                    torch.fft.fft2(
-                        holo * torch.exp(1j*(self.kx_add_ky))
-                        )) * self.mask_list[0]
+            fftImage = torch.fft.fftshift(
+                torch.fft.fft2(
+                    holograms * torch.exp(1j*(kx_add_ky))
+                    ), dim=(-2, -1)) * self.mask_list[0]
+
+            #Inverse 2-dimensional discrete Fourier Transform, of only the box around the sideband if downsize
+            if self.downsize:
+                fields = self.SE.sideband_to_field(self.SE.crop_spectrum(fftImage), downsize=True)
             else:
-                #Find the peak coordinates
-                self.kx_add_ky, _ = self.FPF.find_peak_coordinates(holo)
-                fftImage = torch.fft.fftshift(
-                    torch.fft.fft2(
-                        holo * torch.exp(1j*(self.kx_add_ky))
-                        )) * self.mask_list[0]
-
-            #Inverse 2-dimensional discrete Fourier Transform
-            fftImage2 = torch.fft.ifft2(torch.fft.fftshift(fftImage))
-
-            #Removes edges in x and y. Some edge effects
-            if self.crop > 0:
-                fftImage2 = fftImage2[self.crop:-self.crop, self.crop:-self.crop]
-            reconstructed_fields[i] = fftImage2
-
-            if not self.skip_background_correction:
-                #Lowpass filtered phase
-                if self.lowpass_filtered_phase and len(self.mask_list) > 1:
-                    field = OU.phase_frequencefilter(reconstructed_fields[i], mask=self.mask_list[1], is_field=True, return_phase=False)
-                else:
-                    field = reconstructed_fields[i]
+                fields = torch.fft.ifft2(torch.fft.fftshift(fftImage, dim=(-2, -1)))
 
-                phase_img_smooth = self.PF.correct_phase_4order(torch.angle(field))
+        #Removes edges in x and y. Some edge effects
+        if self.crop > 0:
+            fields = fields[:, self.crop:-self.crop, self.crop:-self.crop]
 
-                #Correct the field with the phase background
-                reconstructed_fields[i] = reconstructed_fields[i] * torch.exp(-1j * phase_img_smooth)
+        if not self.skip_background_correction:
+            #Lowpass filtered phase
+            if self.lowpass_filtered_phase and len(self.mask_list) > 1:
+                field = OU.phase_frequencefilter(fields, mask=self.mask_list[1], is_field=True, return_phase=False)
+            else:
+                field = fields
+
+            phase_img_smooth = self.PF.correct_phase_4order(torch.angle(field))
 
-                if self.lowpass_filtered_phase and len(self.mask_list) > 2:
-                    for _ in range(self.phase_corrections):
-                            field = OU.phase_frequencefilter(reconstructed_fields[i], mask=self.mask_list[2], is_field=True, return_phase=False)
+            #Correct the fields with the phase background
+            fields = fields * torch.exp(-1j * phase_img_smooth)
+
+            if self.lowpass_filtered_phase and len(self.mask_list) > 2:
+                for _ in range(self.phase_corrections):
+                    field = OU.phase_frequencefilter(fields, mask=self.mask_list[2], is_field=True, return_phase=False)
 
-                            phase_img_smooth = self.PF.correct_phase_4order(torch.angle(field))
+                    phase_img_smooth = self.PF.correct_phase_4order(torch.angle(field))
 
-                            #Correct the field with the phase background
-                            reconstructed_fields[i] = reconstructed_fields[i] * torch.exp(-1j * phase_img_smooth)
+                    #Correct the fields with the phase background
+                    fields = fields * torch.exp(-1j * phase_img_smooth)
 
-            #Correct reconstructed_fields[i] with the mean of the phase
-            reconstructed_fields[i] = reconstructed_fields[i] * torch.exp(-1j * torch.mean(torch.angle(reconstructed_fields[i])))
+        #Correct the fields with the mean of the phase
+        fields = fields * torch.exp(-1j * torch.mean(torch.angle(fields), dim=(-2, -1), keepdim=True))
 
-            if self.lowpass_kernel_end:
-                real_smoothed = F.conv2d(reconstructed_fields[i].real.unsqueeze(0).unsqueeze(0), self.kernel, padding=self.padding)
-                imag_smoothed = F.conv2d(reconstructed_fields[i].imag.unsqueeze(0).unsqueeze(0), self.kernel, padding=self.padding)
-                reconstructed_fields[i] = reconstructed_fields[i] * torch.exp(-1j * torch.angle(real_smoothed + 1j * imag_smoothed))
+        if self.lowpass_kernel_end:
+            real_smoothed = F.conv2d(fields.real.unsqueeze(1), self.kernel, padding=self.padding).squeeze(1)
+            imag_smoothed = F.conv2d(fields.imag.unsqueeze(1), self.kernel, padding=self.padding).squeeze(1)
+            fields = fields * torch.exp(-1j * torch.angle(real_smoothed + 1j * imag_smoothed))
 
         if self.correct_field:
-            for i in range(reconstructed_fields.shape[0]):
-                reconstructed_fields[i] = OU.correctfield(reconstructed_fields[i], n_iter=3)
-        
-        #Save the fft instead of the field if fft_save is True 
-        if self.fft_save:
-            reconstructed_fields = FL.field_to_vec_multi(reconstructed_fields, self.rad, mask=self.mask_list[0])
+            fields = OU.correctfield(fields, n_iter=3)
 
-        return reconstructed_fields
+        return fields
     
     def load_fft(self, ffts):
         """
@@ -340,5 +411,5 @@ class HolographicReconstruction(nn.Module):
         Parameters:
         - ffts (torch.Tensor): FFTs to reconstruct.
         """
-        return FL.vec_to_field_multi(ffts, self.rad, shape=(self.xrc, self.yrc), mask=self.mask_list[0])
+        return FL.vec_to_field_multi(ffts, self.rad, shape=(self.xrc, self.yrc), mask=self.fft_mask)
 
@@ -164,6 +164,9 @@ class PolynomialFitterV2:
         self.polynomial = self.get_4th_polynomial().to(self.device)
         self.G_matrix = self.get_G_matrix().to(self.device)
 
+        # G is fixed for the shape, so the Cholesky factor of G'G is calculated once here and reused for every frame.
+        self.G_cholesky = torch.linalg.cholesky(torch.matmul(torch.transpose(self.G_matrix, 0, 1), self.G_matrix))
+
     def get_4th_polynomial(self):
         """
         Function that retrieves the 4th-order polynomial
@@ -240,49 +243,34 @@ class PolynomialFitterV2:
         Calculates the coefficients (4th order) by taking the derivative of phase image to fit a phase background. 
 
         Input: 
-            phase_img : phase image
+            phase_img : phase image, shape (H, W) or a batch of phase images, shape (N, H, W)
         Output: 
-            Phase background fit
+            Phase background fit, same shape as phase_img
         """
-        An0 = phase_img.clone()
-
         #Move to device
-        An0 = An0.to(self.device)
+        An0 = phase_img.to(self.device)
 
-        An0 = An0 - An0[0, 0]  # Set phase to "0"
+        An0 = An0 - An0[..., :1, :1]  # Set phase to "0"
 
         # Derivative the phase to handle the modulus
-        dx = -torch.pi + (torch.pi + torch.diff(An0, dim=0)) % (2 * torch.pi)
-        dy = -torch.pi + torch.transpose((torch.pi + torch.diff(torch.transpose(An0, 0, 1), dim=0)) % (2 * torch.pi), 0, 1)
+        dx = -torch.pi + (torch.pi + torch.diff(An0, dim=-2)) % (2 * torch.pi)
+        dy = -torch.pi + (torch.pi + torch.diff(An0, dim=-1)) % (2 * torch.pi)
 
         # dx1, dy1 the derivatives
-        dx1 = 1 / 2 * ((dx[:, 1:] + dx[:, :-1])).flatten()
-        dy1 = 1 / 2 * ((dy[1:, :] + dy[:-1, :])).flatten()
+        dx1 = 1 / 2 * ((dx[..., :, 1:] + dx[..., :, :-1])).flatten(-2)
+        dy1 = 1 / 2 * ((dy[..., 1:, :] + dy[..., :-1, :])).flatten(-2)
 
         # (derivate w.r.t to X and Y respectively.) Each factor have a constant b_i to be fitted later on.
-        G_end = self.G_matrix.shape[0]
-        uneven_range = torch.arange(1, G_end + 1, 2, device=self.device)
-        even_range = torch.arange(0, G_end, 2, device=self.device)
-
-        dt = torch.zeros(2 * (An0.shape[0] - 1) * (An0.shape[1] - 1), device=self.device)
-        dt[even_range] = dx1
-        dt[uneven_range] = dy1
-
-        # Here the coefficients to the polynomial are calculated. Note that np.linalg.lstsq(b,B)[0] is equivalent to \ in MATLAB              
-        R = torch.linalg.cholesky(torch.matmul(torch.transpose(self.G_matrix, 0, 1), self.G_matrix))
-        R = torch.transpose(R, 0, 1)
-        Rt = torch.transpose(R, 0, 1)
+        # dx1 on the even rows and dy1 on the uneven rows of dt.
+        dt = torch.stack((dx1, dy1), dim=-1).flatten(-2)
 
+        # Here the coefficients to the polynomial are calculated with the precalculated Cholesky factor of G'G.
         # Equivalent to R\(R'\(G'*dt))
-        b = torch.linalg.solve(R,
-                               torch.linalg.solve(
-                                   Rt, torch.matmul(self.G_matrix.t(), dt))
-                                )
+        b = torch.cholesky_solve(torch.matmul(dt, self.G_matrix).unsqueeze(-1), self.G_cholesky).squeeze(-1)
         self.b=b
+
         # Phase background is defined by the 4th order polynomial with the fitted parameters.
-        phase_background = torch.zeros_like(self.polynomial[0], device=self.device)
-        for i, factor in enumerate(self.polynomial):
-            phase_background = phase_background + b[i] * factor
+        phase_background = torch.tensordot(b, self.polynomial, dims=1)
         
         return phase_background
 
@@ -367,36 +355,55 @@ class FourierPeakFinder:
         Find peak coordinates in Fourier space for a given frame.
 
         Args:
-        - frame (torch.Tensor): Input tensor (2D) representing the frame.
+        - frame (torch.Tensor): Input tensor (2D) representing the frame, or a batch of frames (N, H, W).
 
         Returns:
         - Tuple: (kx_add_ky, dist_peak) where:
           - kx_add_ky (torch.Tensor): Resulting tensor from computing kx_pos * X + ky_pos * Y.
           - dist_peak (torch.Tensor): Distance of the peak from the center.
         """
-        xr, yr = frame.shape
+        kx_pos, ky_pos, dist_peak = self.find_peak_wavevectors(frame)
+
+        # Compute kx_add_ky
+        kx_add_ky = kx_pos * self.X + ky_pos * self.Y
+
+        return kx_add_ky, dist_peak
+
+    def find_peak_wavevectors(self, frame):
+        """
+        Find the wave vector of the peak in Fourier space, without building kx_add_ky.
+
+        Args:
+        - frame (torch.Tensor): Input tensor (2D) representing the frame, or a batch of frames (N, H, W).
+
+        Returns:
+        - Tuple: (kx_pos, ky_pos, dist_peak) where kx_pos and ky_pos have shape (..., 1, 1).
+        """
+        xr = frame.shape[-2]
 
         # Compute 2D Fourier transform
         fftImage = torch.fft.fft2(frame)
 
         # Shift zero-frequency component to the center of the spectrum
-        fftImage = torch.fft.fftshift(fftImage)
+        fftImage = torch.fft.fftshift(fftImage, dim=(-2, -1))
 
         # Apply filters to fftImage
         fftImage = torch.where(self.position_matrix < self.filter_radius, torch.tensor(0, dtype=fftImage.dtype, device=fftImage.device), fftImage)
         
         #Set fftImage to zero from 0 to middle of the image
-        fftImage[:, :xr//2] = 0
+        fftImage[..., :xr//2] = 0
 
         # Compute magnitude of the fftImage
         fftImage = torch.abs(fftImage)
 
         # Apply Gaussian filter to the fftImage
-        fftImage = F.conv2d(fftImage.real.unsqueeze(0).unsqueeze(0), torch.ones(1, 1, 7, 7, device=fftImage.device) / 49, padding=3).squeeze()
+        fftImage = F.conv2d(
+            fftImage.reshape(-1, 1, *fftImage.shape[-2:]), torch.ones(1, 1, 7, 7, device=fftImage.device) / 49, padding=3
+            ).reshape(fftImage.shape)
 
-        #Find the coordinates of the maximum values in the fftImage
-        max_index = torch.argmax(fftImage)
-        max_coords = torch.unravel_index(max_index, fftImage.shape)
+        #Find the coordinates of the maximum values in the fftImage, one per frame
+        max_index = torch.argmax(fftImage.flatten(-2), dim=-1)
+        max_coords = torch.unravel_index(max_index, fftImage.shape[-2:])
         max_coords = (max_coords[0], max_coords[1])
 
         # Extract coordinates from X and Y matrices
@@ -405,13 +412,10 @@ class FourierPeakFinder:
         dist_peak = torch.sqrt(x_pos**2 + y_pos**2)
 
         # Assuming KX and KY are defined similarly to X and Y
-        kx_pos = self.KX[max_coords]
-        ky_pos = self.KY[max_coords]
-
-        # Compute kx_add_ky
-        kx_add_ky = kx_pos * self.X + ky_pos * self.Y
+        kx_pos = self.KX[max_coords][..., None, None]
+        ky_pos = self.KY[max_coords][..., None, None]
 
-        return kx_add_ky, dist_peak
+        return kx_pos, ky_pos, dist_peak
 
 class Polynomial2DModel(nn.Module):
     def __init__(self, 
@@ -639,3 +643,105 @@ def phaseunwrap_skimage(field, norm_phase_after=False):
 
     # Return the corrected field
     return torch.abs(field) * torch.exp(1j * phase_unwrapped)
+
+
+class SidebandExtractor:
+    def __init__(self, mask, device='cpu'):
+        """
+        Extracts the masked 1st order sideband from a real rfft2 of the holograms by index arithmetic,
+        instead of multiplying with torch.exp(1j*kx_add_ky) and doing a full complex fft2.
+        The shift is rounded to whole frequency bins, the remaining linear phase is removed by the background fit.
+
+        Args:
+        - mask (torch.Tensor): Mask in the shifted Fourier space (mask_list[0]).
+        - device (str): Device to use.
+        """
+        self.device = device
+        self.shape = tuple(mask.shape[-2:])
+        xr, yr = self.shape
+
+        mask = mask.to(device)
+        self.rows = self.get_box(torch.nonzero(mask.bool().any(dim=1)).flatten(), xr)
+        self.cols = self.get_box(torch.nonzero(mask.bool().any(dim=0)).flatten(), yr)
+        self.mask_crop = mask[self.rows[0]:self.rows[1], self.cols[0]:self.cols[1]]
+
+        # Frequencies of the box, relative to the zero frequency.
+        self.freq_r = torch.arange(*self.rows, device=device) - xr // 2
+        self.freq_c = torch.arange(*self.cols, device=device) - yr // 2
+
+    @staticmethod
+    def get_box(idx, n):
+        """
+        Start and stop of an even sized range centered on n//2 that covers idx.
+        """
+        if idx.numel() == 0:
+            return (n // 2, n // 2)
+        a = int(max(n // 2 - idx.min().item(), idx.max().item() + 1 - n // 2))
+        if 2 * a > n:
+            return (0, n)
+        return (n // 2 - a, n // 2 + a)
+
+    def get_shift(self, kx_pos, ky_pos):
+        """
+        Shift in whole frequency bins from the wave vectors of the peak (rows, columns), shapes (B,).
+        """
+        xr, yr = self.shape
+        kx_pos = torch.as_tensor(kx_pos, device=self.device).reshape(-1)
+        ky_pos = torch.as_tensor(ky_pos, device=self.device).reshape(-1)
+        shift_r = torch.round(kx_pos * xr / (2 * torch.pi)).long()
+        shift_c = torch.round(ky_pos * yr / (2 * torch.pi)).long()
+        return shift_r, shift_c
+
+    def get_sideband(self, holograms, shift_r, shift_c):
+        """
+        Masked sideband of the holograms, centered in the box.
+
+        Args:
+        - holograms (torch.Tensor): Real holograms, shape (B, H, W).
+        - shift_r, shift_c (torch.Tensor): Shifts from get_shift, shape (B,) or (1,).
+
+        Returns:
+        - torch.Tensor: Sidebands, shape (B, h, w).
+        """
+        xr, yr = self.shape
+        B = holograms.shape[0]
+        fftImage = torch.fft.rfft2(holograms)
+
+        src_r = (self.freq_r[None, :] - shift_r.reshape(-1, 1)) % xr
+        src_c = (self.freq_c[None, :] - shift_c.reshape(-1, 1)) % yr
+
+        # rfft2 only stores columns 0...W//2, F[r, c] = conj(F[-r, -c]) for the others.
+        in_half = (src_c <= yr // 2)[:, None, :]
+        idx_r = torch.where(in_half, src_r[:, :, None], (-src_r[:, :, None]) % xr)
+        idx_c = torch.where(in_half, src_c[:, None, :], (-src_c[:, None, :]) % yr)
+        idx_b = torch.arange(B, device=fftImage.device)[:, None, None]
+
+        sideband = fftImage[idx_b, idx_r.expand(B, -1, -1), idx_c.expand(B, -1, -1)]
+        sideband = torch.where(in_half, sideband, sideband.conj())
+        return sideband * self.mask_crop
+
+    def sideband_to_field(self, sideband, downsize=False):
+        """
+        Complex valued fields from sidebands in the box, shape (B, h, w).
+        With downsize only the box is inverse transformed, giving fields at reduced resolution (B, h, w),
+        scaled with (h*w)/(H*W) to keep the amplitude of the full size fields. Otherwise the fields have shape (B, H, W).
+        """
+        if downsize:
+            h, w = sideband.shape[-2:]
+            return torch.fft.ifft2(torch.fft.ifftshift(sideband, dim=(-2, -1))) * (h * w / (self.shape[0] * self.shape[1]))
+
+        fftImage = torch.zeros((*sideband.shape[:-2], *self.shape), dtype=sideband.dtype, device=sideband.device)
+        fftImage[..., self.rows[0]:self.rows[1], self.cols[0]:self.cols[1]] = sideband
+        return torch.fft.ifft2(torch.fft.ifftshift(fftImage, dim=(-2, -1)))
+
+    def crop_spectrum(self, fftImage):
+        """
+        Crops shifted (and masked) spectra to the box of the mask.
+        """
+        return fftImage[..., self.rows[0]:self.rows[1], self.cols[0]:self.cols[1]]
+
+    def get_field(self, holograms, shift_r, shift_c, downsize=False):
+        """
+        Complex valued fields of the holograms, at full size or downsized to the box of the mask.
+        """
+        return self.sideband_to_field(self.get_sideband(holograms, shift_r, shift_c), downsize=downsize)
@@ -0,0 +1,561 @@
+# -*- coding: utf-8 -*-
+"""
+Recording formats written by the VideoWriterThread, with readers.
+
+raw: The frames are appended to one memory-mapped file ("name.raw"), so writing a frame is a single copy.
+    The file starts with a header of RAW_HEADER_SIZE bytes: the magic RAW_MAGIC followed by a JSON dict with dtype,
+    shape, fps and the number of frames (updated on close). The frames follow back to back, frame k starts at
+    RAW_HEADER_SIZE + k * frame_nbytes. The file is grown in steps while recording and truncated on close.
+    A sidecar index ("name.raw.idx") holds one RAW_INDEX_DTYPE record per frame: timestamp, frame ID and camera ID.
+    If the recording was not closed (crash, power loss) the number of frames is taken from the index.
+
+hdf5: Lossless, compressed recording ("name.h5", needs h5py). The frames are stored in the dataset "frames" in chunks
+    of chunk_frames frames, timestamps, frame IDs and camera IDs in datasets of the same names. Each chunk is
+    compressed on a thread pool and written with write_direct_chunk, so the writer thread only copies the frame
+    into a chunk buffer. Codecs (see HDF5_CODECS):
+        'blosc-lz4'  : blosc with lz4 and bitshuffle (needs blosc and hdf5plugin), fast enough for live recording.
+        'blosc-zstd' : blosc with zstd and bitshuffle, smaller files but slower.
+        'gzip'       : HDF5's own shuffle + deflate, readable everywhere but ~10 fps per core at 1920x1280.
+    Files written with the blosc codecs are read with h5py after "import hdf5plugin".
+
+mkv: Lossless video ("name.mkv") encoded by an ffmpeg subprocess. The frames are streamed as raw gray/gray16le
+    pixels over a pipe, nothing is converted in Python. Codecs (see FFMPEG_CODECS):
+        'ffv1' : FFV1 level 3 with slices, 8 and 16 bit (12-bit frames keep their full depth).
+        'x264' : libx264 with -qp 0, 8 bit only.
+    ffmpeg must be on the PATH.
+
+Segmented recordings: SegmentedWriter writes raw, hdf5 or mkv recordings with several writer threads in parallel.
+    The frames are cut into blocks of block_frames frames and block b goes to worker b % n_workers, each worker
+    writes its own file ("name_k.raw", ...). The manifest "name.json" has the files and the block size, so the
+    recording order can be restored (get_segment_ranges) or the files concatenated.
+"""
+
+import json
+import mmap
+import os
+import shutil
+import subprocess
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Thread
+from time import perf_counter
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import blosc
+    import hdf5plugin
+except ImportError:
+    blosc = None
+    hdf5plugin = None
+
+RAW_MAGIC = b'HOLORAW1'
+RAW_HEADER_SIZE = 4096
+RAW_INDEX_DTYPE = np.dtype([('timestamp', '<f8'), ('frame_id', '<i8'), ('camera_id', '<i4')])
+
+class RawVideoWriter:
+    """
+    Writes frames of one shape and dtype to a raw file, see the module docstring.
+
+    Input:
+        path : File name, the index is written to path + '.idx'.
+        shape : Shape of the frames.
+        dtype : dtype of the frames.
+        fps : Frame rate, only stored in the header.
+        grow_frames : Number of frames the file is grown by when it is full.
+    """
+
+    def __init__(self, path, shape, dtype = np.uint8, fps = 0, grow_frames = 256):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.fps = fps
+        self.grow_frames = max(int(grow_frames), 1)
+        self.frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.n_frames = 0
+        self.capacity = 0
+        self.mmap = None
+        self.frames = None
+
+        self.file = open(path, 'w+b')
+        # Unbuffered, the index tells how many frames were written if the recording is never closed.
+        self.index_file = open(path + '.idx', 'wb', buffering = 0)
+        self.write_header()
+        self.grow()
+
+    def write_header(self):
+        header = json.dumps({
+            'dtype': self.dtype.str,
+            'shape': list(self.shape),
+            'fps': self.fps,
+            'n_frames': self.n_frames,
+            }).encode()
+        if len(RAW_MAGIC) + len(header) > RAW_HEADER_SIZE:
+            raise ValueError("Raw header too large")
+        self.file.seek(0)
+        self.file.write(RAW_MAGIC + header.ljust(RAW_HEADER_SIZE - len(RAW_MAGIC), b' '))
+        self.file.flush()
+
+    def unmap(self):
+        self.frames = None
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def grow(self):
+        """
+        Grows the file by grow_frames frames and maps it again.
+        """
+        self.unmap()
+        self.capacity += self.grow_frames
+        self.file.truncate(RAW_HEADER_SIZE + self.capacity * self.frame_nbytes)
+        self.mmap = mmap.mmap(self.file.fileno(), 0)
+        self.frames = np.ndarray(
+            (self.capacity, *self.shape), dtype = self.dtype, buffer = self.mmap, offset = RAW_HEADER_SIZE
+            )
+
+    def write(self, frame, timestamp = None, frame_id = None, camera_id = 0):
+        if frame.shape != self.shape:
+            raise ValueError(f"Frame of shape {frame.shape} in a raw recording of shape {self.shape}")
+        if self.n_frames == self.capacity:
+            self.grow()
+
+        self.frames[self.n_frames] = frame
+        record = np.array(
+            (perf_counter() if timestamp is None else timestamp, self.n_frames if frame_id is None else frame_id, camera_id),
+            dtype = RAW_INDEX_DTYPE
+            )
+        self.index_file.write(record.tobytes())
+        self.n_frames += 1
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.unmap()
+        self.file.truncate(RAW_HEADER_SIZE + self.n_frames * self.frame_nbytes)
+        self.write_header()
+        self.file.close()
+        self.index_file.close()
+
+def read_raw_header(path):
+    with open(path, 'rb') as f:
+        data = f.read(RAW_HEADER_SIZE)
+    if not data.startswith(RAW_MAGIC):
+        raise ValueError(f"{path} is not a raw recording")
+    return json.loads(data[len(RAW_MAGIC):].decode())
+
+class RawVideoReader:
+    """
+    Random access to the frames of a raw recording, reader[k] is a view of frame k in the memory-mapped file.
+    timestamps, frame_ids and camera_ids are read from the index (None if there is no index).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        header = read_raw_header(path)
+        self.dtype = np.dtype(header['dtype'])
+        self.shape = tuple(header['shape'])
+        self.fps = header['fps']
+        frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        # Not closed recordings have n_frames 0 in the header and are preallocated, the index has the written frames.
+        n_frames = header['n_frames']
+        if n_frames == 0:
+            n_frames = (os.path.getsize(path) - RAW_HEADER_SIZE) // frame_nbytes
+
+        self.index = None
+        if os.path.isfile(path + '.idx'):
+            self.index = np.fromfile(path + '.idx', dtype = RAW_INDEX_DTYPE)
+            if header['n_frames'] == 0:
+                n_frames = min(n_frames, len(self.index))
+            self.index = self.index[:n_frames]
+
+        self.frames = np.memmap(path, dtype = self.dtype, mode = 'r', offset = RAW_HEADER_SIZE, shape = (n_frames, *self.shape)) \
+            if n_frames > 0 else np.zeros((0, *self.shape), dtype = self.dtype)
+
+    @property
+    def timestamps(self):
+        return None if self.index is None else self.index['timestamp']
+
+    @property
+    def frame_ids(self):
+        return None if self.index is None else self.index['frame_id']
+
+    @property
+    def camera_ids(self):
+        return None if self.index is None else self.index['camera_id']
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, k):
+        return self.frames[k]
+
+HDF5_CODECS = ('blosc-lz4', 'blosc-zstd', 'gzip')
+
+def available_hdf5_codecs():
+    """
+    Codecs of the hdf5 format that can be used in this environment.
+    """
+    if h5py is None:
+        return []
+    if blosc is None:
+        return ['gzip']
+    return list(HDF5_CODECS)
+
+def shuffle_bytes(data, itemsize):
+    """
+    Byte shuffle of HDF5's shuffle filter, the k-th bytes of all elements are stored together.
+    """
+    if itemsize == 1:
+        return data.tobytes()
+    return data.view(np.uint8).reshape(-1, itemsize).T.tobytes()
+
+class HDF5VideoWriter:
+    """
+    Writes frames of one shape and dtype to a compressed HDF5 file, see the module docstring.
+
+    Input:
+        path : File name.
+        shape : Shape of the frames.
+        dtype : dtype of the frames.
+        fps : Frame rate, stored as an attribute.
+        codec : One of HDF5_CODECS.
+        level : Compression level.
+        chunk_frames : Frames per chunk.
+        workers : Compression threads, default all cores.
+    """
+
+    def __init__(self, path, shape, dtype = np.uint8, fps = 0, codec = 'blosc-lz4', level = 5, chunk_frames = 16,
+                 workers = None):
+        if h5py is None:
+            raise ImportError("The hdf5 format needs h5py")
+        if codec not in available_hdf5_codecs():
+            raise ValueError(f"HDF5 codec {codec} not available, use one of {available_hdf5_codecs()}")
+
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.codec = codec
+        self.level = level
+        self.chunk_frames = max(int(chunk_frames), 1)
+        self.workers = workers or os.cpu_count() or 1
+        self.n_frames = 0
+        self.chunk_index = 0
+        self.timestamps = []
+        self.frame_ids = []
+        self.camera_ids = []
+
+        if codec == 'gzip':
+            filters = {'compression': 'gzip', 'compression_opts': level, 'shuffle': True}
+        else:
+            # The chunks are compressed by us, blosc should not start threads of its own.
+            blosc.set_nthreads(1)
+            filters = hdf5plugin.Blosc(cname = codec.split('-')[1], clevel = level, shuffle = hdf5plugin.Blosc.BITSHUFFLE)
+
+        self.file = h5py.File(path, 'w')
+        self.dataset = self.file.create_dataset(
+            'frames', shape = (0, *self.shape), maxshape = (None, *self.shape), dtype = self.dtype,
+            chunks = (self.chunk_frames, *self.shape), **filters
+            )
+        self.dataset.attrs['fps'] = fps
+        self.dataset.attrs['codec'] = codec
+
+        # Chunk buffers are reused, at most 2 per worker are compressed or waiting to be written.
+        self.free_buffers = [np.zeros((self.chunk_frames, *self.shape), dtype = self.dtype)
+                             for _ in range(2 * self.workers)]
+        self.buffer = self.free_buffers.pop()
+        self.buffer_count = 0
+        self.pending = deque()
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix = 'hdf5_compression')
+
+    def compress(self, buffer):
+        if self.codec == 'gzip':
+            return zlib.compress(shuffle_bytes(buffer, self.dtype.itemsize), self.level)
+        return blosc.compress_ptr(buffer.__array_interface__['data'][0], buffer.size, typesize = self.dtype.itemsize,
+                                  clevel = self.level, shuffle = blosc.BITSHUFFLE, cname = self.codec.split('-')[1])
+
+    def write_pending(self, block = False):
+        """
+        Writes the compressed chunks in order, the file is only touched by the writer thread.
+        With block it waits for the oldest chunk if none is done.
+        """
+        while len(self.pending) > 0 and (block or self.pending[0][2].done()):
+            chunk_index, buffer, future = self.pending.popleft()
+            self.dataset.id.write_direct_chunk((chunk_index * self.chunk_frames, *[0] * len(self.shape)), future.result())
+            self.free_buffers.append(buffer)
+            block = False
+
+    def submit_chunk(self):
+        if self.buffer_count < self.chunk_frames:
+            # Last chunk, HDF5 chunks always have the full size.
+            self.buffer[self.buffer_count:] = 0
+        self.pending.append((self.chunk_index, self.buffer, self.pool.submit(self.compress, self.buffer)))
+        self.chunk_index += 1
+        self.buffer_count = 0
+
+        self.write_pending()
+        if len(self.free_buffers) == 0:
+            self.write_pending(block = True)
+        self.buffer = self.free_buffers.pop()
+
+    def write(self, frame, timestamp = None, frame_id = None, camera_id = 0):
+        if frame.shape != self.shape:
+            raise ValueError(f"Frame of shape {frame.shape} in a hdf5 recording of shape {self.shape}")
+
+        self.buffer[self.buffer_count] = frame
+        self.buffer_count += 1
+        self.timestamps.append(perf_counter() if timestamp is None else timestamp)
+        self.frame_ids.append(self.n_frames if frame_id is None else frame_id)
+        self.camera_ids.append(camera_id)
+        self.n_frames += 1
+
+        if self.buffer_count == self.chunk_frames:
+            self.dataset.resize(self.n_frames, axis = 0)
+            self.submit_chunk()
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.buffer_count > 0:
+            self.dataset.resize(self.n_frames, axis = 0)
+            self.submit_chunk()
+        while len(self.pending) > 0:
+            self.write_pending(block = True)
+        self.pool.shutdown()
+
+        index = np.array(list(zip(self.timestamps, self.frame_ids, self.camera_ids)), dtype = RAW_INDEX_DTYPE)
+        self.file.create_dataset('timestamps', data = index['timestamp'])
+        self.file.create_dataset('frame_ids', data = index['frame_id'])
+        self.file.create_dataset('camera_ids', data = index['camera_id'])
+        self.file.close()
+        self.file = None
+
+FFMPEG_CODECS = ('ffv1', 'x264')
+
+def get_ffmpeg_command(path, shape, dtype, fps, codec = 'ffv1', threads = None):
+    """
+    ffmpeg command reading raw frames of shape and dtype from stdin and encoding them losslessly to path.
+    """
+    height, width = shape[:2]
+    if np.dtype(dtype) == np.uint8:
+        pixel_format = 'gray'
+    elif np.dtype(dtype) == np.uint16:
+        pixel_format = 'gray16le'
+    else:
+        raise ValueError(f"No ffmpeg pixel format for frames of dtype {dtype}")
+    threads = str(threads or os.cpu_count() or 1)
+
+    command = ['ffmpeg', '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', pixel_format, '-s', f'{width}x{height}',
+               '-framerate', str(fps if fps and fps > 0 else 25), '-i', '-']
+    if codec == 'ffv1':
+        # Intra only with slices, so all threads are used and every frame can be decoded on its own.
+        command += ['-c:v', 'ffv1', '-level', '3', '-g', '1', '-slices', '24', '-slicecrc', '0', '-threads', threads]
+    elif codec == 'x264':
+        if pixel_format != 'gray':
+            raise ValueError("x264 only records 8-bit frames losslessly, use ffv1")
+        command += ['-c:v', 'libx264', '-preset', 'ultrafast', '-qp', '0', '-pix_fmt', 'gray', '-threads', threads]
+    else:
+        raise ValueError(f"ffmpeg codec {codec} not recognized, use one of {FFMPEG_CODECS}")
+    return command + [path]
+
+class FFmpegVideoWriter:
+    """
+    Streams frames of one shape and dtype to an ffmpeg subprocess, see the module docstring.
+
+    Input:
+        path : File name, .mkv.
+        shape : Shape of the frames.
+        dtype : dtype of the frames, uint8 or uint16.
+        fps : Frame rate of the video.
+        codec : One of FFMPEG_CODECS.
+        threads : Encoder threads, default all cores.
+        pipe_size : Requested size of the pipe to ffmpeg (bytes), capped by the system limit.
+    """
+
+    def __init__(self, path, shape, dtype = np.uint8, fps = 25, codec = 'ffv1', threads = None, pipe_size = 64 * 1024**2):
+        if shutil.which('ffmpeg') is None:
+            raise FileNotFoundError("The mkv format needs ffmpeg on the PATH")
+
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.n_frames = 0
+        self.command = get_ffmpeg_command(path, self.shape, self.dtype, fps, codec, threads)
+        self.process = subprocess.Popen(self.command, stdin = subprocess.PIPE, bufsize = 0)
+        self.set_pipe_size(pipe_size)
+
+    def set_pipe_size(self, pipe_size):
+        # A large pipe lets ffmpeg fall behind for a while without blocking the writer thread (Linux only).
+        if fcntl is None or not hasattr(fcntl, 'F_SETPIPE_SZ'):
+            return
+        try:
+            with open('/proc/sys/fs/pipe-max-size') as f:
+                pipe_size = min(pipe_size, int(f.read()))
+            fcntl.fcntl(self.process.stdin.fileno(), fcntl.F_SETPIPE_SZ, pipe_size)
+        except (OSError, ValueError) as ex:
+            print(f"Could not set the ffmpeg pipe size, {ex}")
+
+    def write(self, frame, timestamp = None, frame_id = None, camera_id = 0):
+        if frame.shape != self.shape or frame.dtype != self.dtype:
+            raise ValueError(f"Frame of shape {frame.shape} ({frame.dtype}) in a video of shape {self.shape} ({self.dtype})")
+        try:
+            self.process.stdin.write(memoryview(np.ascontiguousarray(frame)).cast('B'))
+        except BrokenPipeError:
+            raise RuntimeError(f"ffmpeg stopped with return code {self.process.poll()}")
+        self.n_frames += 1
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            print(f"ffmpeg exited with return code {self.process.returncode}")
+        self.process = None
+
+# Formats that can be written in segments, extension and writer class.
+SEGMENT_WRITERS = {
+    'raw': ('.raw', RawVideoWriter),
+    'hdf5': ('.h5', HDF5VideoWriter),
+    'mkv': ('.mkv', FFmpegVideoWriter),
+    }
+
+def is_format_available(video_format):
+    """
+    False for the formats whose dependencies are missing (h5py for hdf5, ffmpeg for mkv).
+    """
+    if video_format == 'hdf5':
+        return len(available_hdf5_codecs()) > 0
+    if video_format == 'mkv':
+        return shutil.which('ffmpeg') is not None
+    return True
+
+class SegmentedWriter:
+    """
+    Writes a recording with n_workers writer threads, see the module docstring. Same write/close interface as
+    the writers of the single formats. Threads are enough, all writers release the GIL while writing
+    (memory copies and file writes, blosc/zlib, the ffmpeg pipe).
+
+    Input:
+        path : File name without extension, worker k writes path_k.ext and the manifest is path.json.
+        shape : Shape of the frames.
+        dtype : dtype of the frames.
+        fps : Frame rate.
+        video_format : 'raw', 'hdf5' or 'mkv'.
+        n_workers : Number of writer threads and files.
+        block_frames : Consecutive frames written by the same worker.
+        writer_kwargs : Passed on to the writers, e.g. codec.
+    """
+
+    def __init__(self, path, shape, dtype = np.uint8, fps = 0, video_format = 'raw', n_workers = 2, block_frames = 16,
+                 **writer_kwargs):
+        if video_format not in SEGMENT_WRITERS:
+            raise ValueError(f"Format {video_format} can not be written in segments, use one of {list(SEGMENT_WRITERS)}")
+        extension, writer_class = SEGMENT_WRITERS[video_format]
+
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.fps = fps
+        self.video_format = video_format
+        self.n_workers = max(int(n_workers), 1)
+        self.block_frames = max(int(block_frames), 1)
+        self.n_frames = 0
+        self.errors = []
+
+        self.files = [f'{path}_{k}{extension}' for k in range(self.n_workers)]
+        self.writers = [writer_class(file, self.shape, self.dtype, fps = fps, **writer_kwargs) for file in self.files]
+        # Room for two blocks per worker, a slow worker blocks write and the recording queue fills up instead.
+        self.queues = [Queue(maxsize = 2 * self.block_frames) for _ in range(self.n_workers)]
+        self.threads = [Thread(target = self.run_worker, args = (k,), name = f'segment_writer_{k}', daemon = True)
+                        for k in range(self.n_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def run_worker(self, k):
+        writer, queue = self.writers[k], self.queues[k]
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            if len(self.errors) > 0:
+                # Keep emptying the queue so write does not block.
+                continue
+            try:
+                writer.write(*item)
+            except Exception as ex:
+                print(f"Segment writer {k} failed, {ex}")
+                self.errors.append(ex)
+        writer.close()
+
+    def write(self, frame, timestamp = None, frame_id = None, camera_id = 0):
+        if len(self.errors) > 0:
+            raise RuntimeError(f"Segment writer failed, {self.errors[0]}")
+        worker = (self.n_frames // self.block_frames) % self.n_workers
+        self.queues[worker].put((frame, timestamp, frame_id, camera_id))
+        self.n_frames += 1
+
+    def close(self):
+        if self.threads is None:
+            return
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = None
+
+        manifest = {
+            'format': self.video_format,
+            'files': [os.path.basename(file) for file in self.files],
+            'block_frames': self.block_frames,
+            'n_frames': self.n_frames,
+            'shape': list(self.shape),
+            'dtype': self.dtype.str,
+            'fps': self.fps,
+            }
+        with open(self.path + '.json', 'w') as f:
+            json.dump(manifest, f, indent = 2)
+
+def read_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    folder = os.path.dirname(path)
+    manifest['files'] = [os.path.join(folder, file) for file in manifest['files']]
+    return manifest
+
+def get_segment_ranges(manifest, start = 0, stop = None):
+    """
+    Frames start to stop of a segmented recording in recording order.
+
+    Input:
+        manifest : Manifest of the recording, from read_manifest.
+        start : First frame.
+        stop : Frame to stop before, None for the end of the recording.
+    Output:
+        Generator of (file, first, last, offset), frames first to last (exclusive) of file are the frames
+        offset + (0, ..., last - first) of the recording.
+    """
+    n_frames, block_frames, files = manifest['n_frames'], manifest['block_frames'], manifest['files']
+    stop = n_frames if stop is None else min(stop, n_frames)
+
+    block = start // block_frames
+    while block * block_frames < stop:
+        offset = block * block_frames
+        local = (block // len(files)) * block_frames
+        first = max(start, offset)
+        last = min(offset + block_frames, stop)
+        yield files[block % len(files)], local + first - offset, local + last - offset, first
+        block += 1